@@ -1,58 +1,105 @@
+# few-shot 示例与示例部分的渲染只依赖模块常量，在导入时完成一次，构建 prompt 时只拼接样本本身
+
+
+def _format_choices_csqa(choices):
+    if isinstance(choices, dict):
+        return " ".join([f"({k}) {v}" for k, v in choices.items()])
+    else:
+        return " ".join([f"({c['label']}) {c['text']}" for c in choices])
+
+
+def _format_choices_cose(choices_list):
+    labels = [chr(ord('A') + i) for i in range(len(choices_list))]
+    return " ".join([f"({label}) {choice}" for label, choice in zip(labels, choices_list)])
+
+
+def _format_reasoning_example(ex, format_choices):
+    return (
+        f"Question: {ex['question']}\n"
+        f"Choices: {format_choices(ex['choices'])}\n"
+        f"{ex['reasoning']}\n"
+    )
+
+
+def _format_answer_example(ex, format_choices):
+    return (
+        f"Question: {ex['question']}\n"
+        f"Choices: {format_choices(ex['choices'])}\n"
+        f"Answer: {ex['answer']}\n"
+    )
+
+
+# few-shot 示例
+CSQA_K_EXAMPLES = [
+    {
+        "question": "What is used to write on a blackboard?",
+        "choices": {"A": "chalk", "B": "pen", "C": "crayon", "D": "marker", "E": "brush"},
+        "reasoning": (
+            "First, the most promising option is (A) chalk."
+            "There are two reasons support this choice: firstly, Chalk produces visible marks on blackboards. Secondly, Chalk is designed not to damage the board surface.\n"
+            "The least suitable option is (E) brush, as brushes are used for painting, not writing."
+        ),
+        "answer": "A"
+    },
+    {
+        "question": "What do you wear on your feet to walk outside?",
+        "choices": {"A": "hat", "B": "scarf", "C": "gloves", "D": "shoes", "E": "glasses"},
+        "reasoning": (
+            "First, (D) shoes are the most reasonable choice."
+            "There are two reasons support this choice: firstly,Shoes protect your feet outdoors. Secondly, Shoes are specifically made for walking and provide comfort and grip.\n"
+            "The least fitting option is (A) hat, as it's worn on the head, not feet."
+        ),
+        "answer": "D"
+    }
+]
+
+COSE_K_EXAMPLES = [
+    {
+        "question": "What is used to write on a blackboard?",
+        "choices": ["chalk", "pen", "crayon", "marker", "brush"],
+        "reasoning": (
+            "First, (A) chalk is the most suitable."
+            "There are two reasons support this choice: Firstly, Chalk produces visible marks on blackboards. Secondly, Chalk is designed not to damage the board surface."
+            "The least suitable is (E) brush, because brushes are not used for writing."
+        ),
+        "answer": "A"
+    },
+    {
+        "question": "What do you wear on your feet to walk outside?",
+        "choices": ["hat", "scarf", "gloves", "shoes", "glasses"],
+        "reasoning": (
+            "First, the best option is (D) shoes."
+            "There are two reasons support this choice: Firstly, Shoes protect your feet outdoors. Secondly, Shoes are specifically made for walking and provide comfort and grip."
+            "The most unsuitable is (A) hat, which is worn on your head, not feet."
+        ),
+        "answer": "D"
+    }
+]
+
+_CSQA_REASONING_EXAMPLES = "".join(
+    _format_reasoning_example(ex, _format_choices_csqa) + "\n" for ex in CSQA_K_EXAMPLES
+)
+_CSQA_ANSWER_EXAMPLES = "".join(
+    _format_answer_example(ex, _format_choices_csqa) + "\n" for ex in CSQA_K_EXAMPLES
+)
+_COSE_REASONING_EXAMPLES = "".join(
+    _format_reasoning_example(ex, _format_choices_cose) + "\n" for ex in COSE_K_EXAMPLES
+)
+_COSE_ANSWER_EXAMPLES = "".join(
+    _format_answer_example(ex, _format_choices_cose) + "\n" for ex in COSE_K_EXAMPLES
+)
+
+
 def build_fewshot_prompt_csqa(item, stage='both'):
     """
     构建 CSQA 数据集 natural 风格的 few-shot prompt，支持 reasoning / answer / both 两阶段。
     """
-    def format_choices(choices):
-        if isinstance(choices, dict):
-            return " ".join([f"({k}) {v}" for k, v in choices.items()])
-        else:
-            return " ".join([f"({c['label']}) {c['text']}" for c in choices])
-
-    def format_reasoning_example(ex):
-        return (
-            f"Question: {ex['question']}\n"
-            f"Choices: {format_choices(ex['choices'])}\n"
-            f"{ex['reasoning']}\n"
-        )
-
-    def format_answer_example(ex):
-        return (
-            f"Question: {ex['question']}\n"
-            f"Choices: {format_choices(ex['choices'])}\n"
-            f"Answer: {ex['answer']}\n"
-        )
-
-    # few-shot 示例
-    k_examples = [
-        {
-            "question": "What is used to write on a blackboard?",
-            "choices": {"A": "chalk", "B": "pen", "C": "crayon", "D": "marker", "E": "brush"},
-            "reasoning": (
-                "First, the most promising option is (A) chalk."
-                "There are two reasons support this choice: firstly, Chalk produces visible marks on blackboards. Secondly, Chalk is designed not to damage the board surface.\n"
-                "The least suitable option is (E) brush, as brushes are used for painting, not writing."
-            ),
-            "answer": "A"
-        },
-        {
-            "question": "What do you wear on your feet to walk outside?",
-            "choices": {"A": "hat", "B": "scarf", "C": "gloves", "D": "shoes", "E": "glasses"},
-            "reasoning": (
-                "First, (D) shoes are the most reasonable choice."
-                "There are two reasons support this choice: firstly,Shoes protect your feet outdoors. Secondly, Shoes are specifically made for walking and provide comfort and grip.\n"
-                "The least fitting option is (A) hat, as it's worn on the head, not feet."
-            ),
-            "answer": "D"
-        }
-    ]
-
     prompt = ""
     if stage == 'reasoning':
         prompt += "Here are some natural language reasoning examples:\n\n"
-        for ex in k_examples:
-            prompt += format_reasoning_example(ex) + "\n"
+        prompt += _CSQA_REASONING_EXAMPLES
         question = item["question"]
-        choices_str = format_choices(item["choices"])
+        choices_str = _format_choices_csqa(item["choices"])
         prompt += (
             f"Now, think about the following question carefully:\n\n"
             f"Question: {question}\n"
@@ -66,10 +113,9 @@ def build_fewshot_prompt_csqa(item, stage='both'):
 
     elif stage == 'answer':
         prompt += "Here are some examples of final answers:\n\n"
-        for ex in k_examples:
-            prompt += format_answer_example(ex) + "\n"
+        prompt += _CSQA_ANSWER_EXAMPLES
         question = item["question"]
-        choices_str = format_choices(item["choices"])
+        choices_str = _format_choices_csqa(item["choices"])
         prompt += (
             f"Based on the previous reasoning about this question:\n"
             f"Question: {question}\n"
@@ -87,54 +133,12 @@ def build_fewshot_prompt_cose(item, stage='both'):
     """
     针对 CoE-S 数据集构建 natural 风格的 few-shot prompt，选项自动生成标签 A/B/C 等。
     """
-    def format_choices(choices_list):
-        labels = [chr(ord('A') + i) for i in range(len(choices_list))]
-        return " ".join([f"({label}) {choice}" for label, choice in zip(labels, choices_list)])
-
-    def format_reasoning_example(ex):
-        return (
-            f"Question: {ex['question']}\n"
-            f"Choices: {format_choices(ex['choices'])}\n"
-            f"{ex['reasoning']}\n"
-        )
-
-    def format_answer_example(ex):
-        return (
-            f"Question: {ex['question']}\n"
-            f"Choices: {format_choices(ex['choices'])}\n"
-            f"Answer: {ex['answer']}\n"
-        )
-
-    k_examples = [
-        {
-            "question": "What is used to write on a blackboard?",
-            "choices": ["chalk", "pen", "crayon", "marker", "brush"],
-            "reasoning": (
-                "First, (A) chalk is the most suitable."
-                "There are two reasons support this choice: Firstly, Chalk produces visible marks on blackboards. Secondly, Chalk is designed not to damage the board surface."
-                "The least suitable is (E) brush, because brushes are not used for writing."
-            ),
-            "answer": "A"
-        },
-        {
-            "question": "What do you wear on your feet to walk outside?",
-            "choices": ["hat", "scarf", "gloves", "shoes", "glasses"],
-            "reasoning": (
-                "First, the best option is (D) shoes."
-                "There are two reasons support this choice: Firstly, Shoes protect your feet outdoors. Secondly, Shoes are specifically made for walking and provide comfort and grip."
-                "The most unsuitable is (A) hat, which is worn on your head, not feet."
-            ),
-            "answer": "D"
-        }
-    ]
-
     prompt = ""
     if stage == 'reasoning':
         prompt += "Here are some natural language reasoning examples:\n\n"
-        for ex in k_examples:
-            prompt += format_reasoning_example(ex) + "\n"
+        prompt += _COSE_REASONING_EXAMPLES
         question = item["question"]
-        choices_str = format_choices(item["choices"])
+        choices_str = _format_choices_cose(item["choices"])
         prompt += (
             f"Now, think about the following question carefully:\n\n"
             f"Question: {question}\n"
@@ -148,10 +152,9 @@ def build_fewshot_prompt_cose(item, stage='both'):
 
     elif stage == 'answer':
         prompt += "Here are some examples of final answers:\n\n"
-        for ex in k_examples:
-            prompt += format_answer_example(ex) + "\n"
+        prompt += _COSE_ANSWER_EXAMPLES
         question = item["question"]
-        choices_str = format_choices(item["choices"])
+        choices_str = _format_choices_cose(item["choices"])
         prompt += (
             f"Based on the previous reasoning about this question:\n"
             f"Question: {question}\n"
@@ -16,8 +16,18 @@ EXAMPLES_ROOT = "../prompts/examples"
 # 推理参数
 TEMPERATURE = 0.7
 MAX_NEW_TOKENS = 256
+# 第二阶段（只输出选项标签）的生成长度
+ANSWER_MAX_NEW_TOKENS = 32
 ICL_MODE = "zero-shot-cot"  # 可选：zero-shot-cot、few-shot-cot、zero-shot-baseline
 
+# NLI 评估参数
+NLI_MODEL_NAME = "roberta-large-mnli"
+# 软阈值设置：大于等于此值判为 ENTAILMENT，小于等于此值判为 CONTRADICTION
+ENTAILMENT_THRESHOLD = 0.5
+CONTRADICTION_THRESHOLD = 0.2
+CHAIN_PREMISE_PREFIX = "The reasoning says: "
+HYPOTHESIS_TEMPLATE = "The final choice is {answer}."
+
 # 结果输出
 OUTPUT_PATH = "outputs/results.jsonl"
 LOG_PATH = "outputs/logs" 
\ No newline at end of file
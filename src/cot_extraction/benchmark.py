@@ -0,0 +1,108 @@
+# 推理链抽取的一致性校验与微基准
+# golden corpus 由已保存结果中的 model_reasoning 字段（外加少量内置样例）构成，
+# 期望输出由旧版实现 extract_cot_steps_legacy 生成；新版 extract_cot_steps 必须逐条完全一致。
+
+import argparse
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from src.cot_extraction.corpus import iter_reasoning_corpus, PROMPT_TYPES
+from src.cot_extraction.extractor import extract_cot_steps
+from src.cot_extraction.legacy import extract_cot_steps_legacy
+
+# 内置样例：覆盖三种 prompt 类型的常见输出形态与回退路径，保证 outputs/ 为空时也能校验
+BUILTIN_SAMPLES: List[Tuple[str, str]] = [
+    ("Step 1: The question asks where a revolving door serves as a security measure; (A) bank is most plausible.\n"
+     "Step 2: Banks need to control who enters. Revolving doors slow down people leaving in a hurry.\n"
+     "Step 3: (E) new york is unsuitable because it is a city, not a building.\nA", 'templated'),
+    ("Step 1: Chalk seems most plausible.\nStep 2: - Chalk writes clearly; - Chalk is erasable.\n"
+     "Step 2: - Chalk writes clearly; - Chalk is erasable.\n提取的推理步骤：Step 1: duplicated", 'templated'),
+    ("第一步：理解问题。\n步骤：比较选项。\n", 'templated'),
+    ("1. Read the question carefully\n2. Compare the options\n(3) Pick the best one\n", 'templated'),
+    ("The answer is clearly about shoes\n\n4\nShoes protect feet outdoors\nok", 'templated'),
+    ("First, the most promising option is (A) bank, since banks keep money safe. Then, revolving doors "
+     "make it hard to run out quickly. Also, they control the flow of people! Finally, (E) new york is "
+     "a city and not a place with a door.", 'natural'),
+    ("- Shoes protect your feet.\n• Shoes give grip when walking.\nTherefore, shoes are the answer.", 'natural'),
+    ("I think the best answer is chalk. It writes on boards. A brush paints instead.", 'natural'),
+    ("People work to complete their job. They may also talk to each other! Is that the aim? No.", 'simple'),
+    ("complete job\nlearn from each other\ncomplete job", 'simple'),
+    ("", 'simple'),
+    ("ab", 'natural'),
+]
+
+
+def build_golden_corpus(root: str = "outputs", include_builtin: bool = True) -> List[Dict]:
+    """收集语料并用旧版实现生成期望输出"""
+    samples = list(BUILTIN_SAMPLES) if include_builtin else []
+    samples.extend(iter_reasoning_corpus(root))
+    return [
+        {"prompt_type": prompt_type, "text": text, "steps": extract_cot_steps_legacy(text, prompt_type)}
+        for text, prompt_type in samples
+    ]
+
+
+def check_golden(corpus: List[Dict]) -> List[Dict]:
+    """返回新版输出与期望不一致的条目"""
+    mismatches = []
+    for entry in corpus:
+        steps = extract_cot_steps(entry["text"], entry["prompt_type"])
+        if steps != entry["steps"]:
+            mismatches.append({**entry, "actual": steps})
+    return mismatches
+
+
+def run_benchmark(corpus: List[Dict], repeats: int = 20) -> Dict[str, Dict[str, float]]:
+    """按 prompt 类型统计新旧实现处理单条输出的平均耗时（微秒）"""
+    by_type = defaultdict(list)
+    for entry in corpus:
+        by_type[entry["prompt_type"]].append(entry["text"])
+
+    report = {}
+    for prompt_type in PROMPT_TYPES:
+        texts = by_type.get(prompt_type)
+        if not texts:
+            continue
+        timings = {}
+        for name, fn in (("legacy", extract_cot_steps_legacy), ("current", extract_cot_steps)):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for text in texts:
+                    fn(text, prompt_type)
+            timings[name] = (time.perf_counter() - start) / (repeats * len(texts)) * 1e6
+        timings["outputs"] = len(texts)
+        timings["speedup"] = timings["legacy"] / timings["current"] if timings["current"] else float("inf")
+        report[prompt_type] = timings
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Golden-corpus check and microbenchmark for extract_cot_steps")
+    parser.add_argument("--root", default="outputs", help="Directory containing saved result JSONL files")
+    parser.add_argument("--golden", help="Read the golden corpus from this JSONL file instead of rebuilding it")
+    parser.add_argument("--write-golden", help="Write the rebuilt golden corpus to this JSONL file")
+    parser.add_argument("--repeats", type=int, default=20, help="Benchmark repetitions over the corpus")
+    args = parser.parse_args()
+
+    if args.golden:
+        with open(args.golden, 'r', encoding='utf-8') as f:
+            corpus = [json.loads(line) for line in f if line.strip()]
+    else:
+        corpus = build_golden_corpus(args.root)
+    if args.write_golden:
+        with open(args.write_golden, 'w', encoding='utf-8') as f:
+            for entry in corpus:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    mismatches = check_golden(corpus)
+    print(f"Golden corpus: {len(corpus)} outputs, {len(mismatches)} mismatches")
+    for entry in mismatches[:10]:
+        print(f"[{entry['prompt_type']}] {entry['text'][:80]!r}\n  expected: {entry['steps']}\n  actual:   {entry['actual']}")
+
+    print(f"\n{'Prompt Type':<12} {'Outputs':<8} {'Legacy (us)':<12} {'Current (us)':<13} {'Speedup':<8}")
+    for prompt_type, t in run_benchmark(corpus, args.repeats).items():
+        print(f"{prompt_type:<12} {t['outputs']:<8} {t['legacy']:<12.1f} {t['current']:<13.1f} {t['speedup']:.2f}x")
+
+    raise SystemExit(1 if mismatches else 0)
@@ -0,0 +1,127 @@
+# 批量并行推理链抽取
+# 对大量已保存的模型输出重新抽取步骤（例如修改 natural 的 marker 列表之后），
+# 按块分发到进程池，结果按输入顺序流式返回；附带重写结果文件中 extracted_steps 字段的命令行工具。
+
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from src.cot_extraction.corpus import infer_prompt_type, iter_result_files
+from src.cot_extraction.extractor import extract_cot_steps
+
+
+def _extract_chunk(chunk: List[Tuple[str, str]]) -> List[List[str]]:
+    return [extract_cot_steps(text, prompt_type) for text, prompt_type in chunk]
+
+
+def _chunked(pairs: Iterable[Tuple[str, str]], size: int) -> Iterator[List[Tuple[str, str]]]:
+    it = iter(pairs)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def extract_steps_bulk(
+    pairs: Iterable[Tuple[str, str]],
+    workers: Optional[int] = None,
+    chunk_size: int = 256
+) -> Iterator[List[str]]:
+    """
+    并行抽取推理步骤。
+    参数：
+        pairs: (output_text, prompt_type) 的可迭代对象，可以是惰性生成器
+        workers: 进程数，默认使用 CPU 核数
+        chunk_size: 每个任务包含的输出条数
+    返回：
+        与输入一一对应、按输入顺序产出的步骤列表；同时在途的块数有上限，内存占用不随输入规模增长
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk in _chunked(pairs, chunk_size):
+            yield from _extract_chunk(chunk)
+        return
+
+    max_in_flight = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in _chunked(pairs, chunk_size):
+            pending.append(executor.submit(_extract_chunk, chunk))
+            if len(pending) >= max_in_flight:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _iter_records(path: str) -> Iterator[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def rewrite_result_file(
+    path: str,
+    prompt_type: Optional[str] = None,
+    workers: Optional[int] = None,
+    chunk_size: int = 256,
+    dry_run: bool = False
+) -> Tuple[int, int]:
+    """
+    对结果文件中的 model_reasoning 重新抽取步骤并原地改写 extracted_steps。
+    entailment_info 等 NLI 结果不会重新计算。
+    返回：
+        (记录总数, extracted_steps 发生变化的记录数)
+    """
+    prompt_type = prompt_type or infer_prompt_type(path)
+    if prompt_type is None:
+        raise ValueError(f"Cannot infer prompt type from file name: {path}")
+
+    pairs = ((record.get("model_reasoning") or "", prompt_type) for record in _iter_records(path))
+    steps_iter = extract_steps_bulk(pairs, workers, chunk_size)
+
+    total = changed = 0
+    tmp_path = path + ".tmp"
+    out = None if dry_run else open(tmp_path, 'w', encoding='utf-8')
+    try:
+        for record, steps in zip(_iter_records(path), steps_iter):
+            total += 1
+            if record.get("extracted_steps") != steps:
+                changed += 1
+            record["extracted_steps"] = steps
+            if out is not None:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    finally:
+        if out is not None:
+            out.close()
+    if not dry_run:
+        os.replace(tmp_path, path)
+    return total, changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-extract reasoning steps in saved result files")
+    parser.add_argument("paths", nargs="+", help="Result JSONL files or directories to scan")
+    parser.add_argument("--prompt_type", choices=["simple", "templated", "natural"],
+                        help="Prompt type (default: inferred from each file name)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunk_size", type=int, default=256, help="Outputs per worker task")
+    parser.add_argument("--dry_run", action="store_true", help="Only report how many records would change")
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths:
+        files.extend(iter_result_files(path) if os.path.isdir(path) else [path])
+
+    for path in files:
+        if args.prompt_type is None and infer_prompt_type(path) is None:
+            print(f"Skipping {path}: cannot infer prompt type")
+            continue
+        total, changed = rewrite_result_file(path, args.prompt_type, args.workers, args.chunk_size, args.dry_run)
+        action = "would change" if args.dry_run else "changed"
+        print(f"{path}: {total} records, {changed} {action}")
@@ -0,0 +1,51 @@
+# 推理输出语料工具
+# 遍历 outputs/ 下已保存的结果文件，按文件名推断 prompt 类型，取出 model_reasoning 字段
+
+import json
+import os
+from typing import Iterator, Optional, Tuple
+
+from src.utils.dead_letter import is_dead_letter_file
+
+PROMPT_TYPES = ('simple', 'templated', 'natural')
+
+
+def infer_prompt_type(path: str) -> Optional[str]:
+    """
+    根据结果文件名推断 prompt 类型，
+    例如 csqa_entail_results_mistral_7b_few-shot_natural.jsonl → 'natural'
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    # 前后补分隔符后匹配 "_<type>."，兼容带额外后缀的文件名
+    marked = f"_{stem}."
+    for prompt_type in PROMPT_TYPES:
+        if f"_{prompt_type}." in marked:
+            return prompt_type
+    return None
+
+
+def iter_result_files(root: str = "outputs") -> Iterator[str]:
+    """按路径排序遍历 root 下所有 JSONL 结果文件（跳过死信文件）"""
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith('.jsonl') and not is_dead_letter_file(name):
+                paths.append(os.path.join(dirpath, name))
+    yield from sorted(paths)
+
+
+def iter_reasoning_corpus(root: str = "outputs") -> Iterator[Tuple[str, str]]:
+    """产出 (model_reasoning, prompt_type)，跳过无法推断类型或没有推理文本的记录"""
+    for path in iter_result_files(root):
+        prompt_type = infer_prompt_type(path)
+        if prompt_type is None:
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                text = record.get('model_reasoning')
+                if isinstance(text, str):
+                    yield text, prompt_type
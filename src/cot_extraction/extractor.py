@@ -1,10 +1,45 @@
 # 推理链抽取模块
 # 用于将LLM输出按规则/正则拆分为逐步推理链
-
-# TODO: 实现正则表达式或自定义规则的推理链拆解
+# 所有正则在模块加载时预编译；每种 prompt 类型只产出候选片段，最后统一做一次清理与去重
 
 import re
-from typing import List, Optional
+from typing import Iterable, List, Optional, Set, Tuple
+
+# 预处理：移除可能的答案部分和重复的提取步骤标记
+_TRAILING_LABEL_RE = re.compile(r'\n[A-E]\.?$')
+_EXTRACTED_MARKER_RE = re.compile(r'提取的推理步骤[:：]')
+
+# templated：标准 "Step N:" 段落，以及段内按句号、分号或子弹符号的二次拆分
+_STEP_SEGMENT_RE = re.compile(r'Step\s*\d+:([\s\S]*?)(?=(?:Step\s*\d+:)|\Z)')
+_STEP_SUBSPLIT_RE = re.compile(r'(?<=[\.;])\s+|[\-•]\s*')
+# templated 回退：无编号的 Step / 中文步骤、数字列表、按行分段
+_ALT_STEP_RE = re.compile(r'(?:Step|第.*?步|步骤)\s*:?\s*([^。\n]*[。\n])', re.DOTALL)
+_NUMBER_LIST_RE = re.compile(
+    r'(?:^|\n)\s*(?:\d+\.|\(\d+\))\s*([^\n]*(?:\n(?!\d+\.|\(\d+\))[^\n]*)*)',
+    re.MULTILINE
+)
+_DIGIT_LINE_RE = re.compile(r'^\s*\d+\s*$')
+
+# natural：行首子弹符号规范成 "Also," 标记，再按口语化 marker 拆分
+_BULLET_RE = re.compile(r'^[\-•]\s+', re.MULTILINE)
+NATURAL_MARKERS = [
+    r'First(?:ly)?,?', r'To\s+start\s+with,?', r'Firstly,?',
+    r'Then(?:\s+we)?,?', r'Next,?', r'After\s+that,?',
+    r'Also,?', r'Additionally,?', r'Moreover,?',
+    r'Furthermore,?', r'Therefore,?', r'Finally,?',
+    r'Lastly,?'
+]
+_MARKER_RE = re.compile('(' + '|'.join(NATURAL_MARKERS) + ')', re.IGNORECASE)
+# 按 ". "、"? "、"! "、"; " 之后的大写字母拆分
+_NATURAL_SENTENCE_RE = re.compile(r'(?<=[\.\?!;])\s+(?=[A-Z])')
+_FALLBACK_SENTENCE_RE = re.compile(r'(?<=[\.\?!])\s+(?=[A-Z])')
+
+# simple 或其他格式
+_SIMPLE_SENTENCE_RE = re.compile(r'[.!?]\s+')
+
+# 近似去重：词级 shingle 的精确 Jaccard
+_WORD_RE = re.compile(r'\w+')
+
 
 def clean_step(step: str) -> Optional[str]:
     # 简单清理：去掉多余空白，过滤过短内容
@@ -13,6 +48,89 @@ def clean_step(step: str) -> Optional[str]:
         return None
     return s
 
+
+def _normalize(text: str) -> str:
+    """规范化空白，用作去重的键"""
+    return ' '.join(text.split())
+
+
+def _dedup_steps(candidates: Iterable[str]) -> List[str]:
+    """唯一的一次清理 + 去重：保留首次出现的步骤，过滤过短内容"""
+    valid_steps = []
+    seen_contents = set()
+    for candidate in candidates:
+        cleaned = clean_step(candidate)
+        if not cleaned:
+            continue
+        normalized = _normalize(cleaned)
+        if normalized not in seen_contents:
+            valid_steps.append(cleaned)
+            seen_contents.add(normalized)
+    return valid_steps
+
+
+def _preprocess(output_text: str) -> str:
+    output_text = _TRAILING_LABEL_RE.sub('', output_text)
+    # 移除"提取的推理步骤："等标记后的重复内容
+    match = _EXTRACTED_MARKER_RE.search(output_text)
+    return output_text[:match.start()] if match else output_text
+
+
+def _templated_candidates(text: str) -> List[str]:
+    # 对每个 "Step N:" 段去掉前缀，再拆成更细粒度的子句
+    candidates = []
+    for match in _STEP_SEGMENT_RE.finditer(text):
+        for frag in _STEP_SUBSPLIT_RE.split(match.group(1).strip()):
+            frag = frag.strip()
+            if frag:
+                candidates.append(frag)
+    if candidates:
+        return candidates
+
+    # 没有标准 Step 格式时依次尝试其他结构化标记
+    for pattern in (_ALT_STEP_RE, _NUMBER_LIST_RE):
+        candidates = [c for c in (m.group(1).strip() for m in pattern.finditer(text)) if c]
+        if candidates:
+            return candidates
+
+    # 最后按行分段：移除空行和只包含数字的行，过滤过短的行
+    candidates = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if line and not _DIGIT_LINE_RE.match(line) and len(line) > 5:
+            candidates.append(line)
+    return candidates
+
+
+def _sentence_candidates(text: str, splitter) -> List[str]:
+    candidates = []
+    for s in splitter.split(text):
+        step = s.strip()
+        if len(step) >= 4:
+            candidates.append(step)
+    return candidates
+
+
+def _natural_candidates(text: str) -> List[str]:
+    # 每个 marker 片段从该 marker 开始，到下一个 marker 之前结束，再用宽松句子边界拆细
+    candidates = []
+    starts = [m.start() for m in _MARKER_RE.finditer(text)]
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        candidates.extend(_sentence_candidates(text[start:end].strip(), _NATURAL_SENTENCE_RE))
+    if candidates:
+        return candidates
+    # fallback：按普通句子边界再试一次
+    return _sentence_candidates(text, _FALLBACK_SENTENCE_RE)
+
+
+def _simple_candidates(text: str) -> List[str]:
+    candidates = [s.strip() for s in _SIMPLE_SENTENCE_RE.split(text) if s.strip()]
+    # 如果句子分割效果不好（不同句子不超过一个），追加换行分割的结果
+    if len({_normalize(s) for s in candidates}) <= 1:
+        candidates.extend(line.strip() for line in text.split('\n') if line.strip())
+    return candidates
+
+
 def extract_cot_steps(output_text: str, prompt_type: str) -> List[str]:
     """
     根据不同的prompt类型，从模型输出中提取推理步骤
@@ -22,162 +140,64 @@ def extract_cot_steps(output_text: str, prompt_type: str) -> List[str]:
     返回：
         有效的推理步骤列表
     """
-    steps = []
-    
-    # 预处理：移除可能的答案部分和重复的提取步骤标记
-    output_text = re.sub(r'\n[A-E]\.?$', '', output_text)
-    # 移除"提取的推理步骤："等标记后的重复内容
-    output_text = re.split(r'提取的推理步骤[:：]', output_text)[0]
-    
-    if prompt_type == 'templated':
-        # 使用新的正则表达式提取步骤
-        step_pattern = re.compile(r'(Step\s*\d+:[\s\S]*?)(?=(?:Step\s*\d+:)|\Z)')
-        matches = list(step_pattern.finditer(output_text))
-
-        if matches:
-            seen_contents = set()
-            # 对每个 Step 段做二次拆分
-            for match in matches:
-                raw_seg = match.group(1).strip()
-                # 提取并移除 “Step N:” 前缀
-                step_num_match = re.match(r'Step\s*(\d+):', raw_seg)
-                seg = re.sub(r'^Step\s*\d+:', '', raw_seg).strip()
-
-                # 第二层：按句号、分号或子弹符号拆分成更细粒度的子句
-                sub_frags = re.split(r'(?<=[\.;])\s+|[\-\u2022]\s*', seg)
-                for frag in sub_frags:
-                    frag = frag.strip()
-                    if not frag:
-                        continue
-                    # 规范化去重
-                    normalized = ' '.join(frag.split())
-                    if normalized not in seen_contents:
-                        steps.append(frag)
-                        seen_contents.add(normalized)
-
-        # 如果没有找到标准Step格式，尝试其他结构化标记
-        if not steps:
-            # 尝试匹配其他Step格式（可能没有编号）
-            alt_step_pattern = re.compile(
-                r'(?:Step|第.*?步|步骤)\s*:?\s*([^。\n]*[。\n])',
-                re.DOTALL
-            )
-            matches = alt_step_pattern.finditer(output_text)
-            seen_contents = set()
-            for match in matches:
-                content = match.group(1).strip()
-                normalized_content = ' '.join(content.split())
-                if content and normalized_content not in seen_contents:
-                    steps.append(content)
-                    seen_contents.add(normalized_content)
-            
-            # 如果还是没找到，尝试数字列表格式
-            if not steps:
-                number_list_pattern = re.compile(
-                    r'(?:^|\n)\s*(?:\d+\.|\(\d+\))\s*([^\n]*(?:\n(?!\d+\.|\(\d+\))[^\n]*)*)',
-                    re.MULTILINE
-                )
-                matches = number_list_pattern.finditer(output_text)
-                for match in matches:
-                    content = match.group(1).strip()
-                    normalized_content = ' '.join(content.split())
-                    if content and normalized_content not in seen_contents:
-                        steps.append(content)
-                        seen_contents.add(normalized_content)
-                
-            # 最后尝试匹配缩进或换行分隔的段落
-            if not steps:
-                # 移除空行和只包含数字的行
-                lines = [line.strip() for line in output_text.split('\n')
-                        if line.strip() and not re.match(r'^\s*\d+\s*$', line.strip())]
-                seen_contents = set()
-                for line in lines:
-                    if len(line) > 5:  # 过滤过短的行
-                        normalized_line = ' '.join(line.split())
-                        if normalized_line not in seen_contents:
-                            steps.append(line)
-                            seen_contents.add(normalized_line)
+    output_text = _preprocess(output_text)
 
+    if prompt_type == 'templated':
+        candidates = _templated_candidates(output_text)
     elif prompt_type == 'natural':
-        # 1. 先把行首的 “- ” 或 “• ” 规范成 “Also,” 标记
-        output_text = re.sub(r'^[\-\u2022]\s+', 'Also, ', output_text, flags=re.MULTILINE)
-
-        # 2. 扩展 marker 列表，覆盖更多口语化表达
-        markers = [
-            r'First(?:ly)?,?', r'To\s+start\s+with,?', r'Firstly,?',
-            r'Then(?:\s+we)?,?', r'Next,?', r'After\s+that,?',
-            r'Also,?', r'Additionally,?', r'Moreover,?',
-            r'Furthermore,?', r'Therefore,?', r'Finally,?',
-            r'Lastly,?'
-        ]
-        marker_re = re.compile('(' + '|'.join(markers) + ')', re.IGNORECASE)
-
-        # 3. 第一轮按 marker 拆分
-        parts = marker_re.split(output_text)
-
-        # 4. 对每个 marker 片段，再用宽松句子边界拆细
-        seen_contents = set()
-        for i in range(1, len(parts), 2):
-            fragment = (parts[i] + parts[i + 1]).strip()
-            # 按 “. ”、“? ”、“! ”、”; ” 之后的大写字母拆分
-            sentences = re.split(r'(?<=[\.\?!;])\s+(?=[A-Z])', fragment)
-            for s in sentences:
-                step = s.strip()
-                if len(step) < 4:
-                    continue
-                norm = ' '.join(step.split())
-                if norm not in seen_contents:
-                    steps.append(step)
-                    seen_contents.add(norm)
-
-        # 5. fallback：如果还是没拆出任何步骤，按普通句子边界再试一次
-        if not steps:
-            for s in re.split(r'(?<=[\.\?!])\s+(?=[A-Z])', output_text):
-                step = s.strip()
-                if len(step) < 4:
-                    continue
-                norm = ' '.join(step.split())
-                if norm not in seen_contents:
-                    steps.append(step)
-                    seen_contents.add(norm)
-                
+        output_text = _BULLET_RE.sub('Also, ', output_text)
+        candidates = _natural_candidates(output_text)
     else:  # simple或其他格式
-        # 1. 尝试句子分割
-        sentences = re.split(r'[.!?]\s+', output_text)
-        seen_contents = set()
-        for s in sentences:
-            s = s.strip()
-            normalized_s = ' '.join(s.split())
-            if s and normalized_s not in seen_contents:
-                steps.append(s)
-                seen_contents.add(normalized_s)
-        
-        # 2. 如果句子分割效果不好，尝试换行分割
-        if len(steps) <= 1:
-            lines = [s.strip() for s in output_text.split('\n')]
-            seen_contents = set()
-            for line in lines:
-                normalized_line = ' '.join(line.split())
-                if line and normalized_line not in seen_contents:
-                    steps.append(line)
-                    seen_contents.add(normalized_line)
-    
-    # 清理和验证每个步骤
-    valid_steps = []
-    seen_contents = set()
-    for step in steps:
-        cleaned = clean_step(step)
-        if cleaned:
-            normalized_cleaned = ' '.join(cleaned.split())
-            # 避免重复步骤
-            if normalized_cleaned not in seen_contents:
-                valid_steps.append(cleaned)
-                seen_contents.add(normalized_cleaned)
-    
+        candidates = _simple_candidates(output_text)
+
+    valid_steps = _dedup_steps(candidates)
+
     # 如果没有提取到有效步骤，尝试将整个输出作为一个步骤
     if not valid_steps and output_text.strip():
         cleaned = clean_step(output_text)
         if cleaned:
             valid_steps.append(cleaned)
-    
-    return valid_steps
\ No newline at end of file
+
+    return valid_steps
+
+
+def _shingles(text: str, size: int) -> Set[str]:
+    # 去掉 "Step N:" / marker 之类的差异影响有限，这里只做小写词级 n-gram
+    tokens = _WORD_RE.findall(text.lower())
+    if len(tokens) < size:
+        return {' '.join(tokens)} if tokens else set()
+    return {' '.join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def collapse_near_duplicates(
+    steps: List[str],
+    threshold: float = 0.8,
+    shingle_size: int = 2
+) -> Tuple[List[str], int]:
+    """
+    折叠近似重复的步骤（例如 Step 2 复述 Step 1，或 "Therefore," 句重复所选答案），保留首次出现的步骤。
+    每个步骤与所有已保留的步骤比较精确 Jaccard，Jaccard 大于等于 threshold 的步骤一定会被折叠（不依赖分桶的召回率）；
+    一条输出通常只有十来个步骤，两两比较的开销可以忽略。
+    参数：
+        steps: extract_cot_steps 的输出
+        threshold: 词级 shingle Jaccard 相似度阈值，大于等于该值视为重复
+        shingle_size: shingle 的词数
+    返回：
+        (保留的步骤列表, 被折叠的步骤数 = 节省的逐步 NLI 调用次数)
+    """
+    kept: List[str] = []
+    kept_shingles: List[Set[str]] = []
+    removed = 0
+    for step in steps:
+        shingles = _shingles(step, shingle_size)
+        # 没有词的步骤不参与比较
+        is_duplicate = bool(shingles) and any(
+            len(shingles & other) / len(shingles | other) >= threshold
+            for other in kept_shingles if other
+        )
+        if is_duplicate:
+            removed += 1
+            continue
+        kept.append(step)
+        kept_shingles.append(shingles)
+    return kept, removed
@@ -0,0 +1,111 @@
+# 增量式推理链抽取
+# 在模型流式生成时逐块喂入文本，每遇到 "Step N:" 或 discourse marker（First / Then / Finally …）边界，
+# 就立即产出已经完整的步骤；finish() 之后的全部步骤与 extract_cot_steps 对完整文本的结果完全一致。
+
+from typing import Iterable, Iterator, List
+
+from src.cot_extraction.extractor import (
+    extract_cot_steps,
+    _dedup_steps,
+    _sentence_candidates,
+    _BULLET_RE,
+    _EXTRACTED_MARKER_RE,
+    _MARKER_RE,
+    _NATURAL_SENTENCE_RE,
+    _SIMPLE_SENTENCE_RE,
+    _STEP_SEGMENT_RE,
+    _STEP_SUBSPLIT_RE,
+)
+
+# _TRAILING_LABEL_RE（"\n[A-E]\.?$"，可位于结尾换行之前）最多影响文本末尾 4 个字符
+TRAILING_LABEL_MARGIN = 4
+
+
+class StreamingStepExtractor:
+    """
+    extract_cot_steps 的增量版本。
+    只有位于最后一个已完整出现的边界之前的片段才会被抽取，因此已产出的步骤永远是
+    最终结果的前缀；回退规则（无 Step 标记、无 marker、句子过少等）只在 finish() 时生效。
+    """
+
+    def __init__(self, prompt_type: str):
+        self.prompt_type = prompt_type
+        self.buffer = ""
+        self.steps: List[str] = []
+        self.finished = False
+
+    def feed(self, chunk: str) -> List[str]:
+        """追加一段生成文本，返回新完成的步骤"""
+        if self.finished:
+            raise RuntimeError("StreamingStepExtractor.feed() called after finish()")
+        self.buffer += chunk
+        stable = _dedup_steps(self._stable_candidates())
+        new_steps = stable[len(self.steps):]
+        self.steps.extend(new_steps)
+        return new_steps
+
+    def finish(self) -> List[str]:
+        """生成结束：对完整文本做一次批量抽取，返回尚未产出的剩余步骤"""
+        self.finished = True
+        final_steps = extract_cot_steps(self.buffer, self.prompt_type)
+        new_steps = final_steps[len(self.steps):]
+        self.steps = final_steps
+        return new_steps
+
+    def _stable_text(self) -> str:
+        # "提取的推理步骤：" 之后的内容在批量版本中也会被丢弃
+        match = _EXTRACTED_MARKER_RE.search(self.buffer)
+        return self.buffer[:match.start()] if match else self.buffer
+
+    def _stable_candidates(self) -> List[str]:
+        text = self._stable_text()
+        if self.prompt_type == 'templated':
+            return self._templated_candidates(text)
+        elif self.prompt_type == 'natural':
+            # 结尾的答案标记被删掉后，行首子弹符号可能不再匹配，因此末尾几个字符暂不参与规范化
+            stable = text[:max(len(text) - TRAILING_LABEL_MARGIN, 0)]
+            return self._natural_candidates(_BULLET_RE.sub('Also, ', stable))
+        return self._simple_candidates(text)
+
+    @staticmethod
+    def _templated_candidates(text: str) -> List[str]:
+        # 最后一个 "Step N:" 段可能还在生成，只抽取它之前的段
+        segments = list(_STEP_SEGMENT_RE.finditer(text))[:-1]
+        candidates = []
+        for match in segments:
+            for frag in _STEP_SUBSPLIT_RE.split(match.group(1).strip()):
+                frag = frag.strip()
+                if frag:
+                    candidates.append(frag)
+        return candidates
+
+    @staticmethod
+    def _natural_candidates(text: str) -> List[str]:
+        # 最后一个 marker 之后的片段可能还在生成
+        starts = [m.start() for m in _MARKER_RE.finditer(text)]
+        candidates = []
+        for start, end in zip(starts, starts[1:]):
+            candidates.extend(_sentence_candidates(text[start:end].strip(), _NATURAL_SENTENCE_RE))
+        return candidates
+
+    @staticmethod
+    def _simple_candidates(text: str) -> List[str]:
+        # 只取最后一个完整句子边界之前的句子：分隔符之后要已出现非空白字符，
+        # 且离结尾至少 TRAILING_LABEL_MARGIN 个字符（批量版本会删掉结尾的 "\nA." 之类答案标记）
+        cut = 0
+        for match in _SIMPLE_SENTENCE_RE.finditer(text):
+            if match.end() <= len(text) - TRAILING_LABEL_MARGIN:
+                cut = match.end()
+        candidates = [s.strip() for s in _SIMPLE_SENTENCE_RE.split(text[:cut]) if s.strip()]
+        # 批量版本在不同句子不超过一个时会追加按行拆分的结果，此时无法提前确定
+        if len({' '.join(s.split()) for s in candidates}) <= 1:
+            return []
+        return candidates
+
+
+def iter_stream_steps(chunks: Iterable[str], prompt_type: str) -> Iterator[str]:
+    """消费生成文本块，按完成顺序逐个产出推理步骤"""
+    extractor = StreamingStepExtractor(prompt_type)
+    for chunk in chunks:
+        yield from extractor.feed(chunk)
+    yield from extractor.finish()
@@ -1,8 +1,21 @@
 # src/datasets/loader.py
+import json
 import os
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
 from datasets import load_dataset, load_from_disk
 from src.config import DATA_ROOT
 
+# 主循环实际用到的列：只映射这些列，其余列（如 question_concept、explanation）不会被读入
+CSQA_COLUMNS = ("id", "question", "choices", "answerKey")
+COSE_COLUMNS = ("id", "question", "choices", "answer")
+# 分片策略：contiguous 为连续行区间，strided 为按 shard_count 间隔取行
+SHARD_POLICIES = ("contiguous", "strided")
+
 def _ensure_dir(path: str):
     if not os.path.isdir(path):
         os.makedirs(path, exist_ok=True)
@@ -35,3 +48,154 @@ def load_cose():
     ds = load_dataset("cos_e","v1.11")   # 或者 "cos_e", "2017" 等，根据 Hugging Face Hub 上的版本标签
     ds.save_to_disk(local_path)
     return ds
+
+
+_DOWNLOADERS = {"commonsenseqa": load_commonsenseqa, "cose": load_cose}
+
+
+def _split_arrow_files(name: str, split: str) -> List[str]:
+    """读取 save_to_disk 产生的 state.json，返回该划分的 Arrow 文件列表"""
+    split_dir = os.path.join(DATA_ROOT, name, split)
+    if not os.path.exists(os.path.join(split_dir, "state.json")):
+        # 本地还没有数据时先通过 datasets 下载并保存
+        _DOWNLOADERS[name]()
+    with open(os.path.join(split_dir, "state.json"), "r", encoding="utf-8") as f:
+        state = json.load(f)
+    return [os.path.join(split_dir, data_file["filename"]) for data_file in state["_data_files"]]
+
+
+@lru_cache(maxsize=None)
+def _mapped_split(name: str, split: str) -> pa.Table:
+    # 同一进程内每个划分只映射一次，进程内连续运行多个实验时共享
+    tables = [pa.ipc.open_stream(pa.memory_map(path, "r")).read_all() for path in _split_arrow_files(name, split)]
+    return pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+
+
+def load_split_table(name: str, split: str, columns: Optional[Sequence[str]] = None) -> pa.Table:
+    """
+    以内存映射方式打开 data/<name>/<split> 下的 Arrow 文件，只保留需要的列。
+    返回的 Table 直接引用映射的页面，不复制数据，也不经过 datasets 的格式化层。
+    参数：
+        name: 数据集目录名，'commonsenseqa' 或 'cose'
+        split: 数据划分，如 'validation'
+        columns: 需要的列，None 表示全部
+    """
+    table = _mapped_split(name, split)
+    return table.select(list(columns)) if columns else table
+
+
+class RecordView(Mapping):
+    """列式批次中一行的只读视图，按列名取值；与 datasets 的行字典结构一致，可直接传给 prompt 构建函数"""
+
+    __slots__ = ("_columns", "_row")
+
+    def __init__(self, columns: Dict[str, list], row: int):
+        self._columns = columns
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._columns[key][self._row]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+
+class ColumnBatch:
+    """
+    一个 RecordBatch 的列式包装：每列整体转换一次 Python 列表，行通过 RecordView 访问。
+    额外提供两列：
+        row_idx: 样本在划分中的行号
+        choice_map: CSQA 的 {label: text} 选项字典（choices 为 struct 列时才有）
+    """
+
+    def __init__(self, batch: pa.RecordBatch, row_indices: List[int]):
+        self.arrow = batch
+        self.columns: Dict[str, list] = {
+            name: batch.column(i).to_pylist() for i, name in enumerate(batch.schema.names)
+        }
+        self.columns["row_idx"] = row_indices
+        if "choices" in batch.schema.names and pa.types.is_struct(batch.schema.field("choices").type):
+            choices = batch.column(batch.schema.get_field_index("choices"))
+            self.columns["choice_map"] = [
+                dict(zip(labels, texts))
+                for labels, texts in zip(choices.field("label").to_pylist(), choices.field("text").to_pylist())
+            ]
+
+    def __len__(self):
+        return self.arrow.num_rows
+
+    def __iter__(self) -> Iterator[RecordView]:
+        for row in range(self.arrow.num_rows):
+            yield RecordView(self.columns, row)
+
+
+def shard_row_indices(num_rows: int, shard_index: int = 0, shard_count: int = 1,
+                      policy: str = "contiguous") -> range:
+    """
+    返回第 shard_index 个分片（共 shard_count 个）负责的行号，只依赖这三个参数，各节点无需协调即可各取一份。
+    contiguous：把 [0, num_rows) 均分为连续区间；strided：取 shard_index, shard_index + shard_count, ...
+    """
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard {shard_index} of {shard_count}")
+    if policy == "contiguous":
+        return range(num_rows * shard_index // shard_count, num_rows * (shard_index + 1) // shard_count)
+    if policy == "strided":
+        return range(shard_index, num_rows, shard_count)
+    raise ValueError(f"Unknown shard policy: {policy}, must be one of {SHARD_POLICIES}")
+
+
+def shard_size(num_rows: int, shard_index: int = 0, shard_count: int = 1, policy: str = "contiguous") -> int:
+    return len(shard_row_indices(num_rows, shard_index, shard_count, policy))
+
+
+def iter_split_batches(
+    name: str,
+    split: str,
+    columns: Optional[Sequence[str]] = None,
+    limit: Optional[int] = None,
+    batch_size: int = 64,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    shard_policy: str = "contiguous",
+    shuffle_seed: Optional[int] = None
+) -> Iterator[ColumnBatch]:
+    """
+    按批次遍历某个划分的前 limit 行（None 表示全部）中属于当前分片的行，每批只转换所需的列。
+    row_idx 始终是样本在整个划分中的行号，便于合并分片结果。
+    shuffle_seed 不为 None 时按该种子打乱分片内的顺序（自适应采样用，同一种子顺序固定，可续跑）。
+    """
+    table = load_split_table(name, split, columns)
+    if limit is not None:
+        table = table.slice(0, limit)
+    rows = shard_row_indices(table.num_rows, shard_index, shard_count, shard_policy)
+    if shard_count > 1:
+        # 连续分片直接切片（零拷贝）；间隔分片只对已裁剪的列做一次 take
+        table = table.slice(rows.start, len(rows)) if rows.step == 1 else table.take(pa.array(rows))
+    if shuffle_seed is not None:
+        order = np.random.default_rng(shuffle_seed).permutation(len(rows))
+        table = table.take(pa.array(order))
+        rows = [rows[i] for i in order.tolist()]
+    offset = 0
+    for batch in table.to_batches(max_chunksize=batch_size):
+        yield ColumnBatch(batch, list(rows[offset:offset + batch.num_rows]))
+        offset += batch.num_rows
+
+
+def iter_split_records(
+    name: str,
+    split: str,
+    columns: Optional[Sequence[str]] = None,
+    limit: Optional[int] = None,
+    batch_size: int = 64,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    shard_policy: str = "contiguous",
+    shuffle_seed: Optional[int] = None
+) -> Iterator[RecordView]:
+    """iter_split_batches 的逐行版本，可直接替换 val_data.select(range(n)) 的遍历"""
+    for batch in iter_split_batches(name, split, columns, limit, batch_size,
+                                    shard_index, shard_count, shard_policy, shuffle_seed):
+        yield from batch
@@ -0,0 +1,239 @@
+# analytics.py
+# 跨运行分析：把 outputs/ 下全部结果文件载入一张 Arrow 列式表（每个样本一行），
+# 用 Arrow 的分组聚合与 NumPy 向量运算计算各 (数据集, shot, 模型, prompt 类型) 的指标、
+# 按步骤位置的蕴含分数、NLI 标签分布以及答案正确性与蕴含率的相关性；步骤级表由嵌套列展开，不逐行循环。
+import argparse
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from src.utils.result_io import iter_result_records
+from src.utils.result_parquet import RESULT_SCHEMA, parse_result_name, parquet_path, _record_row
+from src.utils.shards import _SHARD_SUFFIX_RE
+
+RUN_KEYS = ("dataset", "shot", "model", "prompt_type")
+NLI_LABELS = ("ENTAILMENT", "NEUTRAL", "CONTRADICTION")
+
+# 分析用到的列；其余列（问题、推理文本等）不读取
+ANALYTICS_COLUMNS = list(RUN_KEYS) + [
+    "id", "correct", "entailment_ratio", "chain_ratio", "contrastive_ratio", "coherence",
+    "question_consistency", "valid_steps", "step_scores", "step_labels",
+]
+
+
+def find_result_files(root: str = "outputs", include_replay: bool = False) -> List[str]:
+    """
+    返回 root 下每个结果的一个文件：优先使用不比 JSONL 旧的 Parquet 副本；
+    已合并的分片只取合并后的文件，默认跳过 outputs/replay 下的重放结果
+    """
+    replay_root = os.path.join(os.path.abspath(root), "replay") + os.sep
+    candidates = set()
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith((".jsonl", ".parquet")) and parse_result_name(name) is not None:
+                candidates.add(os.path.join(dirpath, name[:name.rindex(".")] + ".jsonl"))
+
+    files = []
+    for path in sorted(candidates):
+        if not include_replay and os.path.abspath(path).startswith(replay_root):
+            continue
+        match = _SHARD_SUFFIX_RE.search(path)
+        if match and any(os.path.exists(path[:match.start()] + ext) for ext in (".jsonl", ".parquet")):
+            continue
+        pq_file = parquet_path(path)
+        if os.path.exists(pq_file) and (not os.path.exists(path) or os.path.getmtime(pq_file) >= os.path.getmtime(path)):
+            files.append(pq_file)
+        else:
+            files.append(path)
+    return files
+
+
+def _load_file(path: str, columns: Sequence[str], chunk_size: int = 4096) -> pa.Table:
+    if path.endswith(".parquet"):
+        return pq.read_table(path, columns=list(columns), schema=RESULT_SCHEMA)
+    # 没有 Parquet 副本的 JSONL：按块展开成同一 schema，只保留需要的列
+    meta = parse_result_name(path)
+    schema = pa.schema([RESULT_SCHEMA.field(name) for name in columns])
+    batches, rows = [], []
+    for record in iter_result_records(path):
+        rows.append(_record_row(record, meta))
+        if len(rows) == chunk_size:
+            batches.append(pa.RecordBatch.from_pylist(rows, schema=schema))
+            rows = []
+    if rows:
+        batches.append(pa.RecordBatch.from_pylist(rows, schema=schema))
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+def load_results_table(
+    root: str = "outputs",
+    columns: Sequence[str] = ANALYTICS_COLUMNS,
+    include_replay: bool = False
+) -> pa.Table:
+    """把 root 下全部结果载入一张表（每个样本一行），步骤分数与标签为嵌套 list 列"""
+    tables = [_load_file(path, columns) for path in find_result_files(root, include_replay)]
+    if not tables:
+        return pa.schema([RESULT_SCHEMA.field(name) for name in columns]).empty_table()
+    return pa.concat_tables(tables).unify_dictionaries()
+
+
+def explode_steps(table: pa.Table, max_position: int = 10) -> pa.Table:
+    """
+    展开为步骤级表（每个步骤一行）：运行键、correct、position（从 0 开始，>= max_position 的合并为 max_position）、
+    score、label、is_entail。chain 模式的记录没有逐步分数，不产生步骤行
+    """
+    scores = table["step_scores"].combine_chunks()
+    labels = table["step_labels"].combine_chunks()
+    parents = pc.list_parent_indices(scores)
+    offsets = scores.offsets.to_numpy()
+    # 步骤在所属记录中的位置 = 扁平下标 - 该记录在扁平数组中的起点
+    flat_index = np.arange(len(parents)) + offsets[0]
+    position = np.minimum(flat_index - offsets[parents.to_numpy()], max_position)
+
+    flat_labels = pc.list_flatten(labels)
+    steps = table.select(list(RUN_KEYS) + ["correct"]).take(parents)
+    return (steps
+            .append_column("position", pa.array(position, pa.int32()))
+            .append_column("score", pc.list_flatten(scores))
+            .append_column("label", flat_labels)
+            .append_column("is_entail", pc.equal(flat_labels.cast(pa.string()), "ENTAILMENT")))
+
+
+def _decode(table: pa.Table) -> pa.Table:
+    """把字典编码的列解码为普通列（Arrow 不支持按字典列排序，CSV 也不支持字典类型）"""
+    columns = [pc.cast(col, col.type.value_type) if pa.types.is_dictionary(col.type) else col for col in table.columns]
+    return pa.table(columns, names=table.column_names)
+
+
+def _sorted(grouped: pa.Table, keys: Sequence[str]) -> pa.Table:
+    """聚合结果每组一行，解码后按分组键排序"""
+    return _decode(grouped).sort_by([(key, "ascending") for key in keys])
+
+
+def run_metrics(table: pa.Table, keys: Sequence[str] = RUN_KEYS) -> pa.Table:
+    """
+    按 keys 分组的样本级指标：样本数、准确率、各类平均比例，
+    以及答案正确 / 错误时的平均蕴含率和二者的相关系数（点二列相关），均由一次分组聚合得到的矩计算
+    """
+    keys = list(keys)
+    # 相关性只在有蕴含率的样本上计算：没有蕴含率的样本 x 记为 null，聚合时自动跳过
+    y = pc.cast(table["entailment_ratio"], pa.float64())
+    x = pc.if_else(pc.is_valid(y), pc.cast(table["correct"], pa.float64()), None)
+    metrics = [
+        ("id", "count"), ("correct", "mean"), ("entailment_ratio", "mean"), ("chain_ratio", "mean"),
+        ("contrastive_ratio", "mean"), ("coherence", "mean"), ("question_consistency", "mean"), ("valid_steps", "mean"),
+    ]
+    grouped = table.select(keys + sorted({name for name, _ in metrics})).append_column("x", x) \
+        .append_column("y", y).append_column("xy", pc.multiply(x, y)) \
+        .append_column("xx", pc.multiply(x, x)).append_column("yy", pc.multiply(y, y)) \
+        .group_by(keys).aggregate(metrics + [("x", "count")] + [(c, "sum") for c in ("x", "y", "xy", "xx", "yy")])
+    grouped = _sorted(grouped, keys)
+
+    n, sx, sy, sxy, sxx, syy = (grouped[c].to_numpy(zero_copy_only=False).astype(np.float64)
+                                for c in ("x_count", "x_sum", "y_sum", "xy_sum", "xx_sum", "yy_sum"))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio_correct = sxy / sx
+        ratio_incorrect = (sy - sxy) / (n - sx)
+        cov = sxy / n - (sx / n) * (sy / n)
+        corr = cov / np.sqrt((sxx / n - (sx / n) ** 2) * (syy / n - (sy / n) ** 2))
+
+    names = keys + ["sample_size", "accuracy", "entailment_ratio", "chain_entailment", "contrastive_ratio",
+                    "coherence", "question_consistency", "mean_steps"]
+    result = grouped.select(keys + [f"{name}_{agg}" for name, agg in metrics]).rename_columns(names)
+    for name, values in (("ratio_correct", ratio_correct), ("ratio_incorrect", ratio_incorrect),
+                         ("accuracy_ratio_corr", corr)):
+        result = result.append_column(name, pa.array(np.where(np.isfinite(values), values, np.nan), from_pandas=True))
+    return result
+
+
+def step_position_metrics(steps: pa.Table, keys: Sequence[str] = RUN_KEYS) -> pa.Table:
+    """按步骤位置（以及答案正误）的平均蕴含分数与蕴含步骤比例"""
+    keys = list(keys) + ["correct", "position"]
+    grouped = steps.group_by(keys).aggregate([("score", "count"), ("score", "mean"), ("is_entail", "mean")])
+    grouped = grouped.select(keys + ["score_count", "score_mean", "is_entail_mean"])
+    return _sorted(grouped.rename_columns(keys + ["steps", "mean_score", "entail_share"]), keys)
+
+
+def label_distribution(steps: pa.Table, keys: Sequence[str] = RUN_KEYS) -> pa.Table:
+    """各组步骤的 NLI 标签分布（每个标签一列，值为占比）"""
+    keys = list(keys)
+    label = steps["label"].cast(pa.string())
+    indicators = {f"{name.lower()}_share": pc.cast(pc.equal(label, name), pa.float64()) for name in NLI_LABELS}
+    grouped = pa.table({**{key: steps[key] for key in keys}, "score": steps["score"], **indicators}) \
+        .group_by(keys).aggregate([("score", "count")] + [(name, "mean") for name in indicators])
+    grouped = grouped.select(keys + ["score_count"] + [f"{name}_mean" for name in indicators])
+    return _sorted(grouped.rename_columns(keys + ["steps"] + list(indicators)), keys)
+
+
+def run_level_correlation(metrics: pa.Table) -> Optional[float]:
+    """各运行的准确率与平均蕴含率之间的 Pearson 相关系数（运行数少于 3 时返回 None）"""
+    acc = metrics["accuracy"].to_numpy(zero_copy_only=False).astype(np.float64)
+    ratio = metrics["entailment_ratio"].to_numpy(zero_copy_only=False).astype(np.float64)
+    mask = ~(np.isnan(acc) | np.isnan(ratio))
+    if mask.sum() < 3 or np.std(acc[mask]) == 0 or np.std(ratio[mask]) == 0:
+        return None
+    return float(np.corrcoef(acc[mask], ratio[mask])[0, 1])
+
+
+def _print_table(title: str, table: pa.Table, max_rows: int = 50):
+    print("\n" + "="*80)
+    print(title)
+    print("="*80)
+    names = table.column_names
+    print("  ".join(f"{name:>14}" for name in names))
+    for row in table.slice(0, max_rows).to_pylist():
+        cells = []
+        for name in names:
+            value = row[name]
+            if isinstance(value, float):
+                cells.append(f"{value:>14.4f}")
+            else:
+                cells.append(f"{str(value):>14}")
+        print("  ".join(cells))
+    if table.num_rows > max_rows:
+        print(f"... {table.num_rows - max_rows} more rows")
+
+
+def _write_csv(table: pa.Table, path: str):
+    pacsv.write_csv(_decode(table), path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grouped cross-run metrics over every result file under outputs/")
+    parser.add_argument("--root", default="outputs", help="Directory to scan for result files")
+    parser.add_argument("--group_by", nargs="+", choices=list(RUN_KEYS), default=list(RUN_KEYS),
+                        help="Columns to group runs by (e.g. --group_by model prompt_type)")
+    parser.add_argument("--max_position", type=int, default=10,
+                        help="Step positions at or beyond this value are reported together")
+    parser.add_argument("--include_replay", action="store_true", help="Also load outputs/replay")
+    parser.add_argument("--output_dir", default=None, help="Write the tables as CSV files to this directory")
+    args = parser.parse_args()
+
+    table = load_results_table(args.root, include_replay=args.include_replay)
+    if table.num_rows == 0:
+        raise SystemExit(f"No result files found under {args.root}")
+    steps = explode_steps(table, args.max_position)
+    print(f"Loaded {table.num_rows} samples and {steps.num_rows} scored steps from {args.root}")
+
+    tables: Dict[str, pa.Table] = {
+        "run_metrics": run_metrics(table, args.group_by),
+        "step_positions": step_position_metrics(steps, args.group_by),
+        "label_distribution": label_distribution(steps, args.group_by),
+    }
+    _print_table("Grouped metrics", tables["run_metrics"])
+    _print_table("Entailment by step position", tables["step_positions"])
+    _print_table("NLI label distribution", tables["label_distribution"])
+    corr = run_level_correlation(tables["run_metrics"])
+    if corr is not None:
+        print(f"\nAccuracy vs entailment ratio across groups (Pearson r): {corr:.3f}")
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for name, result in tables.items():
+            _write_csv(result, os.path.join(args.output_dir, f"{name}.csv"))
+        print(f"\nTables written to {args.output_dir}")
@@ -0,0 +1,129 @@
+# coherence.py
+# 推理链连贯性评估模块：相邻步骤之间、每个步骤与问题之间的 NLI 一致性
+from typing import List, Dict, Any, Tuple
+from src.utils.nli_client import get_nli_client
+from src.evaluation.entailment import _clean_step_text, _premise_for_nli
+
+# 概率向量下标：0→ENTAILMENT, 1→NEUTRAL, 2→CONTRADICTION
+ENTAIL_IDX = 0
+CONTRADICTION_IDX = 2
+
+
+def _empty_coherence() -> Dict[str, Any]:
+    return {
+        "consecutive_entail": [],
+        "consecutive_contradiction": [],
+        "question_contradiction": [],
+        "coherence": None,
+        "question_consistency": None
+    }
+
+
+def compute_coherence_batch(
+    samples: List[Tuple[List[str], str]],
+    nli_client=None,
+    batch_size: int = 32
+) -> List[Dict[str, Any]]:
+    """
+    批量计算一组样本的推理链连贯性。所有样本的全部 NLI 对放进同一次按长度分桶的前向计算。
+    参数：
+        samples: (steps, question) 列表
+        nli_client: NLI 客户端实例（可选）
+        batch_size: 每个前向批次的大小
+    返回：
+        与 samples 一一对应的字典列表：
+        - consecutive_entail: 第 i 步 → 第 i+1 步的 ENTAILMENT 概率
+        - consecutive_contradiction: 第 i 步 → 第 i+1 步的 CONTRADICTION 概率
+        - question_contradiction: 问题 → 每个步骤的 CONTRADICTION 概率
+        - coherence: 相邻步骤之间 1 - CONTRADICTION 概率的平均值（少于两个步骤时为 None）
+        - question_consistency: 问题与步骤之间 1 - CONTRADICTION 概率的平均值（无步骤时为 None）
+    """
+    if nli_client is None:
+        nli_client = get_nli_client()
+
+    premises: List[str] = []
+    hypotheses: List[str] = []
+    # 记录每个样本的 pair 在扁平列表中的区间
+    spans = []
+    for steps, question in samples:
+        start = len(premises)
+        for prev_step, next_step in zip(steps, steps[1:]):
+            premises.append(_premise_for_nli(prev_step))
+            hypotheses.append(_clean_step_text(next_step))
+        mid = len(premises)
+        for step in steps:
+            premises.append(f"The question is: {question}")
+            hypotheses.append(_clean_step_text(step))
+        spans.append((start, mid, len(premises)))
+
+    probs = nli_client.predict_proba(premises, hypotheses, batch_size=batch_size,
+                                     bucket_by_length=True) if premises else []
+
+    results = []
+    for start, mid, end in spans:
+        if start == end:
+            results.append(_empty_coherence())
+            continue
+        consecutive = probs[start:mid]
+        question = probs[mid:end]
+        consecutive_contra = [p[CONTRADICTION_IDX] for p in consecutive]
+        question_contra = [p[CONTRADICTION_IDX] for p in question]
+        results.append({
+            "consecutive_entail": [p[ENTAIL_IDX] for p in consecutive],
+            "consecutive_contradiction": consecutive_contra,
+            "question_contradiction": question_contra,
+            "coherence": (sum(1 - c for c in consecutive_contra) / len(consecutive_contra)
+                          if consecutive_contra else None),
+            "question_consistency": sum(1 - c for c in question_contra) / len(question_contra)
+        })
+    return results
+
+
+def compute_coherence(steps: List[str], question: str, nli_client=None) -> Dict[str, Any]:
+    """单个样本的连贯性评估，compute_coherence_batch 的便捷封装"""
+    return compute_coherence_batch([(steps, question)], nli_client)[0]
+
+
+class CoherenceBatcher:
+    """
+    在主评估循环中累积结果记录，每满 flush_every 条就对这一批样本做一次连贯性打分，
+    并把结果写回记录的 "coherence_info" 字段，同时维护全局平均值。
+    add / flush 返回本次打完分的记录，调用方可以在此时才把它们写入结果文件。
+    """
+
+    def __init__(self, nli_client=None, flush_every: int = 16):
+        self.nli_client = nli_client
+        self.flush_every = flush_every
+        self.pending: List[Dict[str, Any]] = []
+        self.total_coherence = 0.0
+        self.coherence_count = 0
+        self.total_question = 0.0
+        self.question_count = 0
+
+    def add(self, record: Dict[str, Any]) -> List[Dict[str, Any]]:
+        self.pending.append(record)
+        if len(self.pending) >= self.flush_every:
+            return self.flush()
+        return []
+
+    def flush(self) -> List[Dict[str, Any]]:
+        if not self.pending:
+            return []
+        samples = [(r["extracted_steps"], r["question"]) for r in self.pending]
+        for record, info in zip(self.pending, compute_coherence_batch(samples, self.nli_client)):
+            record["coherence_info"] = info
+            if info["coherence"] is not None:
+                self.total_coherence += info["coherence"]
+                self.coherence_count += 1
+            if info["question_consistency"] is not None:
+                self.total_question += info["question_consistency"]
+                self.question_count += 1
+        flushed, self.pending = self.pending, []
+        return flushed
+
+    def averages(self) -> Dict[str, Any]:
+        """返回所有已打分样本的平均连贯性（未刷新的记录需先调用 flush）"""
+        return {
+            "coherence": self.total_coherence / self.coherence_count if self.coherence_count else None,
+            "question_consistency": self.total_question / self.question_count if self.question_count else None
+        }
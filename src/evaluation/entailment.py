@@ -1,89 +1,318 @@
 # entailment.py
 # 逻辑蕴含率评估模块 - 使用软阈值分类
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 from src.utils.nli_client import get_nli_client
+import base64
 import re
-# 软阈值设置：大于等于此值判为 ENTAILMENT，小于等于此值判为 CONTRADICTION
-ENTAILMENT_THRESHOLD = 0.5
-CONTRADICTION_THRESHOLD = 0.2
+import numpy as np
+# 软阈值、假设句模板等打分参数定义在 config 中（实验 DAG 据此判断 NLI 分数是否失效，无需加载 torch）
+from src.config import ENTAILMENT_THRESHOLD, CONTRADICTION_THRESHOLD, CHAIN_PREMISE_PREFIX, HYPOTHESIS_TEMPLATE
+# 评估模式：step 逐步打分；chain 整条推理链作为一个前提打分；both 两者都计算
+ENTAIL_MODES = ("step", "chain", "both")
+# 概率向量下标：0→ENTAILMENT, 1→NEUTRAL, 2→CONTRADICTION
+ENTAIL_IDX = 0
 
 
-def compute_entailment_ratio(
+def _clean_step_text(step: str) -> str:
+    """对 step 做轻量补全，去掉多余前缀"""
+    cleaned = step.strip()
+    # 如果以 "(X)" 或 "and " 等开头，可以去掉这些标记
+    cleaned = re.sub(r'^\([A-E]\)\s*', '', cleaned, flags=re.IGNORECASE)
+    cleaned = re.sub(r'^[Aa]nd\s+', '', cleaned)
+    return cleaned
+
+
+def _premise_for_nli(step: str) -> str:
+    """给 NLI 一个完整的前提句，让模型更好理解"""
+    return f"This step says: {_clean_step_text(step)}."
+
+
+def _label_from_prob(prob: float,
+                     entail_threshold: float = ENTAILMENT_THRESHOLD,
+                     contradiction_threshold: float = CONTRADICTION_THRESHOLD) -> str:
+    """根据软阈值把 ENTAILMENT 概率映射为标签"""
+    if prob >= entail_threshold:
+        return "ENTAILMENT"
+    elif prob <= contradiction_threshold:
+        return "CONTRADICTION"
+    return "ENTAILMENT"
+
+
+def build_hypothesis(answer: str, template: str = HYPOTHESIS_TEMPLATE) -> str:
+    """由答案文本构造 NLI 假设句"""
+    return template.format(answer=answer)
+
+
+def _empty_chain() -> Dict[str, Any]:
+    # 没有步骤时链级概率记 0，标签与软阈值对 0 的判定一致
+    return {
+        "chain_score": 0.0,
+        "chain_label": _label_from_prob(0.0),
+        "chain_ratio": 0.0,
+        "chain_windows": 0
+    }
+
+
+def _chain_premises(steps: List[str], hypothesis: str, nli_client) -> List[str]:
+    """把清理后的所有步骤拼接成前提；超过 512 token 时按窗口切分"""
+    cleaned = [f"{_clean_step_text(step).rstrip('.')}." for step in steps]
+    return nli_client.window_premises(cleaned, hypothesis, prefix=CHAIN_PREMISE_PREFIX)
+
+
+def _chain_info(scores: List[float], label_fn) -> Dict[str, Any]:
+    chain_score = max(scores)
+    chain_label = label_fn(chain_score)
+    return {
+        "chain_score": chain_score,
+        "chain_label": chain_label,
+        "chain_ratio": 1.0 if chain_label == "ENTAILMENT" else 0.0,
+        "chain_windows": len(scores)
+    }
+
+
+def compute_chain_entailment(
     steps: List[str],
     answer: str,
     nli_client=None
 ) -> Dict[str, Any]:
+    """
+    链级蕴含评估：把清理后的所有步骤拼接成一个前提，与答案假设句做一次 NLI。
+    拼接结果超过 512 token 时按窗口切分，所有窗口在同一次批量调用中打分，取最大概率。
+    返回：
+        - chain_score: 整条推理链的 ENTAILMENT 概率
+        - chain_label: 按软阈值得到的标签
+        - chain_ratio: 链级判定为 ENTAILMENT 记 1.0，否则 0.0
+        - chain_windows: 实际使用的窗口数
+    """
+    if not steps:
+        return _empty_chain()
+
+    hypothesis = build_hypothesis(answer)
+    if nli_client is None:
+        nli_client = get_nli_client()
+
+    windows = _chain_premises(steps, hypothesis, nli_client)
+    scores = nli_client.entailment_scores(windows, [hypothesis] * len(windows))
+    return _chain_info(scores, _label_from_prob)
+
+
+def compute_entailment_ratio_batch(
+    samples: List[Tuple[List[str], str]],
+    nli_client=None,
+    mode: str = "both",
+    hypothesis_template: str = HYPOTHESIS_TEMPLATE,
+    entail_threshold: float = ENTAILMENT_THRESHOLD,
+    contradiction_threshold: float = CONTRADICTION_THRESHOLD,
+    batch_size: int = 32,
+    return_probs: bool = False
+):
+    """
+    批量计算一组样本的逻辑蕴含比例。所有样本的逐步 NLI 对与链级窗口放进同一次按长度分桶的前向计算。
+    参数：
+        samples: (steps, answer) 列表
+        nli_client: NLI 客户端实例（可选）
+        mode: 'step'、'chain' 或 'both'，含义同 compute_entailment_ratio
+        hypothesis_template: 假设句模板，{answer} 处填入答案文本
+        entail_threshold / contradiction_threshold: 软阈值
+        batch_size: 每个前向批次的大小
+        return_probs: 是否同时返回原始三分类概率（供 ProbabilitySidecar 保存）
+    返回：
+        与 samples 一一对应、格式与 compute_entailment_ratio 相同的字典列表；
+        return_probs=True 时返回 (字典列表, 概率列表)，概率列表每项为
+        (步骤概率 (步骤数, 3) 数组, 得分最高的链级窗口的概率 (3,) 数组或 None)
+    """
+    if mode not in ENTAIL_MODES:
+        raise ValueError(f"Unknown entailment mode: {mode}, must be one of {ENTAIL_MODES}")
+    if nli_client is None:
+        nli_client = get_nli_client()
+
+    def label_fn(prob):
+        return _label_from_prob(prob, entail_threshold, contradiction_threshold)
+
+    premises: List[str] = []
+    hypotheses: List[str] = []
+    # 记录每个样本的逐步对与链级窗口在扁平列表中的区间
+    spans = []
+    for steps, answer in samples:
+        hypothesis = build_hypothesis(answer, hypothesis_template)
+        start = len(premises)
+        if steps and mode != "chain":
+            premises.extend(_premise_for_nli(step) for step in steps)
+        mid = len(premises)
+        if steps and mode != "step":
+            premises.extend(_chain_premises(steps, hypothesis, nli_client))
+        hypotheses.extend([hypothesis] * (len(premises) - start))
+        spans.append((hypothesis, start, mid, len(premises)))
+
+    probs = np.asarray(nli_client.predict_proba(premises, hypotheses, batch_size=batch_size,
+                                                bucket_by_length=True) if premises else [],
+                       dtype=np.float64).reshape(-1, 3)
+    scores = probs[:, ENTAIL_IDX].tolist()
+
+    results = []
+    raw_probs = []
+    for (steps, _), (hypothesis, start, mid, end) in zip(samples, spans):
+        chain_probs = probs[mid + int(np.argmax(probs[mid:end, ENTAIL_IDX]))] if end > mid else None
+        raw_probs.append((probs[start:mid], chain_probs))
+        # 若无步骤，直接返回
+        if not steps:
+            result = {
+                "ratio": None if mode == "chain" else 0.0,
+                "step_details": [],
+                "valid_steps": 0,
+                "entail_steps": 0,
+                "hypothesis": "",
+                "mode": mode
+            }
+            if mode != "step":
+                result.update(_empty_chain())
+            results.append(result)
+            continue
+
+        chain_info = _chain_info(scores[mid:end], label_fn) if mode != "step" else {}
+        if mode == "chain":
+            # 逐步比例没有计算：ratio 记 None（汇总时跳过），链级结果见 chain_ratio
+            results.append({
+                "ratio": None,
+                "step_details": [],
+                "valid_steps": len(steps),
+                "entail_steps": None,
+                "hypothesis": hypothesis,
+                "mode": mode,
+                **chain_info
+            })
+            continue
+
+        # 基于阈值分类
+        step_details = []
+        entail_count = 0
+        for step, prob in zip(steps, scores[start:mid]):
+            label = label_fn(prob)
+            is_entail = (label == "ENTAILMENT")
+            if is_entail:
+                entail_count += 1
+            step_details.append({
+                "step_text": step,
+                "score": prob,
+                "label": label,
+                "is_entail": is_entail
+            })
+
+        results.append({
+            "ratio": entail_count / len(steps),
+            "step_details": step_details,
+            "valid_steps": len(steps),
+            "entail_steps": entail_count,
+            "hypothesis": hypothesis,
+            "mode": mode,
+            **chain_info
+        })
+    return (results, raw_probs) if return_probs else results
+
+
+def compute_entailment_ratio(
+    steps: List[str],
+    answer: str,
+    nli_client=None,
+    mode: str = "both",
+    return_probs: bool = False
+):
     """
     计算推理步骤与最终答案的逻辑蕴含比例，采用软阈值分类。
     参数：
         steps: 推理步骤列表
         answer: 标准或模型选的答案文本
         nli_client: NLI 客户端实例（可选）
+        mode: 'step' 逐步打分；'chain' 只做链级打分（每个样本一次 NLI 调用）；'both' 两者都计算
+        return_probs: 为 True 时返回 (评估信息, 原始概率)，见 compute_entailment_ratio_batch
     返回：
         包含评估信息的字典：
-        - ratio: ENTAILMENT 步骤比例
-        - step_details: 每步的分数、标签和 is_entail 标记
+        - ratio: ENTAILMENT 步骤比例（chain 模式下不计算，为 None；链级结果见 chain_ratio）
+        - step_details: 每步的分数、标签和 is_entail 标记（chain 模式下为空）
         - valid_steps: 有效步骤总数
-        - entail_steps: 判定为 ENTAILMENT 的步骤数
+        - entail_steps: 判定为 ENTAILMENT 的步骤数（chain 模式下为 None）
         - hypothesis: 用于 NLI 的假设文本
+        - mode: 使用的评估模式
+        - chain_score / chain_label / chain_ratio / chain_windows: 链级结果（'chain' 与 'both' 模式）
     """
-    # 若无步骤，直接返回
-    if not steps:
+    if return_probs:
+        results, raw_probs = compute_entailment_ratio_batch([(steps, answer)], nli_client, mode, return_probs=True)
+        return results[0], raw_probs[0]
+    return compute_entailment_ratio_batch([(steps, answer)], nli_client, mode)[0]
+
+
+def encode_float16_matrix(matrix: np.ndarray) -> Dict[str, Any]:
+    """把概率矩阵压缩为 float16 并编码成可写入 JSON 的字典"""
+    arr = np.ascontiguousarray(matrix, dtype=np.float16)
+    return {
+        "shape": list(arr.shape),
+        "dtype": "float16",
+        "data": base64.b64encode(arr.tobytes()).decode("ascii")
+    }
+
+
+def decode_float16_matrix(encoded: Dict[str, Any]) -> np.ndarray:
+    """encode_float16_matrix 的逆操作"""
+    buf = base64.b64decode(encoded["data"])
+    return np.frombuffer(buf, dtype=np.float16).reshape(encoded["shape"])
+
+
+def compute_choice_matrix(
+    steps: List[str],
+    choices: List[str],
+    chosen_index: int,
+    nli_client=None,
+    hypothesis_template: str = HYPOTHESIS_TEMPLATE
+) -> Dict[str, Any]:
+    """
+    对比式评估：把每个步骤与全部选项的假设句配对，一次批量 NLI 得到 (步骤 × 选项) 的
+    ENTAILMENT 概率矩阵，并由此计算对比指标。
+    参数：
+        steps: 推理步骤列表
+        choices: 选项文本列表（顺序与 A/B/C/D/E 对应）
+        chosen_index: 模型所选（或回退的标准）答案在 choices 中的下标
+        nli_client: NLI 客户端实例（可选）
+        hypothesis_template: 假设句模板，与同一记录的逐步评估保持一致
+    返回：
+        - choice_matrix: float16 压缩后的概率矩阵（见 decode_float16_matrix）
+        - chosen_index: 所选答案下标
+        - contrastive_ratio: 对所选答案的支持度高于所有其他选项的步骤比例
+        - mean_margin: 所选答案概率减去其他选项最大概率的平均值
+        - chain_agrees: 各步骤平均后概率最高的选项是否就是所选答案
+    """
+    if not steps or not choices:
         return {
-            "ratio": 0.0,
-            "step_details": [],
-            "valid_steps": 0,
-            "entail_steps": 0,
-            "hypothesis": ""
+            "choice_matrix": encode_float16_matrix(np.zeros((0, len(choices)))),
+            "chosen_index": chosen_index,
+            "contrastive_ratio": 0.0,
+            "mean_margin": 0.0,
+            "chain_agrees": False
         }
 
-    # 构造假设句（完整自然语句有助于 NLI 判断）
-    hypothesis = f"The final choice is {answer}."
-
-    # 获取 NLI 客户端
     if nli_client is None:
         nli_client = get_nli_client()
 
-    step_details = []
-    entail_count = 0
-
-    # 对每个步骤计算 ENTAILMENT 概率，并基于阈值分类
-    for step in steps:
-        prob = nli_client.entailment_score(step, hypothesis)
-     # 1. 对 step 做轻量补全，去掉多余前缀
-        cleaned = step.strip()
-      # 如果以 "(X)" 或 "and " 等开头，可以去掉这些标记
-        cleaned = re.sub(r'^\([A-E]\)\s*', '', cleaned, flags=re.IGNORECASE)
-        cleaned = re.sub(r'^[Aa]nd\s+', '', cleaned)
-
-     # 2. 给 NLI 一个完整的前提句，让模型更好理解
-        premise_for_nli = f"This step says: {cleaned}."
-        prob = nli_client.entailment_score(premise_for_nli, hypothesis)
-        if prob >= ENTAILMENT_THRESHOLD:
-            label = "ENTAILMENT"
-        elif prob <= CONTRADICTION_THRESHOLD:
-            label = "CONTRADICTION"
-        else:
-            label = "ENTAILMENT"
-
-        is_entail = (label == "ENTAILMENT")
-        if is_entail:
-            entail_count += 1
-
-        step_details.append({
-            "step_text": step,
-            "score": prob,
-            "label": label,
-            "is_entail": is_entail
-        })
+    premises = [_premise_for_nli(step) for step in steps]
+    hypotheses = [build_hypothesis(choice, hypothesis_template) for choice in choices]
+    # 所有 (步骤, 选项) 对按行优先展开，一次批量调用
+    pair_premises = [p for p in premises for _ in hypotheses]
+    pair_hypotheses = hypotheses * len(premises)
+    scores = np.asarray(
+        nli_client.entailment_scores(pair_premises, pair_hypotheses),
+        dtype=np.float32
+    ).reshape(len(steps), len(choices))
 
-    # 计算比例
-    ratio = entail_count / len(steps)
+    chosen = scores[:, chosen_index]
+    others = np.delete(scores, chosen_index, axis=1)
+    if others.shape[1]:
+        margin = chosen - others.max(axis=1)
+    else:
+        margin = chosen
 
     return {
-        "ratio": ratio,
-        "step_details": step_details,
-        "valid_steps": len(steps),
-        "entail_steps": entail_count,
-        "hypothesis": hypothesis,
+        "choice_matrix": encode_float16_matrix(scores),
+        "chosen_index": chosen_index,
+        "contrastive_ratio": float((margin > 0).mean()),
+        "mean_margin": float(margin.mean()),
+        "chain_agrees": bool(int(scores.mean(axis=0).argmax()) == chosen_index)
     }
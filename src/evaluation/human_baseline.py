@@ -0,0 +1,132 @@
+# human_baseline.py
+# CoS-E 人工解释的蕴含率基线：一次性批量打分，结果以列式 Parquet 文件缓存，供各实验报告对比
+import argparse
+import os
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.cot_extraction.extractor import extract_cot_steps
+
+HUMAN_BASELINE_PATH = os.path.join("outputs", "baseline", "cose_human_baseline.parquet")
+EXPLANATION_FIELDS = ("abstractive_explanation", "extractive_explanation")
+
+
+def build_cose_human_baseline(
+    output_path: str = HUMAN_BASELINE_PATH,
+    splits=("train", "validation"),
+    field: str = "abstractive_explanation",
+    batch_size: int = 128,
+    nli_client=None
+) -> str:
+    """
+    把 CoS-E 各划分中的人工解释拆分为步骤，与标准答案假设句做大批量 NLI 打分，
+    并把每条样本的结果写成一张列式表。
+    参数：
+        output_path: 输出的 Parquet 文件路径
+        splits: 需要打分的数据划分
+        field: 使用的解释字段，'abstractive_explanation' 或 'extractive_explanation'
+        batch_size: NLI 前向批次大小
+        nli_client: NLI 客户端实例（可选）
+    返回：
+        写出的文件路径
+    """
+    # 延迟导入：报告侧只需读取基线文件，不必加载 torch / datasets
+    from src.datasets.loader import load_split_table
+    from src.evaluation.entailment import _premise_for_nli, _label_from_prob, build_hypothesis
+    from src.utils.nli_client import get_nli_client
+
+    if field not in EXPLANATION_FIELDS:
+        raise ValueError(f"Unknown explanation field: {field}, must be one of {EXPLANATION_FIELDS}")
+    if nli_client is None:
+        nli_client = get_nli_client()
+
+    columns: Dict[str, list] = {
+        "id": [], "split": [], "answer": [], "explanation": [],
+        "steps": [], "valid_steps": [], "entail_steps": [], "ratio": [], "step_scores": []
+    }
+    premises: List[str] = []
+    hypotheses: List[str] = []
+
+    for split in splits:
+        # 只映射需要的三列
+        data = load_split_table("cose", split, ["id", "answer", field]).to_pydict()
+        for sample_id, answer, explanation in zip(data["id"], data["answer"], data[field]):
+            # 人工解释没有固定格式，按 simple 规则拆句
+            steps = extract_cot_steps(explanation or "", prompt_type="simple")
+            hypothesis = build_hypothesis(answer)
+            premises.extend(_premise_for_nli(step) for step in steps)
+            hypotheses.extend([hypothesis] * len(steps))
+            columns["id"].append(sample_id)
+            columns["split"].append(split)
+            columns["answer"].append(answer)
+            columns["explanation"].append(explanation)
+            columns["steps"].append(steps)
+
+    # 所有划分的全部步骤一次性按长度分桶批量打分
+    scores = nli_client.entailment_scores(premises, hypotheses,
+                                          batch_size=batch_size, bucket_by_length=True)
+
+    offset = 0
+    for steps in columns["steps"]:
+        step_scores = scores[offset:offset + len(steps)]
+        offset += len(steps)
+        entail = sum(1 for s in step_scores if _label_from_prob(s) == "ENTAILMENT")
+        columns["valid_steps"].append(len(steps))
+        columns["entail_steps"].append(entail)
+        columns["ratio"].append(entail / len(steps) if steps else 0.0)
+        columns["step_scores"].append(step_scores)
+
+    table = pa.table({
+        "id": pa.array(columns["id"], pa.string()),
+        "split": pa.array(columns["split"], pa.string()).dictionary_encode(),
+        "answer": pa.array(columns["answer"], pa.string()),
+        "explanation": pa.array(columns["explanation"], pa.string()),
+        "steps": pa.array(columns["steps"], pa.list_(pa.string())),
+        "valid_steps": pa.array(columns["valid_steps"], pa.int32()),
+        "entail_steps": pa.array(columns["entail_steps"], pa.int32()),
+        "ratio": pa.array(columns["ratio"], pa.float32()),
+        "step_scores": pa.array(columns["step_scores"], pa.list_(pa.float32())),
+    })
+    table = table.replace_schema_metadata({"field": field, "nli_model": nli_client.model.name_or_path})
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    pq.write_table(table, output_path, compression="zstd")
+    return output_path
+
+
+def load_human_baseline(path: str = HUMAN_BASELINE_PATH, columns: Optional[List[str]] = None) -> Optional[pa.Table]:
+    """读取缓存的人工解释基线，文件不存在时返回 None"""
+    if not os.path.exists(path):
+        return None
+    return pq.read_table(path, columns=columns)
+
+
+def human_baseline_ratio(split: str = "validation", path: str = HUMAN_BASELINE_PATH) -> Optional[float]:
+    """返回指定划分上人工解释的平均蕴含率，基线文件不存在时返回 None"""
+    table = load_human_baseline(path, columns=["split", "ratio"])
+    if table is None:
+        return None
+    mask = pc.equal(table["split"].cast(pa.string()), split)
+    ratios = table["ratio"].filter(mask)
+    if len(ratios) == 0:
+        return None
+    return pc.mean(ratios).as_py()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score CoS-E human explanations as an entailment baseline")
+    parser.add_argument("--output", default=HUMAN_BASELINE_PATH, help="Parquet file to write")
+    parser.add_argument("--splits", nargs="+", default=["train", "validation"], help="Dataset splits to score")
+    parser.add_argument("--field", choices=EXPLANATION_FIELDS, default="abstractive_explanation",
+                        help="Which CoS-E explanation field to score")
+    parser.add_argument("--batch_size", type=int, default=128, help="NLI batch size")
+    args = parser.parse_args()
+
+    path = build_cose_human_baseline(args.output, tuple(args.splits), args.field, args.batch_size)
+    print(f"Human baseline saved to: {path}")
+    for split in args.splits:
+        ratio = human_baseline_ratio(split, path)
+        print(f"{split}: Average Entailment Ratio: {ratio:.2%}" if ratio is not None else f"{split}: N/A")
@@ -0,0 +1,90 @@
+# metrics.py
+# 单个实验（数据集 × shot × prompt 类型 × 模型）的结构化汇总指标，由各评估函数返回，供运行器直接使用；
+# 评估函数同时把它写成结果文件旁的 <结果>.metrics.json，子进程模式的运行器读取该文件，不再解析标准输出
+import json
+import os
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, Optional
+
+
+@dataclass
+class ExperimentMetrics:
+    dataset: str
+    shot: str
+    prompt_type: str
+    model_name: str
+    sample_size: int = 0
+    accuracy: Optional[float] = None
+    entailment_ratio: Optional[float] = None
+    chain_entailment: Optional[float] = None
+    contrastive_ratio: Optional[float] = None
+    coherence: Optional[float] = None
+    question_consistency: Optional[float] = None
+    near_duplicates_removed: int = 0
+    nli_calls_saved: int = 0
+    output_file: Optional[str] = None
+    duration: Optional[float] = None
+    # 自适应采样时的停止点与最终区间（见 src.evaluation.sequential）
+    early_stop: Optional[Dict] = None
+    # 本次运行新评估的样本数（sample_size 还包含续跑前已完成的样本）
+    evaluated: int = 0
+    # 死信文件中仍然失败的样本数（LLM 调用重试后失败，未计入指标）
+    failed: int = 0
+    # total_seconds、inference_seconds（等待 LLM 的时间）、seconds_per_sample（按本次新评估的样本计）
+    timings: Optional[Dict] = None
+    # LLM 调用次数、失败次数、prompt / 生成 token 数与耗时（见 src.inference.infer.TokenUsage）
+    token_usage: Optional[Dict] = None
+    # 离线重放的结果：原结果文件与重放配置（见 src.replay）
+    replay: Optional[Dict] = None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ExperimentMetrics":
+        """忽略未知字段，便于读取旧版本或其他来源的指标字典"""
+        names = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in names})
+
+
+def metrics_path(result_file: str) -> str:
+    base = result_file[:-len(".jsonl")] if result_file.endswith(".jsonl") else result_file
+    return base + ".metrics.json"
+
+
+def save_metrics(metrics: ExperimentMetrics, result_file: str) -> str:
+    """写入 <结果>.metrics.json；先写临时文件再替换，运行器不会读到写了一半的文件"""
+    path = metrics_path(result_file)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics.to_dict(), f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def experiment_identity(result_file: str) -> Optional[Dict[str, str]]:
+    """
+    结果文件对应的 dataset / shot / prompt_type / model_name：优先取自其 .metrics.json，
+    早于 .metrics.json 的结果文件由文件名解析，模型名按 name:tag 还原（mistral_7b -> mistral:7b）；都无法确定时返回 None
+    """
+    metrics = load_metrics(result_file)
+    if metrics is not None:
+        return {"dataset": metrics.dataset, "shot": metrics.shot, "prompt_type": metrics.prompt_type,
+                "model_name": metrics.model_name}
+    # 延迟导入：result_parquet 依赖 pyarrow
+    from src.utils.result_parquet import parse_result_name
+    meta = parse_result_name(result_file)
+    if meta is None:
+        return None
+    name, _, tag = meta["model"].rpartition("_")
+    return {"dataset": meta["dataset"], "shot": meta["shot"], "prompt_type": meta["prompt_type"],
+            "model_name": f"{name}:{tag}" if name else tag}
+
+
+def load_metrics(result_file: str) -> Optional[ExperimentMetrics]:
+    """读取结果文件对应的指标 JSON，不存在时返回 None"""
+    path = metrics_path(result_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return ExperimentMetrics.from_dict(json.load(f))
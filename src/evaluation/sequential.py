@@ -0,0 +1,217 @@
+# sequential.py
+# 自适应采样（序贯提前停止）：评估循环按随机顺序取样，边评估边维护准确率与蕴含率的置信区间，
+# 区间宽度降到目标以下、或与参考运行的配对差值区间已不含 0 时提前停止，并把停止点与最终区间写入 <结果>.sequential.json。
+# 每 check_every 个样本检查一次；置信水平按计划的检查次数做 Bonferroni 分摊，反复查看不会抬高误判率。
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+from statistics import NormalDist
+from typing import Dict, Optional
+
+from src.evaluation.significance import SAMPLE_METRICS, load_sample_scores
+from src.utils.result_io import result_path
+
+# 自适应模式下打乱样本顺序的固定种子：同一实验每次得到同样的顺序，续跑时不会改变已评估的样本集合
+SHUFFLE_SEED = 0
+
+
+@dataclass(frozen=True)
+class StoppingRule:
+    """
+    提前停止条件，至少设置 target_width 或参考运行之一
+        target_width: 各指标置信区间（全宽）都不超过该值时停止
+        reference_model / reference_prompt_type: 参考运行（同数据集、同 shot，缺省项与当前实验相同）；
+            reference_metric 的配对差值区间不含 0 时停止
+        confidence: 整个序贯过程的置信水平
+        min_samples: 开始检查前至少评估的样本数
+        check_every: 每隔多少个样本检查一次
+    """
+    target_width: Optional[float] = None
+    reference_model: Optional[str] = None
+    reference_prompt_type: Optional[str] = None
+    reference_metric: str = "accuracy"
+    confidence: float = 0.95
+    min_samples: int = 30
+    check_every: int = 10
+
+    def reference_path(self, dataset: str, shot: str, model_name: str, prompt_type: str) -> Optional[str]:
+        if self.reference_model is None and self.reference_prompt_type is None:
+            return None
+        return result_path(dataset, shot, self.reference_model or model_name,
+                           self.reference_prompt_type or prompt_type)
+
+    def to_env(self) -> Dict[str, str]:
+        """传给子进程（--isolate）的环境变量，与 from_env 对应"""
+        return {f"STOP_{key.upper()}": "" if value is None else str(value) for key, value in asdict(self).items()}
+
+    @classmethod
+    def from_env(cls, environ=os.environ) -> Optional["StoppingRule"]:
+        """从 STOP_* 环境变量构建；既没有目标宽度也没有参考运行时返回 None"""
+        values = {key: convert(environ[f"STOP_{key.upper()}"]) for key, convert in _ENV_TYPES.items()
+                  if environ.get(f"STOP_{key.upper()}", "") != ""}
+        rule = cls(**values)
+        if rule.target_width is None and rule.reference_model is None and rule.reference_prompt_type is None:
+            return None
+        return rule
+
+
+_ENV_TYPES = {
+    "target_width": float,
+    "reference_model": str,
+    "reference_prompt_type": str,
+    "reference_metric": str,
+    "confidence": float,
+    "min_samples": int,
+    "check_every": int,
+}
+
+
+class _Moments:
+    """流式均值与方差"""
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, value: float):
+        self.n += 1
+        self.total += value
+        self.total_sq += value * value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.n if self.n else float("nan")
+
+    def stderr(self) -> float:
+        if self.n < 2:
+            return float("inf")
+        var = max(self.total_sq - self.total * self.total / self.n, 0.0) / (self.n - 1)
+        return math.sqrt(var / self.n)
+
+
+def _interval(moments: _Moments, z: float, binary: bool) -> Dict[str, float]:
+    n, mean = moments.n, moments.mean
+    if binary and n:
+        # 准确率用 Wilson 区间：样本少、准确率接近 0 或 1 时不会退化成零宽度
+        denom = 1 + z * z / n
+        center = (mean + z * z / (2 * n)) / denom
+        half = z / denom * math.sqrt(mean * (1 - mean) / n + z * z / (4 * n * n))
+    else:
+        center, half = mean, z * moments.stderr()
+    return {"mean": mean, "low": center - half, "high": center + half, "width": 2 * half}
+
+
+class SequentialMonitor:
+    """
+    逐条接收结果记录，维护各指标的置信区间及与参考运行的配对差值；should_stop() 判断是否可以停止
+    """
+
+    def __init__(self, rule: StoppingRule, max_samples: int, reference_file: Optional[str] = None):
+        self.rule = rule
+        self.max_samples = max_samples
+        self.metrics = {name: _Moments() for name in SAMPLE_METRICS}
+        self.reference_file = reference_file if reference_file and os.path.exists(reference_file) else None
+        self.reference = load_sample_scores(self.reference_file) if self.reference_file else {}
+        self.diffs = {name: _Moments() for name in SAMPLE_METRICS}
+        self.reason: Optional[str] = None
+        # 计划的检查次数：从 min_samples 开始每 check_every 个样本一次
+        looks = max(1, (max_samples - rule.min_samples) // rule.check_every + 1)
+        self.z = NormalDist().inv_cdf(1 - (1 - rule.confidence) / (2 * looks))
+
+    @property
+    def n(self) -> int:
+        return self.metrics["accuracy"].n
+
+    def add_record(self, record: Dict):
+        # 缺失的指标（chain 模式的逐步蕴含率）不计入，其余指标照常累计
+        values = {name: fn(record) for name, fn in SAMPLE_METRICS.items()}
+        for name, value in values.items():
+            if value is not None:
+                self.metrics[name].add(value)
+        reference = self.reference.get(record.get("id"))
+        if reference is not None:
+            for name, ref_value in zip(SAMPLE_METRICS, reference):
+                if values[name] is not None and ref_value is not None:
+                    self.diffs[name].add(values[name] - ref_value)
+
+    def intervals(self) -> Dict[str, Dict[str, float]]:
+        """有取值的各指标的区间"""
+        return {name: _interval(m, self.z, name == "accuracy") for name, m in self.metrics.items() if m.n}
+
+    def reference_interval(self) -> Optional[Dict[str, float]]:
+        moments = self.diffs[self.rule.reference_metric]
+        if not self.reference_file or moments.n == 0:
+            return None
+        return {**_interval(moments, self.z, binary=False), "n_paired": moments.n}
+
+    def should_stop(self) -> bool:
+        """只在检查点上判断；一旦满足条件，reason 记录停止原因"""
+        if self.reason is not None:
+            return True
+        n = self.n
+        if n < self.rule.min_samples or (n - self.rule.min_samples) % self.rule.check_every:
+            return False
+        if self.rule.target_width is not None and all(
+                i["width"] <= self.rule.target_width for i in self.intervals().values()):
+            self.reason = "target_width"
+        else:
+            diff = self.reference_interval()
+            if diff is not None and diff["n_paired"] >= self.rule.min_samples and (diff["low"] > 0 or diff["high"] < 0):
+                self.reason = "reference_decided"
+        return self.reason is not None
+
+    def summary(self) -> Dict:
+        return {
+            "stopped_at": self.n,
+            "max_samples": self.max_samples,
+            "reason": self.reason or "exhausted",
+            "rule": asdict(self.rule),
+            "z": self.z,
+            "intervals": self.intervals(),
+            "reference_file": self.reference_file,
+            "reference_diff": self.reference_interval(),
+        }
+
+    def save(self, result_file: str) -> str:
+        base = result_file[:-len(".jsonl")] if result_file.endswith(".jsonl") else result_file
+        path = base + ".sequential.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2, ensure_ascii=False)
+        return path
+
+    def describe(self) -> str:
+        summary = self.summary()
+        lines = [f"Sequential stop: {summary['reason']} after {summary['stopped_at']} of {self.max_samples} samples"]
+        for name, i in summary["intervals"].items():
+            lines.append(f"  {name}: {i['mean']:.2%} [{i['low']:.2%}, {i['high']:.2%}]")
+        diff = summary["reference_diff"]
+        if diff is not None:
+            lines.append(f"  {self.rule.reference_metric} vs reference ({diff['n_paired']} paired): "
+                         f"{diff['mean']*100:+.2f} pts [{diff['low']*100:+.2f}, {diff['high']*100:+.2f}]")
+        return "\n".join(lines)
+
+
+def add_stopping_arguments(parser):
+    """运行器与 run_matrix 共用的自适应采样参数"""
+    group = parser.add_argument_group("adaptive sampling (sample_size becomes an upper bound)")
+    group.add_argument("--target_width", type=float, default=None,
+                       help="Stop once the accuracy and entailment ratio intervals are at most this wide (e.g. 0.1)")
+    group.add_argument("--reference_model", default=None,
+                       help="Stop once the paired difference to this model's result file excludes zero")
+    group.add_argument("--reference_prompt_type", default=None,
+                       help="Stop once the paired difference to this prompt type's result file excludes zero")
+    group.add_argument("--reference_metric", choices=list(SAMPLE_METRICS), default="accuracy",
+                       help="Metric compared against the reference run")
+    group.add_argument("--stop_confidence", type=float, default=0.95,
+                       help="Confidence level over the whole sequential run")
+    group.add_argument("--min_samples", type=int, default=30, help="Samples evaluated before the first check")
+    group.add_argument("--check_every", type=int, default=10, help="Samples between two checks")
+
+
+def stopping_rule_from_args(args) -> Optional[StoppingRule]:
+    if args.target_width is None and args.reference_model is None and args.reference_prompt_type is None:
+        return None
+    return StoppingRule(args.target_width, args.reference_model, args.reference_prompt_type, args.reference_metric,
+                        args.stop_confidence, args.min_samples, args.check_every)
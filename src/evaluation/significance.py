@@ -0,0 +1,164 @@
+# significance.py
+# 运行之间的配对 bootstrap 显著性检验：按样本 id 对齐两个或多个运行，
+# 一次生成 (重采样次数 × 样本数) 的下标矩阵并转换为计数矩阵，所有运行与指标的重采样均值由一次矩阵乘法得到，不做 Python 循环。
+import argparse
+from collections import defaultdict
+from itertools import combinations
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from src.evaluation.metrics import ExperimentMetrics
+from src.utils.result_io import iter_result_records
+
+# 指标名 -> 从一条结果记录中取样本级取值；chain 模式的记录没有逐步蕴含率（ratio 为 None）
+SAMPLE_METRICS = {
+    "accuracy": lambda r: float(r.get("model_answer") == r.get("answer_label")),
+    "entailment_ratio": lambda r: (r.get("entailment_info") or {}).get("ratio"),
+}
+
+
+def load_sample_scores(path: str, metrics: Iterable[str] = tuple(SAMPLE_METRICS)) -> Dict[str, Tuple[float, ...]]:
+    """读取结果文件，返回 样本 id -> 各指标的取值（缺失的指标为 None）；所有指标都缺失的样本跳过"""
+    scores = {}
+    for record in iter_result_records(path):
+        values = tuple(SAMPLE_METRICS[m](record) for m in metrics)
+        if any(v is not None for v in values):
+            scores[record["id"]] = values
+    return scores
+
+
+def align_runs(paths: Dict[str, str], metrics: Iterable[str] = tuple(SAMPLE_METRICS)) -> Tuple[List[str], np.ndarray]:
+    """
+    按样本 id 对齐多个运行，只保留所有运行都有的样本
+    返回：
+        ids: 对齐后的样本 id（排序）
+        values: (运行数, 指标数, 样本数) 的取值数组，运行顺序同 paths；缺失的指标为 NaN
+    """
+    metrics = tuple(metrics)
+    per_run = [load_sample_scores(path, metrics) for path in paths.values()]
+    ids = sorted(set.intersection(*(set(scores) for scores in per_run))) if per_run else []
+    values = np.array([[scores[i] for i in ids] for scores in per_run], dtype=np.float64)
+    return ids, values.reshape(len(per_run), len(ids), len(metrics)).transpose(0, 2, 1)
+
+
+def bootstrap_means(values: np.ndarray, n_resamples: int = 10000, seed: int = 0) -> np.ndarray:
+    """
+    对最后一维（样本）做配对重采样：所有运行和指标共用同一组下标，保证差值是配对的。
+    values: (..., 样本数)；返回 (..., n_resamples) 的重采样均值
+    """
+    n = values.shape[-1]
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, n, size=(n_resamples, n), dtype=np.int32)
+    # 下标矩阵 -> 每次重采样中各样本被抽中的次数，均值 = 取值 · 次数 / n
+    counts = np.bincount((index + np.arange(n_resamples, dtype=np.int64)[:, None] * n).ravel(),
+                         minlength=n_resamples * n).reshape(n_resamples, n).astype(np.float32)
+    return values @ counts.T / n
+
+
+def compare_runs(
+    paths: Dict[str, str],
+    metrics: Iterable[str] = tuple(SAMPLE_METRICS),
+    n_resamples: int = 10000,
+    confidence: float = 0.95,
+    seed: int = 0
+) -> List[Dict]:
+    """
+    对 paths 中的每一对运行、每个指标计算配对差值（前者减后者）的 bootstrap 置信区间与双侧 p 值。
+    p 值用以观测差值为中心平移后的 bootstrap 分布估计原假设（差值为 0）下出现同样大差值的概率。
+    返回：
+        每对运行、每个指标一行：run_a、run_b、metric、n、mean_a、mean_b、diff、ci_low、ci_high、p_value
+    """
+    metrics = tuple(metrics)
+    names = list(paths)
+    ids, values = align_runs(paths, metrics)
+    if len(names) < 2 or not ids:
+        return []
+    observed = values.mean(axis=-1)                               # (运行, 指标)
+    resampled = bootstrap_means(values, n_resamples, seed)         # (运行, 指标, 重采样)
+
+    pairs = list(combinations(range(len(names)), 2))
+    a, b = np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs])
+    diff = observed[a] - observed[b]                              # (配对, 指标)
+    boot_diff = resampled[a] - resampled[b]                       # (配对, 指标, 重采样)
+    alpha = (1 - confidence) / 2
+    ci_low, ci_high = np.quantile(boot_diff, [alpha, 1 - alpha], axis=-1)
+    extreme = np.abs(boot_diff - diff[..., None]) >= np.abs(diff[..., None]) - 1e-12
+    p_value = (extreme.sum(axis=-1) + 1) / (n_resamples + 1)
+
+    rows = []
+    for k, (i, j) in enumerate(pairs):
+        for m, metric in enumerate(metrics):
+            # 任一运行缺少该指标（例如 chain 模式没有逐步蕴含率）时不比较
+            if np.isnan(values[[i, j], m]).any():
+                continue
+            rows.append({
+                "run_a": names[i], "run_b": names[j], "metric": metric, "n": len(ids),
+                "mean_a": float(observed[i, m]), "mean_b": float(observed[j, m]),
+                "diff": float(diff[k, m]), "ci_low": float(ci_low[k, m]), "ci_high": float(ci_high[k, m]),
+                "p_value": float(p_value[k, m]),
+            })
+    return rows
+
+
+def format_comparison(row: Dict, confidence: float = 0.95) -> str:
+    marker = "*" if row["p_value"] < 1 - confidence else " "
+    return (f"{row['run_a']:<12} vs {row['run_b']:<12} {row['metric']:<18} "
+            f"{row['diff']*100:+7.2f} pts  [{row['ci_low']*100:+7.2f}, {row['ci_high']*100:+7.2f}]  "
+            f"p={row['p_value']:.4f}{marker} (n={row['n']})")
+
+
+def print_prompt_comparisons(results: Iterable[ExperimentMetrics], n_resamples: int = 10000,
+                             confidence: float = 0.95, seed: int = 0):
+    """
+    运行汇总用：在同一 (数据集, shot, 模型) 内两两比较各 prompt 类型，打印配对差值、置信区间与 p 值
+    """
+    groups: Dict[Tuple[str, str, str], Dict[str, str]] = defaultdict(dict)
+    for metrics in results:
+        if metrics.output_file and metrics.accuracy is not None:
+            groups[(metrics.dataset, metrics.shot, metrics.model_name)][metrics.prompt_type] = metrics.output_file
+
+    lines = []
+    for (dataset, shot, model_name), paths in sorted(groups.items()):
+        if len(paths) < 2:
+            continue
+        try:
+            rows = compare_runs(paths, n_resamples=n_resamples, confidence=confidence, seed=seed)
+        except OSError as e:
+            print(f"Skipping significance test for {dataset} {shot} {model_name}: {e}")
+            continue
+        if rows:
+            lines.append(f"{dataset} / {shot} / {model_name}")
+            lines.extend("  " + format_comparison(row, confidence) for row in rows)
+    if not lines:
+        return
+    print(f"Paired bootstrap ({n_resamples} resamples, {confidence:.0%} CI, * p < {1 - confidence:.2f})")
+    for line in lines:
+        print(line)
+    print("="*80)
+
+
+def _parse_run(entry: str) -> Tuple[str, str]:
+    name, sep, path = entry.partition("=")
+    return (name, path) if sep else (entry, entry)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Paired bootstrap comparison of result files aligned by sample id")
+    parser.add_argument("runs", nargs="+", metavar="[NAME=]PATH", help="Result JSONL files to compare (two or more)")
+    parser.add_argument("--metrics", nargs="+", choices=list(SAMPLE_METRICS), default=list(SAMPLE_METRICS))
+    parser.add_argument("--n_resamples", type=int, default=10000, help="Bootstrap resamples")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the intervals")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if len(args.runs) < 2:
+        parser.error("Compare at least two runs")
+
+    rows = compare_runs(dict(_parse_run(entry) for entry in args.runs), args.metrics, args.n_resamples,
+                        args.confidence, args.seed)
+    if not rows:
+        raise SystemExit("The runs share no sample ids")
+    print(f"Aligned samples: {rows[0]['n']}")
+    for row in rows:
+        print(f"{row['run_a']} = {row['mean_a']:.2%}, {row['run_b']} = {row['mean_b']:.2%} ({row['metric']})")
+        print("  " + format_comparison(row, args.confidence))
@@ -0,0 +1,203 @@
+# threshold_sweep.py
+# 软阈值扫描：读取各结果文件旁的概率 sidecar（.probs.npz），对整个 ENTAILMENT_THRESHOLD × CONTRADICTION_THRESHOLD 网格
+# 用 searchsorted 按阈值区间计数，重新计算标签、蕴含率、链级蕴含率以及按答案正误分组的蕴含率，不需要重新跑 NLI。
+import argparse
+import csv
+import glob
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.evaluation.entailment import ENTAIL_IDX, ENTAILMENT_THRESHOLD, CONTRADICTION_THRESHOLD
+from src.utils.prob_sidecar import load_sidecar
+from src.utils.result_io import iter_result_records
+
+DEFAULT_GRID = np.round(np.arange(0.05, 1.0, 0.05), 2)
+
+
+def threshold_counts(p: np.ndarray, groups: np.ndarray, n_groups: int, thresholds: np.ndarray,
+                     weights: Optional[np.ndarray] = None) -> tuple:
+    """
+    按组统计 p >= t 与 p > t 的（加权）个数，t 取遍升序的 thresholds：每个概率用 searchsorted 定位到阈值区间，
+    按 (组, 区间) 累加成直方图后做后缀和，内存与概率个数加上 组数 × 阈值个数 成正比。NaN 概率不计入。
+    返回：
+        (ge, gt)，形状均为 (n_groups, len(thresholds))
+    """
+    valid = ~np.isnan(p)
+    p, groups = p[valid], groups[valid]
+    weights = None if weights is None else weights[valid]
+    n_bins = len(thresholds) + 1
+    counts = []
+    for side in ("right", "left"):
+        # side="right" 时 k 为 <= p 的阈值个数，即 p >= thresholds[g] 当且仅当 g < k；side="left" 对应 p > thresholds[g]
+        k = np.searchsorted(thresholds, p, side=side)
+        hist = np.bincount(groups * n_bins + k, weights=weights, minlength=n_groups * n_bins).reshape(n_groups, n_bins)
+        counts.append(np.cumsum(hist[:, ::-1], axis=1)[:, ::-1][:, 1:])
+    return tuple(counts)
+
+
+def select_entailed(ge: np.ndarray, gt: np.ndarray, thresholds: np.ndarray, entail_thresholds: np.ndarray,
+                    contradiction_thresholds: np.ndarray) -> np.ndarray:
+    """
+    与 _label_from_prob 一致：p >= E 判为 ENTAILMENT，p <= C 判为 CONTRADICTION，介于两者之间也记为 ENTAILMENT，
+    即 p >= E 或 p > C；C < E 时等价于 p > C，否则等价于 p >= E。
+    由 threshold_counts 的结果取出每个 (E, C) 的计数，返回 (E 个数, C 个数, 组数) 的数组
+    """
+    e_idx = np.searchsorted(thresholds, entail_thresholds)
+    c_idx = np.searchsorted(thresholds, contradiction_thresholds)
+    by_c = gt[:, c_idx].T[None, :, :]
+    by_e = ge[:, e_idx].T[:, None, :]
+    return np.where((contradiction_thresholds[None, :] < entail_thresholds[:, None])[:, :, None], by_c, by_e)
+
+
+def _segment_sums(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """按 offsets 分段求和（允许空段），返回 len(offsets) - 1 个段和"""
+    cumsum = np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+    return cumsum[offsets[1:]] - cumsum[offsets[:-1]]
+
+
+def find_sidecars(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(glob.escape(path), "**", "*.probs.npz"), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def _result_record_count(sidecar_file: str) -> Optional[int]:
+    """sidecar 对应结果文件中的记录数；结果文件不存在时为 None"""
+    result_file = sidecar_file[:-len(".probs.npz")] + ".jsonl"
+    if not os.path.exists(result_file):
+        return None
+    return sum(1 for _ in iter_result_records(result_file))
+
+
+def sweep_thresholds(
+    sidecar_files: List[str],
+    entail_thresholds: np.ndarray = DEFAULT_GRID,
+    contradiction_thresholds: np.ndarray = DEFAULT_GRID
+) -> List[Dict[str, Optional[float]]]:
+    """
+    把所有运行的步骤概率拼成一个数组，按运行统计整个阈值网格上的加权计数（见 threshold_counts），
+    内存与步骤数加上 运行数 × 网格大小 成正比，不随 E × C 网格与步骤数之积增长。
+    返回：
+        每个 (运行, E, C) 一行：entailment_ratio、ratio_correct / ratio_incorrect（答案正确 / 错误的记录上的平均蕴含率）、
+        chain_ratio，以及与阈值无关的 accuracy 和 sample_size；该运行没有对应概率时为 None。
+        result_records 为对应结果文件的记录数，与 sample_size 不一致时（例如中断后续跑丢了部分概率）打印警告，
+        此时各指标只覆盖结果文件的一个子集，与 .metrics.json 不可直接比较
+    """
+    entail_thresholds = np.asarray(entail_thresholds, dtype=np.float64)
+    contradiction_thresholds = np.asarray(contradiction_thresholds, dtype=np.float64)
+    runs = [(path, load_sidecar(path)) for path in sidecar_files]
+    runs = [(path, data) for path, data in runs if len(data["row_idx"])]
+    if not runs:
+        return []
+
+    # 全部运行的步骤拼成一个扁平数组；record_offsets 把记录映射到步骤区间，run_offsets 把运行映射到记录区间
+    step_p = np.concatenate([data["step_probs"][:, ENTAIL_IDX].astype(np.float32) for _, data in runs])
+    chain_p = np.concatenate([data["chain_probs"][:, ENTAIL_IDX].astype(np.float32) for _, data in runs])
+    correct = np.concatenate([data["correct"] for _, data in runs])
+    step_base = np.cumsum([0] + [len(data["step_probs"]) for _, data in runs])
+    record_offsets = np.concatenate(
+        [data["step_offsets"][:-1] + base for (_, data), base in zip(runs, step_base)] + [[step_base[-1]]]
+    ).astype(np.int64)
+    run_offsets = np.cumsum([0] + [len(data["row_idx"]) for _, data in runs]).astype(np.int64)
+
+    # 每个步骤按 1 / 所在记录的步骤数加权，按运行统计各阈值下的计数，即得各运行的蕴含率之和（无步骤的记录与
+    # compute_entailment_ratio 一样记为 0）；再乘以答案是否正确，得到正确答案记录上的蕴含率之和
+    thresholds = np.unique(np.concatenate([entail_thresholds, contradiction_thresholds]))
+    n_runs = len(runs)
+    step_counts = np.diff(record_offsets)
+    record_run = np.repeat(np.arange(n_runs), np.diff(run_offsets))
+    step_record = np.repeat(np.arange(len(step_counts)), step_counts)
+    step_weight = 1.0 / np.maximum(step_counts, 1)[step_record]
+    step_run = record_run[step_record]
+    ratio_sum = select_entailed(*threshold_counts(step_p, step_run, n_runs, thresholds, step_weight),
+                                thresholds, entail_thresholds, contradiction_thresholds)
+    ratio_correct_sum = select_entailed(
+        *threshold_counts(step_p, step_run, n_runs, thresholds, step_weight * correct[step_record]),
+        thresholds, entail_thresholds, contradiction_thresholds)
+    chain_sum = select_entailed(*threshold_counts(chain_p, record_run, n_runs, thresholds),
+                                thresholds, entail_thresholds, contradiction_thresholds)
+
+    # 与阈值无关的按运行计数
+    has_steps = _segment_sums(step_counts.astype(np.float64), run_offsets) > 0
+    n_records = np.diff(run_offsets).astype(np.float64)
+    n_correct = _segment_sums(correct.astype(np.float64), run_offsets)
+    n_chain = _segment_sums((~np.isnan(chain_p)).astype(np.float64), run_offsets)
+
+    def safe_div(num, den, valid=True):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(valid & (den > 0), num / np.where(den > 0, den, 1), np.nan)
+
+    metrics = {
+        "entailment_ratio": safe_div(ratio_sum, n_records, has_steps),
+        "ratio_correct": safe_div(ratio_correct_sum, n_correct, has_steps),
+        "ratio_incorrect": safe_div(ratio_sum - ratio_correct_sum, n_records - n_correct, has_steps),
+        "chain_ratio": safe_div(chain_sum, n_chain),
+    }
+
+    rows = []
+    for r, (path, _) in enumerate(runs):
+        run = os.path.basename(path)[:-len(".probs.npz")]
+        result_records = _result_record_count(path)
+        if result_records is not None and result_records != int(n_records[r]):
+            print(f"Warning: {path} has probabilities for {int(n_records[r])} records but its result file has "
+                  f"{result_records}; the sweep covers only part of that run")
+        for i, e in enumerate(entail_thresholds):
+            for j, c in enumerate(contradiction_thresholds):
+                row = {"run": run, "entail_threshold": float(e), "contradiction_threshold": float(c),
+                       "sample_size": int(n_records[r]), "result_records": result_records, "accuracy": float(n_correct[r] / n_records[r])}
+                for key, values in metrics.items():
+                    value = values[i, j, r]
+                    row[key] = None if np.isnan(value) else float(value)
+                rows.append(row)
+    return rows
+
+
+def _closest(values: np.ndarray, target: float) -> float:
+    return float(values[np.argmin(np.abs(values - target))])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-label stored NLI probabilities over a grid of soft thresholds")
+    parser.add_argument("paths", nargs="*", default=["outputs"], help="Sidecar .probs.npz files or directories to scan")
+    parser.add_argument("--entail_thresholds", type=float, nargs="+", default=DEFAULT_GRID.tolist(),
+                        help="ENTAILMENT_THRESHOLD values to evaluate")
+    parser.add_argument("--contradiction_thresholds", type=float, nargs="+", default=DEFAULT_GRID.tolist(),
+                        help="CONTRADICTION_THRESHOLD values to evaluate")
+    parser.add_argument("--output", default=os.path.join("outputs", "threshold_sweep.csv"), help="CSV file for the full grid")
+    args = parser.parse_args()
+
+    files = find_sidecars(args.paths)
+    entail_grid = np.asarray(args.entail_thresholds)
+    contradiction_grid = np.asarray(args.contradiction_thresholds)
+    rows = sweep_thresholds(files, entail_grid, contradiction_grid)
+    if not rows:
+        raise SystemExit(f"No probability sidecars found under {args.paths}")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{len(rows)} rows for {len(files)} runs written to {args.output}")
+
+    # 每个运行：当前默认阈值（取网格中最接近的点）与正确 / 错误答案之间蕴含率差距最大的阈值
+    current = (_closest(entail_grid, ENTAILMENT_THRESHOLD), _closest(contradiction_grid, CONTRADICTION_THRESHOLD))
+    print(f"{'Run':<60} {'E':>5} {'C':>5} {'Ratio':>8} {'Correct':>8} {'Wrong':>8}")
+    for run in dict.fromkeys(row["run"] for row in rows):
+        run_rows = [row for row in rows if row["run"] == run]
+        separated = [row for row in run_rows if row["ratio_correct"] is not None and row["ratio_incorrect"] is not None]
+        best = max(separated, key=lambda row: row["ratio_correct"] - row["ratio_incorrect"], default=None)
+        default = next(row for row in run_rows
+                       if (row["entail_threshold"], row["contradiction_threshold"]) == current)
+        for row in (default, best):
+            if row is None:
+                continue
+            fmt = lambda v: f"{v:.2%}" if v is not None else "N/A"
+            print(f"{run:<60} {row['entail_threshold']:>5.2f} {row['contradiction_threshold']:>5.2f} "
+                  f"{fmt(row['entailment_ratio']):>8} {fmt(row['ratio_correct']):>8} {fmt(row['ratio_incorrect']):>8}")
@@ -3,9 +3,97 @@
 
 # TODO: 实现API调用与本地模型推理的统一接口
 
+import contextvars
+import json
+import os
 import requests
 import time
 
+from src.config import MODEL_PATH
+
+# 每次调用的最大尝试次数
+MAX_ATTEMPTS = 3
+
+
+class InferenceError(RuntimeError):
+    """
+    LLM 调用在全部重试后仍然失败；评估脚本捕获后把样本写入死信文件（见 src.utils.dead_letter），
+    不再把错误信息当作模型输出去抽取步骤和打分
+    """
+
+    def __init__(self, model_name, url, attempts, error):
+        super().__init__(f"{model_name} at {url} failed after {attempts} attempts: {error}")
+        self.model_name = model_name
+        self.url = url
+        self.attempts = attempts
+        self.error = str(error)
+        self.error_type = type(error).__name__
+
+
+def ollama_endpoints():
+    """
+    解析 OLLAMA_HOSTS 环境变量，例如 "mistral:7b=http://gpu1:11434,falcon3:7b=http://gpu2:11434"，
+    返回 模型名 -> 服务地址；未列出的模型使用 config.MODEL_PATH
+    """
+    endpoints = {}
+    for entry in os.environ.get("OLLAMA_HOSTS", "").split(","):
+        if "=" in entry:
+            model, host = entry.split("=", 1)
+            endpoints[model.strip()] = host.strip().rstrip("/")
+    return endpoints
+
+
+def ollama_endpoint(model_name):
+    return ollama_endpoints().get(model_name, MODEL_PATH)
+
+
+class TokenUsage:
+    """
+    累计一次实验中 Ollama 调用的 token 数与耗时：prompt / 生成 token 数及 Ollama 报告的耗时取自响应，
+    seconds 为客户端等待的墙钟时间（含重试）
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.failed_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.prompt_eval_seconds = 0.0
+        self.eval_seconds = 0.0
+        self.seconds = 0.0
+
+    def add_response(self, data):
+        self.calls += 1
+        self.prompt_tokens += data.get("prompt_eval_count", 0)
+        self.completion_tokens += data.get("eval_count", 0)
+        # Ollama 的耗时单位为纳秒
+        self.prompt_eval_seconds += data.get("prompt_eval_duration", 0) / 1e9
+        self.eval_seconds += data.get("eval_duration", 0) / 1e9
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "failed_calls": self.failed_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "prompt_eval_seconds": self.prompt_eval_seconds,
+            "eval_seconds": self.eval_seconds,
+            "seconds": self.seconds,
+            "tokens_per_second": self.completion_tokens / self.eval_seconds if self.eval_seconds else None,
+        }
+
+
+# 当前线程正在累计的 TokenUsage；进程内并行的实验各在自己的线程里，互不干扰
+_token_usage = contextvars.ContextVar("token_usage", default=None)
+
+
+def track_token_usage():
+    """开始累计本线程之后的 run_inference / run_inference_stream 调用，返回累计对象"""
+    usage = TokenUsage()
+    _token_usage.set(usage)
+    return usage
+
 def run_inference(prompt, model_name, temperature, max_new_tokens, icl_mode):
     """
     使用Ollama本地API进行推理。
@@ -15,8 +103,9 @@ def run_inference(prompt, model_name, temperature, max_new_tokens, icl_mode):
     max_new_tokens: 最大生成token数
     icl_mode: ICL模式（可忽略）
     返回：模型生成的文本
+    异常：重试 MAX_ATTEMPTS 次仍失败时抛出 InferenceError
     """
-    url = "http://localhost:11434/api/generate"
+    url = f"{ollama_endpoint(model_name)}/api/generate"
     payload = {
         "model": model_name,
         "prompt": prompt,
@@ -26,13 +115,71 @@ def run_inference(prompt, model_name, temperature, max_new_tokens, icl_mode):
         },
         "stream": False
     }
-    for _ in range(3):  # 最多重试3次
+    usage = _token_usage.get()
+    start = time.time()
+    for _ in range(MAX_ATTEMPTS):
         try:
             response = requests.post(url, json=payload, timeout=120)
             response.raise_for_status()
             data = response.json()
+            if usage is not None:
+                usage.add_response(data)
+                usage.seconds += time.time() - start
             return data.get("response", "")
         except Exception as e:
+            last_error = e
+            print(f"Ollama API调用失败，重试中... 错误信息: {e}")
+            time.sleep(2)
+    if usage is not None:
+        usage.failed_calls += 1
+        usage.seconds += time.time() - start
+    raise InferenceError(model_name, url, MAX_ATTEMPTS, last_error)
+
+def run_inference_stream(prompt, model_name, temperature, max_new_tokens, icl_mode):
+    """
+    使用Ollama本地API进行流式推理，逐块产出生成文本，
+    可直接交给 StreamingStepExtractor 在生成过程中抽取推理步骤。
+    参数同 run_inference；连接在产出第一块文本之前失败时最多重试 MAX_ATTEMPTS 次，仍失败时抛出 InferenceError。
+    """
+    url = f"{ollama_endpoint(model_name)}/api/generate"
+    payload = {
+        "model": model_name,
+        "prompt": prompt,
+        "options": {
+            "temperature": temperature,
+            "num_predict": max_new_tokens
+        },
+        "stream": True
+    }
+    usage = _token_usage.get()
+    start = time.time()
+    for _ in range(MAX_ATTEMPTS):
+        try:
+            response = requests.post(url, json=payload, timeout=120, stream=True)
+            response.raise_for_status()
+            break
+        except Exception as e:
+            last_error = e
             print(f"Ollama API调用失败，重试中... 错误信息: {e}")
             time.sleep(2)
-    return "[Ollama API调用失败]" 
\ No newline at end of file
+    else:
+        if usage is not None:
+            usage.failed_calls += 1
+            usage.seconds += time.time() - start
+        raise InferenceError(model_name, url, MAX_ATTEMPTS, last_error)
+
+    with response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            chunk = data.get("response", "")
+            if chunk:
+                yield chunk
+            if data.get("done"):
+                # 最后一块带有整次调用的 token 数与耗时
+                if usage is not None:
+                    usage.add_response(data)
+                break
+    if usage is not None:
+        usage.seconds += time.time() - start
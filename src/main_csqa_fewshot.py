@@ -3,21 +3,31 @@
 
 # TODO: 实现命令行参数解析、主流程调度
 
-import json
 import os
+import time
 import re
 from tqdm import tqdm
-from src.datasets.loader import load_commonsenseqa
-from src.inference.infer import run_inference
-from prompts.templates.templated.templated_few_shot import build_fewshot_prompt_csqa as build_templated_prompt_csqa
-from prompts.templates.naturalistic.natural_few_shot import build_fewshot_prompt_csqa as build_natural_prompt_csqa
-from src.cot_extraction.extractor import extract_cot_steps
-from src.evaluation.entailment import compute_entailment_ratio
+from src.datasets.loader import iter_split_records, shard_size, CSQA_COLUMNS
+from src.config import TEMPERATURE, MAX_NEW_TOKENS, ANSWER_MAX_NEW_TOKENS
+from src.inference.infer import InferenceError, run_inference, track_token_usage
+from src.cot_extraction.extractor import extract_cot_steps, collapse_near_duplicates
+from src.evaluation.entailment import compute_entailment_ratio, compute_choice_matrix
+from src.evaluation.coherence import CoherenceBatcher
+from src.evaluation.sequential import SequentialMonitor, StoppingRule, SHUFFLE_SEED
 from src.utils.nli_client import get_nli_client
-from src.evaluation.accuracy import compute_accuracy
+from src.utils.prompt_store import load_prompt_store
+from src.utils.result_io import result_path, completed_ids, iter_result_records, ResultWriter
+from src.utils.shards import summarize_results
+from src.utils.prob_sidecar import ProbabilitySidecar
+from src.utils.dead_letter import DeadLetterWriter
+from src.utils.result_parquet import write_results_parquet
+from src.evaluation.metrics import ExperimentMetrics, save_metrics
 
 
-def evaluate_csqa_entailment(prompt_type='natural', sample_size=103, model_name="mistral:7b"):
+def evaluate_csqa_entailment(prompt_type='natural', sample_size=103, model_name="mistral:7b", entail_mode="both",
+                             contrastive=False, coherence=False, near_dup_threshold=None,
+                             shard_index=0, shard_count=1, shard_policy="contiguous", resume=False, parquet=False,
+                             stopping=None, only_ids=None, nli_client=None, progress_callback=None):
     """
     使用entailment ratio评估CommonsenseQA数据集上的推理质量
 
@@ -25,63 +35,116 @@ def evaluate_csqa_entailment(prompt_type='natural', sample_size=103, model_name=
         prompt_type: 使用的prompt类型，'templated'或'natural'
         sample_size: 评估样本数量
         model_name: 使用的模型名称 (e.g., 'mistral:7b', 'falcon3:7b')
+        entail_mode: 蕴含评估模式，'step'、'chain' 或 'both'（chain 模式每个样本只调用一次 NLI）
+        contrastive: 是否额外计算每个步骤对全部选项的蕴含概率矩阵及对比指标
+        coherence: 是否计算相邻步骤之间、步骤与问题之间的连贯性（按批次合并打分）
+        near_dup_threshold: 近似重复步骤折叠的 Jaccard 阈值，None 表示不折叠
+        shard_index / shard_count / shard_policy: 只评估前 sample_size 行中第 shard_index 个分片（共 shard_count 个），
+            策略为 'contiguous' 或 'strided'；分片结果写入单独的文件，用 src.utils.shards 合并
+        resume: 跳过结果文件中已有的样本 id，在原文件末尾继续追加；汇总指标包含之前已完成的样本
+        parquet: 结束后另存一份 zstd 压缩的 Parquet 结果（见 src.utils.result_parquet）
+        stopping: StoppingRule，设置后按随机顺序评估，区间足够窄或与参考运行的比较已有定论时提前停止，
+            sample_size 只作为上限（见 src.evaluation.sequential）
+        only_ids: 只评估这些样本 id（配合 resume 重跑死信文件中的失败样本，见 src.retry_failed），None 表示全部
+        nli_client: 共享的 NLI 客户端（进程内运行多个实验时复用），None 时使用全局单例
+        progress_callback: 每完成一个样本调用一次 progress_callback(已完成数, 总数)，供调度器估算进度
+    返回：
+        ExperimentMetrics 汇总指标
     """
+    start_time = time.time()
+    # 累计本次评估中所有 LLM 调用的 token 数与耗时
+    token_usage = track_token_usage()
     # 验证prompt_type
     if prompt_type not in ['templated', 'natural']:
         raise ValueError(f"不支持的prompt类型: {prompt_type}，必须是 'templated' 或 'natural'")
 
-    # 1. 加载数据
-    dataset = load_commonsenseqa()
-    val_data = dataset["validation"]
+    # 1. 加载数据：内存映射 Arrow 文件，只读取需要的列，按批次转换成行视图
+    val_data = iter_split_records("commonsenseqa", "validation", CSQA_COLUMNS, limit=sample_size,
+                                  shard_index=shard_index, shard_count=shard_count, shard_policy=shard_policy,
+                                  shuffle_seed=SHUFFLE_SEED if stopping else None)
 
-    # 2. 选择prompt构建函数
-    if prompt_type == 'templated':
-        build_prompt = build_templated_prompt_csqa
-    else:  # natural
-        build_prompt = build_natural_prompt_csqa
+    # 2. 从预编译的 prompt 仓库读取 prompt（模板源码变化时自动重新编译）
+    prompt_store = load_prompt_store("csqa", "few_shot", prompt_type, limit=sample_size)
 
     # 3. 初始化NLI客户端
-    nli_client = get_nli_client()
+    if nli_client is None:
+        nli_client = get_nli_client()
 
-    results = []
-    predictions = []
-    references = []
-    total_ratio = 0.0
+    # 结果逐条追加写入，崩溃后可用 resume 续跑
+    output_file = result_path("csqa", "few_shot", model_name, prompt_type, shard_index, shard_count)
+    done_ids = completed_ids(output_file) if resume else set()
+    if done_ids:
+        print(f"Resuming: {len(done_ids)} samples already in {output_file}")
+    writer = ResultWriter(output_file, append=resume)
+    # 原始三分类概率另存为 .probs.npz，调整软阈值时用 threshold_sweep 重新打标签
+    sidecar = ProbabilitySidecar(output_file, resume=resume)
+    # LLM 调用重试后仍失败的样本写入死信文件，不进入结果与指标；记录重跑所需的参数
+    dead_letters = DeadLetterWriter(output_file, {
+        "dataset": "csqa", "shot": "few_shot", "model_name": model_name, "prompt_type": prompt_type,
+        "sample_size": sample_size, "entail_mode": entail_mode, "contrastive": contrastive, "coherence": coherence,
+        "near_dup_threshold": near_dup_threshold, "shard_index": shard_index, "shard_count": shard_count,
+        "shard_policy": shard_policy,
+    }, append=resume)
+    processed = 0
+    total_items = shard_size(sample_size, shard_index, shard_count, shard_policy)
+    monitor = None
+    if stopping is not None:
+        reference_file = stopping.reference_path("csqa", "few_shot", model_name, prompt_type)
+        monitor = SequentialMonitor(stopping, total_items, None if reference_file == output_file else reference_file)
+        # 续跑时先把已完成的样本计入区间
+        for record in (iter_result_records(output_file) if done_ids else ()):
+            monitor.add_record(record)
+    coherence_batcher = CoherenceBatcher(nli_client) if coherence else None
 
     # 4. 遍历样本
-    for item in tqdm(val_data.select(range(sample_size)), desc="Evaluating"):
+    for item in tqdm(val_data, total=total_items, desc="Evaluating"):
+        processed += 1
+        if item["id"] in done_ids or (only_ids is not None and item["id"] not in only_ids):
+            continue
+        if monitor is not None and monitor.should_stop():
+            break
         # 第一阶段：获取推理过程
-        reasoning_prompt = build_prompt(item, stage='reasoning')
-        reasoning_output = run_inference(
-            reasoning_prompt,
-            model_name=model_name,
-            temperature=0.7,
-            max_new_tokens=256,
-            icl_mode="few-shot-cot"
-        )
+        reasoning_prompt = prompt_store.prompt(item['row_idx'], 'reasoning')
+        try:
+            reasoning_output = run_inference(
+                reasoning_prompt,
+                model_name=model_name,
+                temperature=TEMPERATURE,
+                max_new_tokens=MAX_NEW_TOKENS,
+                icl_mode="few-shot-cot"
+            )
+        except InferenceError as e:
+            dead_letters.add(item, "reasoning", e)
+            continue
 
         # 提取推理步骤
         steps = extract_cot_steps(reasoning_output, prompt_type=prompt_type)
+        # 折叠近似重复的步骤，被折叠的步骤不再参与任何 NLI 打分
+        near_dup_removed = 0
+        if near_dup_threshold is not None:
+            steps, near_dup_removed = collapse_near_duplicates(steps, near_dup_threshold)
 
         # 第二阶段：获取答案
-        answer_prompt = build_prompt(item, stage='answer')
-        answer_output = run_inference(
-            answer_prompt,
-            model_name=model_name,
-            temperature=0.7,
-            max_new_tokens=32,
-            icl_mode="few-shot-cot"
-        )
+        answer_prompt = prompt_store.prompt(item['row_idx'], 'answer')
+        try:
+            answer_output = run_inference(
+                answer_prompt,
+                model_name=model_name,
+                temperature=TEMPERATURE,
+                max_new_tokens=ANSWER_MAX_NEW_TOKENS,
+                icl_mode="few-shot-cot"
+            )
+        except InferenceError as e:
+            dead_letters.add(item, "answer", e)
+            continue
 
         # 提取答案标签
         model_label = extract_choice_commonsenseqa(answer_output)
         standard_label = item['answerKey']
 
         # 获取答案文本
-        # 修改：直接使用数据集中的label和text列表
-        choices = {}
-        for label, text in zip(item['choices']['label'], item['choices']['text']):
-            choices[label] = text
+        # 选项字典已由 ColumnBatch 按批次从 choices 列构建
+        choices = item['choice_map']
 
         # 更严谨的answer_text获取逻辑
         valid_labels = ['A', 'B', 'C', 'D', 'E']
@@ -93,25 +156,38 @@ def evaluate_csqa_entailment(prompt_type='natural', sample_size=103, model_name=
             answer_text = choices[standard_label]
             used_label = standard_label
 
-        # 收集预测/参考
-        predictions.append(model_label)
-        references.append(standard_label)
-
         # 计算entailment ratio
-        entail_info = compute_entailment_ratio(
+        entail_info, entail_probs = compute_entailment_ratio(
             steps,
             answer_text,
-            nli_client
-        )
+            nli_client,
+            mode=entail_mode,
+            return_probs=True
+            )
+
+        # 对比式评估：每个步骤与全部选项一次批量打分
+        if contrastive:
+            entail_info["contrastive"] = compute_choice_matrix(
+                steps,
+                list(choices.values()),
+                list(choices.keys()).index(used_label),
+                nli_client
+            )
 
         print("\n" + "-" * 40 + " each evaluation result " + "-" * 40)
         print(f"MA: {model_label} | SA: {standard_label}")
         print(f"hypothesis: {entail_info['hypothesis']}")
         print(f"Valid Steps: {entail_info['valid_steps']} | Supporting Steps: {entail_info['entail_steps']}")
-        print(f"Entailment Ratio: {entail_info['ratio']:.2%}")
+        if entail_info['ratio'] is not None:
+            print(f"Entailment Ratio: {entail_info['ratio']:.2%}")
+        if 'chain_score' in entail_info:
+            print(f"Chain Entailment Score: {entail_info['chain_score']:.2%} ({entail_info['chain_label']})")
+        if 'contrastive' in entail_info:
+            print(f"Contrastive Ratio: {entail_info['contrastive']['contrastive_ratio']:.2%}")
 
         # 记录结果
         result = {
+            "row_idx": item["row_idx"],
             "id": item.get("id", ""),
             "question": item["question"],
             "choices": choices,
@@ -121,29 +197,94 @@ def evaluate_csqa_entailment(prompt_type='natural', sample_size=103, model_name=
             "model_answer": model_label,
             "used_answer_text": answer_text,
             "extracted_steps": steps,
+            "near_duplicates_removed": near_dup_removed,
+            # 每个被折叠的步骤省下：逐步蕴含 1 次、对比矩阵每个选项 1 次、连贯性 2 次（相邻步骤与问题）
+            "nli_calls_saved": near_dup_removed * (
+                (entail_mode != "chain") + (len(choices) if contrastive else 0) + (2 if coherence else 0)
+            ),
             "entailment_info": entail_info
         }
-        results.append(result)
-        total_ratio += entail_info['ratio']
+        sidecar.add(item["row_idx"], model_label == standard_label, *entail_probs)
+        if monitor is not None:
+            monitor.add_record(result)
+        # 开启连贯性评估时，记录在所在批次打完分后才写入
+        if coherence_batcher is not None:
+            writer.write_all(coherence_batcher.add(result))
+        else:
+            writer.write(result)
+        if progress_callback is not None:
+            progress_callback(processed, total_items)
 
-    # 5. 保存详细结果
-    output_dir = os.path.join("outputs", "few_shot")
-    os.makedirs(output_dir, exist_ok=True)
-    model_name_cleaned = model_name.replace(':', '_')
-    output_file = os.path.join(output_dir, f"csqa_entail_results_{model_name_cleaned}_few-shot_{prompt_type}.jsonl")
+    if coherence_batcher is not None:
+        writer.write_all(coherence_batcher.flush())
+    writer.close()
+    sidecar.save()
+    failed = dead_letters.close()
+    parquet_file = write_results_parquet(output_file) if parquet else None
+    if monitor is not None:
+        # 最后一个样本恰好落在检查点上时也要记录停止原因
+        monitor.should_stop()
+        sequential_file = monitor.save(output_file)
 
-    with open(output_file, "w", encoding="utf-8") as f:
-        for r in results:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    # 5. 从结果文件流式重新计算汇总指标（续跑时包含之前已完成的样本）
+    summary = summarize_results(iter_result_records(output_file))
+
+    duration = time.time() - start_time
+    evaluated = summary["sample_size"] - len(done_ids)
+    metrics = ExperimentMetrics(
+        dataset="csqa",
+        shot="few_shot",
+        prompt_type=prompt_type,
+        model_name=model_name,
+        output_file=output_file,
+        duration=duration,
+        evaluated=evaluated,
+        failed=failed,
+        timings={
+            "total_seconds": duration,
+            "inference_seconds": token_usage.seconds,
+            "seconds_per_sample": duration / evaluated if evaluated else None,
+        },
+        token_usage=token_usage.to_dict(),
+        early_stop=monitor.summary() if monitor is not None else None,
+        **summary,
+    )
+    # 机器可读的汇总指标，运行器直接读取该文件；先于打印写入，全部样本都进入死信文件（结果为空）时也能记录 failed
+    metrics_file = save_metrics(metrics, output_file)
 
     # 6. 输出总体统计
-    avg_ratio = total_ratio / len(results)
-    acc = compute_accuracy(predictions, references)
     print(f"\nEvaluation completed!")
-    print(f"Sample size: {len(results)}")
-    print(f"Average Entailment Ratio: {avg_ratio:.2%}")
-    print(f"Accuracy: {acc:.2%}")
+    print(f"Sample size: {summary['sample_size']}")
+    if shard_count > 1:
+        print(f"Shard: {shard_index} of {shard_count} ({shard_policy})")
+    print(f"Average Entailment Ratio: {summary['entailment_ratio']:.2%}" if summary["entailment_ratio"] is not None
+          else "Average Entailment Ratio: N/A")
+    if summary["chain_entailment"] is not None:
+        print(f"Average Chain Entailment: {summary['chain_entailment']:.2%}")
+    if summary["contrastive_ratio"] is not None:
+        print(f"Average Contrastive Ratio: {summary['contrastive_ratio']:.2%}")
+    if summary["coherence"] is not None:
+        print(f"Average Coherence: {summary['coherence']:.2%}")
+    if summary["question_consistency"] is not None:
+        print(f"Average Question Consistency: {summary['question_consistency']:.2%}")
+    if near_dup_threshold is not None:
+        print(f"Near-Duplicate Steps Collapsed: {summary['near_duplicates_removed']} "
+              f"(NLI calls saved: {summary['nli_calls_saved']})")
+    print(f"Accuracy: {summary['accuracy']:.2%}" if summary["accuracy"] is not None else "Accuracy: N/A")
     print(f"Results saved to: {output_file}")
+    if monitor is not None:
+        print(monitor.describe())
+        print(f"Stopping point saved to: {sequential_file}")
+    if parquet_file is not None:
+        print(f"Parquet copy saved to: {parquet_file}")
+
+    if failed:
+        print(f"Failed Samples: {failed} (retry with python -m src.retry_failed {dead_letters.path})")
+    usage = metrics.token_usage
+    print(f"LLM Calls: {usage['calls']} ({usage['failed_calls']} failed) | "
+          f"Tokens: {usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion")
+    print(f"Metrics saved to: {metrics_file}")
+    return metrics
 
 
 def extract_choice_commonsenseqa(output):
@@ -172,10 +313,25 @@ if __name__ == "__main__":
     prompt_type = os.environ.get("PROMPT_TYPE", "natural")
     model_name = os.environ.get("MODEL_NAME", "mistral:7b")
     sample_size = int(os.environ.get("SAMPLE_SIZE", "103"))
+    entail_mode = os.environ.get("ENTAIL_MODE", "both")
+    contrastive = os.environ.get("CONTRASTIVE", "0") == "1"
+    coherence = os.environ.get("COHERENCE", "0") == "1"
+    near_dup_threshold = os.environ.get("NEAR_DUP_THRESHOLD")
+    near_dup_threshold = float(near_dup_threshold) if near_dup_threshold else None
+    shard_index = int(os.environ.get("SHARD_INDEX", "0"))
+    shard_count = int(os.environ.get("SHARD_COUNT", "1"))
+    shard_policy = os.environ.get("SHARD_POLICY", "contiguous")
+    resume = os.environ.get("RESUME", "0") == "1"
+    parquet = os.environ.get("OUTPUT_PARQUET", "0") == "1"
+    stopping = StoppingRule.from_env()
 
     # prompt_type 验证
     if prompt_type not in ['templated', 'natural']:
         print(f"警告：未知的prompt类型 '{prompt_type}'，将使用 'natural'")
         prompt_type = 'natural'
 
-    evaluate_csqa_entailment(prompt_type=prompt_type, sample_size=sample_size, model_name=model_name)
+    evaluate_csqa_entailment(prompt_type=prompt_type, sample_size=sample_size, model_name=model_name,
+                             entail_mode=entail_mode, contrastive=contrastive,
+                             coherence=coherence, near_dup_threshold=near_dup_threshold,
+                             shard_index=shard_index, shard_count=shard_count, shard_policy=shard_policy,
+                             resume=resume, parquet=parquet, stopping=stopping)
@@ -0,0 +1,335 @@
+# pipeline_dag.py
+# 增量实验 DAG：数据快照 → 渲染的 prompt → LLM 输出 → 抽取的步骤 → NLI 分数 → 汇总指标。
+# 每个节点的键是上游节点的键与本阶段输入（模板源码、模型与生成参数、抽取器源码、NLI 模型与阈值等）的哈希，
+# 结果文件旁的 <结果>.dag.json 记录产出它时的各节点键。重跑矩阵时逐个比较，只重算失效的阶段及其下游：
+# LLM 输出仍然有效时，步骤与 NLI 分数用 replay 离线重算，不调用 LLM；LLM 输出失效时旧产物按其生成键打包进缓存，
+# 之后输入改回原样（例如撤销一次模板修改）时直接取回，不必重新生成。
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import tarfile
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from src.config import (
+    ANSWER_MAX_NEW_TOKENS,
+    CHAIN_PREMISE_PREFIX,
+    CONTRADICTION_THRESHOLD,
+    ENTAILMENT_THRESHOLD,
+    HYPOTHESIS_TEMPLATE,
+    MAX_NEW_TOKENS,
+    NLI_MODEL_NAME,
+    TEMPERATURE,
+)
+from src.cot_extraction import extractor
+from src.datasets.loader import _split_arrow_files
+from src.evaluation.metrics import ExperimentMetrics, load_metrics, metrics_path, save_metrics
+from src.utils.dead_letter import DEAD_LETTER_SUFFIX, dead_letter_path, load_dead_letters
+from src.utils.prob_sidecar import sidecar_path
+from src.utils.prompt_store import DATASETS, template_hash
+from src.utils.result_io import OUTPUT_ROOT, completed_ids, iter_result_records, result_path
+from src.utils.shards import summarize_results
+
+DAG_CACHE_ROOT = os.path.join(OUTPUT_ROOT, "dag_cache")
+MANIFEST_SUFFIX = ".dag.json"
+
+# 节点按依赖顺序排列，每个节点只依赖前一个
+STAGES = ("dataset", "prompts", "generations", "steps", "nli", "metrics")
+# 这些节点失效时必须重新调用 LLM
+LLM_STAGES = ("dataset", "prompts", "generations")
+
+# 计算 NLI 分数的代码（前提构造、阈值打标签、窗口与截断），开启连贯性评估时再加上 coherence.py
+NLI_SOURCE_MODULES = ("src.evaluation.entailment", "src.utils.nli_client")
+COHERENCE_SOURCE_MODULE = "src.evaluation.coherence"
+
+# 一个实验的全部产物（结果文件之外按后缀区分），LLM 输出失效时一起打包进缓存
+ARTIFACT_SUFFIXES = (".jsonl", ".probs.npz", ".metrics.json", DEAD_LETTER_SUFFIX, ".parquet", ".sequential.json",
+                     MANIFEST_SUFFIX)
+
+# (路径, 大小, 修改时间) -> 文件内容哈希，同一进程内每个数据文件只读一次
+_file_digests: Dict[tuple, str] = {}
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def file_digest(path: str) -> str:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _file_digests[key] = h.hexdigest()[:16]
+    return _file_digests[key]
+
+
+def source_digest(obj) -> str:
+    """模块或函数源码的哈希，作为代码版本"""
+    return hashlib.sha256(inspect.getsource(obj).encode("utf-8")).hexdigest()[:16]
+
+
+def module_digest(name: str) -> str:
+    """按模块名定位源文件并哈希，不导入模块本身（NLI 相关模块在导入时会加载 torch）"""
+    return file_digest(importlib.util.find_spec(name).origin)
+
+
+def _base(result_file: str) -> str:
+    return result_file[:-len(".jsonl")] if result_file.endswith(".jsonl") else result_file
+
+
+def manifest_path(result_file: str) -> str:
+    return _base(result_file) + MANIFEST_SUFFIX
+
+
+def load_manifest(result_file: str) -> Optional[Dict]:
+    path = manifest_path(result_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(result_file: str, keys: Dict[str, str], inputs: Dict[str, Dict]) -> str:
+    """先写临时文件再替换，与 save_metrics 相同"""
+    path = manifest_path(result_file)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"keys": keys, "inputs": inputs, "updated": time.strftime("%Y-%m-%d %H:%M:%S")}, f,
+                  indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def stale_stages(manifest: Optional[Dict], keys: Dict[str, str]) -> List[str]:
+    """第一个键不一致的节点及其全部下游；没有清单时全部失效"""
+    recorded = (manifest or {}).get("keys", {})
+    for i, stage in enumerate(STAGES):
+        if recorded.get(stage) != keys[stage]:
+            return list(STAGES[i:])
+    return []
+
+
+@dataclass
+class JobPlan:
+    """
+    一个实验需要做的工作：
+        stale: 失效的节点
+        offline: 不调用 LLM 的重算，'rescore'（重新抽取步骤并重跑 NLI）或 'metrics'（只重算汇总指标）
+        llm: 'generate'（从头生成）或 'extend'（续跑缺少的样本，例如 sample_size 变大）
+        restored / archived: 从缓存取回、打包进缓存的产物
+    """
+    result_file: str
+    keys: Dict[str, str]
+    stale: List[str] = field(default_factory=list)
+    offline: Optional[str] = None
+    llm: Optional[str] = None
+    restored: Optional[str] = None
+    archived: Optional[str] = None
+    metrics: Optional[ExperimentMetrics] = None
+
+    def describe(self) -> str:
+        actions = [action for action in (self.offline, self.llm) if action]
+        text = ", ".join(actions) if actions else "up to date"
+        if self.stale == ["adopted"]:
+            text += " (untracked outputs adopted)"
+        elif self.stale:
+            text += f" (stale from {self.stale[0]})"
+        if self.restored:
+            text += f", restored from {self.restored}"
+        if self.archived:
+            text += f", previous outputs archived to {self.archived}"
+        return text
+
+
+class ExperimentDag:
+    """
+    一组评估参数下的实验 DAG，各节点的输入：
+        dataset: 数据划分 Arrow 文件的内容
+        prompts: 模板模块源码（template_hash）
+        generations: 模型名与生成参数（温度、两阶段的最大生成长度）
+        steps: 抽取器源码与近似重复折叠阈值
+        nli: NLI 模型、软阈值、假设句模板、entail_mode、contrastive、coherence
+        metrics: 汇总函数源码
+    sample_size 不参与哈希：样本数增加时只续跑缺少的样本，减少时保留已有的样本。
+    没有清单的结果文件（引入 DAG 之前的运行）默认视为全部失效；adopt_untracked 时假定它们与当前输入一致，直接补写清单
+    """
+
+    def __init__(self, entail_mode: str = "both", contrastive: bool = False, coherence: bool = False,
+                 near_dup_threshold: Optional[float] = None, split: str = "validation",
+                 cache_root: str = DAG_CACHE_ROOT, adopt_untracked: bool = False):
+        self.entail_mode = entail_mode
+        self.contrastive = contrastive
+        self.coherence = coherence
+        self.near_dup_threshold = near_dup_threshold
+        self.split = split
+        self.cache_root = cache_root
+        self.adopt_untracked = adopt_untracked
+
+    def stage_inputs(self, dataset: str, shot: str, prompt_type: str, model_name: str) -> Dict[str, Dict]:
+        data_dir, _ = DATASETS[dataset]
+        scoring_modules = NLI_SOURCE_MODULES + ((COHERENCE_SOURCE_MODULE,) if self.coherence else ())
+        return {
+            "dataset": {"name": data_dir, "split": self.split,
+                        "files": {os.path.basename(path): file_digest(path)
+                                  for path in _split_arrow_files(data_dir, self.split)}},
+            "prompts": {"shot": shot, "prompt_type": prompt_type,
+                        "template": template_hash(dataset, shot, prompt_type)},
+            "generations": {"model_name": model_name, "temperature": TEMPERATURE, "max_new_tokens": MAX_NEW_TOKENS,
+                            "answer_max_new_tokens": ANSWER_MAX_NEW_TOKENS},
+            "steps": {"extractor": source_digest(extractor), "near_dup_threshold": self.near_dup_threshold},
+            "nli": {"model": NLI_MODEL_NAME, "entail_threshold": ENTAILMENT_THRESHOLD,
+                    "contradiction_threshold": CONTRADICTION_THRESHOLD, "hypothesis_template": HYPOTHESIS_TEMPLATE,
+                    "chain_premise_prefix": CHAIN_PREMISE_PREFIX, "entail_mode": self.entail_mode,
+                    "contrastive": self.contrastive, "coherence": self.coherence,
+                    "scoring": {name: module_digest(name) for name in scoring_modules}},
+            "metrics": {"summary": source_digest(summarize_results)},
+        }
+
+    @staticmethod
+    def stage_keys(inputs: Dict[str, Dict]) -> Dict[str, str]:
+        """每个节点的键 = 哈希(节点名, 上游节点的键, 本节点的输入)，上游任何变化都会传递到下游"""
+        keys, parent = {}, ""
+        for stage in STAGES:
+            parent = keys[stage] = _digest(stage, parent, inputs[stage])
+        return keys
+
+    def cache_path(self, result_file: str, generations_key: str) -> str:
+        """outputs/zero_shot/x.jsonl -> outputs/dag_cache/zero_shot/x/<生成键>.tar.gz"""
+        parent = os.path.basename(os.path.dirname(os.path.abspath(result_file)))
+        return os.path.join(self.cache_root, parent, os.path.basename(_base(result_file)), f"{generations_key}.tar.gz")
+
+    def plan(self, dataset: str, shot: str, prompt_type: str, model_name: str, sample_size: int) -> JobPlan:
+        """比较清单与当前的节点键，决定要重算哪些阶段（不修改任何文件）"""
+        result_file = result_path(dataset, shot, model_name, prompt_type)
+        keys = self.stage_keys(self.stage_inputs(dataset, shot, prompt_type, model_name))
+        plan = JobPlan(result_file, keys)
+        if not os.path.exists(result_file):
+            plan.stale, plan.llm = list(STAGES), "generate"
+            return plan
+        manifest = load_manifest(result_file)
+        if manifest is None and self.adopt_untracked:
+            manifest = {"keys": keys}
+            plan.stale = ["adopted"]
+        else:
+            plan.stale = stale_stages(manifest, keys)
+        if any(stage in plan.stale for stage in LLM_STAGES):
+            plan.llm = "generate"
+            return plan
+        if "steps" in plan.stale or "nli" in plan.stale:
+            plan.offline = "rescore"
+        elif plan.stale or load_metrics(result_file) is None:
+            plan.offline = "metrics"
+        # 死信文件中的样本留给 src.retry_failed，不算缺少
+        failed = len(load_dead_letters(dead_letter_path(result_file))) if os.path.exists(
+            dead_letter_path(result_file)) else 0
+        if len(completed_ids(result_file)) + failed < sample_size:
+            plan.llm = "extend"
+            # 续跑结束时评估函数会重写汇总指标
+            if plan.offline == "metrics":
+                plan.offline = None
+        return plan
+
+    def archive(self, result_file: str) -> Optional[str]:
+        """把结果文件及其全部旁路文件按清单中的生成键打包进缓存后删除；没有清单的旧结果记为 untracked_<时间>"""
+        base = _base(result_file)
+        paths = [base + suffix for suffix in ARTIFACT_SUFFIXES if os.path.exists(base + suffix)]
+        if not paths:
+            return None
+        manifest = load_manifest(result_file)
+        key = manifest["keys"]["generations"] if manifest else f"untracked_{time.strftime('%Y%m%d_%H%M%S')}"
+        path = self.cache_path(result_file, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with tarfile.open(tmp_path, "w:gz") as tar:
+            for p in paths:
+                tar.add(p, arcname=os.path.basename(p))
+        os.replace(tmp_path, path)
+        for p in paths:
+            os.remove(p)
+        return path
+
+    def restore(self, result_file: str, generations_key: str) -> Optional[str]:
+        """缓存中有同一生成键的产物时解包回结果目录，返回缓存文件路径"""
+        path = self.cache_path(result_file, generations_key)
+        if not os.path.exists(path):
+            return None
+        names = {os.path.basename(_base(result_file)) + suffix for suffix in ARTIFACT_SUFFIXES}
+        with tarfile.open(path, "r:gz") as tar:
+            # 只接受自己打包的文件名，不解包到其他位置
+            members = [member for member in tar.getmembers() if member.isfile() and member.name in names]
+            if os.path.basename(result_file) not in {member.name for member in members}:
+                return None
+            tar.extractall(os.path.dirname(result_file) or ".", members=members)
+        return path
+
+    def rescore(self, result_file: str, prompt_type: str, nli_client=None):
+        """LLM 输出不变：用 replay 重新抽取步骤、重跑 NLI，替换结果文件与概率 sidecar"""
+        # 延迟导入：只有需要重算时才加载 torch（result_parquet 经 entailment 同样会加载）
+        from src.replay import replay_file
+        from src.utils.result_parquet import parquet_path, write_results_parquet
+
+        tmp_file = os.path.join(self.cache_root, "tmp", f"{os.getpid()}_{os.path.basename(result_file)}")
+        os.makedirs(os.path.dirname(tmp_file), exist_ok=True)
+        replay_file(result_file, tmp_file, prompt_type, nli_client, self.entail_mode,
+                    near_dup_threshold=self.near_dup_threshold, coherence=self.coherence,
+                    contrastive=self.contrastive)
+        os.replace(tmp_file, result_file)
+        os.replace(sidecar_path(tmp_file), sidecar_path(result_file))
+        os.remove(metrics_path(tmp_file))
+        if os.path.exists(parquet_path(result_file)):
+            write_results_parquet(result_file)
+
+    @staticmethod
+    def rebuild_metrics(result_file: str, dataset: str, shot: str, prompt_type: str,
+                        model_name: str) -> ExperimentMetrics:
+        """从结果文件重算汇总指标；生成阶段的信息（token 用量、提前停止）沿用原指标文件"""
+        previous = load_metrics(result_file)
+        failed = len(load_dead_letters(dead_letter_path(result_file))) if os.path.exists(
+            dead_letter_path(result_file)) else 0
+        metrics = ExperimentMetrics(dataset=dataset, shot=shot, prompt_type=prompt_type, model_name=model_name,
+                                    output_file=result_file, failed=failed,
+                                    early_stop=previous.early_stop if previous else None,
+                                    token_usage=previous.token_usage if previous else None,
+                                    **summarize_results(iter_result_records(result_file)))
+        save_metrics(metrics, result_file)
+        return metrics
+
+    def prepare(self, dataset: str, shot: str, prompt_type: str, model_name: str, sample_size: int,
+                nli_client=None) -> JobPlan:
+        """
+        执行计划中不调用 LLM 的部分并更新清单，返回剩余的计划：
+            generate: 旧产物打包进缓存；缓存中有当前生成键的产物时取回并重新规划，否则写入新清单，留给评估函数从头生成
+            rescore / metrics: 离线重算后写入清单
+        plan.llm 为 None 时实验已是最新，plan.metrics 为其汇总指标；否则由调用方以 resume 模式运行评估函数
+        """
+        plan = self.plan(dataset, shot, prompt_type, model_name, sample_size)
+        inputs = self.stage_inputs(dataset, shot, prompt_type, model_name)
+        if plan.llm == "generate":
+            archived = self.archive(plan.result_file)
+            restored = self.restore(plan.result_file, plan.keys["generations"])
+            if restored is not None:
+                previous_stale = plan.stale
+                plan = self.prepare(dataset, shot, prompt_type, model_name, sample_size, nli_client)
+                plan.stale, plan.restored = previous_stale, restored
+            else:
+                # 先写清单：生成中途中断时下次按 extend 续跑，而不是再次从头生成
+                save_manifest(plan.result_file, plan.keys, inputs)
+            plan.archived = archived
+            return plan
+
+        if plan.offline == "rescore":
+            self.rescore(plan.result_file, prompt_type, nli_client)
+        if plan.offline is not None:
+            plan.metrics = self.rebuild_metrics(plan.result_file, dataset, shot, prompt_type, model_name)
+        elif plan.llm is None:
+            plan.metrics = load_metrics(plan.result_file)
+        if plan.stale:
+            save_manifest(plan.result_file, plan.keys, inputs)
+        return plan
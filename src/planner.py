@@ -0,0 +1,197 @@
+# planner.py
+# 墙钟预算规划：在给定的总时长内为矩阵中的每个实验分配样本数，使各实验最终的标准误大致相同；
+# 先用少量样本测出各实验的吞吐，之后每跑完一段就按已观测到的吞吐与方差重新规划（见 run_matrix 的 --budget）。
+import math
+import os
+import re
+import time
+from dataclasses import dataclass
+from statistics import NormalDist
+
+from src.evaluation.significance import load_sample_scores
+from src.utils.result_io import completed_ids, result_path
+
+# 实际分配的剩余预算比例，为最后几段与排程空隙留出余量
+BUDGET_SAFETY = 0.9
+# 实验还没有结果时假定的方差（伯努利变量方差的最大值）
+PRIOR_VARIANCE = 0.25
+
+
+def parse_duration(text):
+    """把 '4h'、'90m'、'3600s'、'1h30m' 或单独的数字（按小时计）解析成秒数"""
+    text = text.strip().lower()
+    try:
+        return float(text) * 3600
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)\s*([hms])', text)
+    if not parts or re.sub(r'(\d+(?:\.\d+)?)\s*([hms])', '', text).strip():
+        raise ValueError(f"Cannot parse duration: {text}")
+    return sum(float(value) * {"h": 3600, "m": 60, "s": 1}[unit] for value, unit in parts)
+
+
+def sample_variance(path):
+    """
+    决定实验所需样本数的单样本方差：取准确率方差（拉普拉斯平滑，预热样本全部答对时不会得到零方差）
+    与逐样本蕴含率方差中较大者
+    """
+    if not path or not os.path.exists(path):
+        return PRIOR_VARIANCE
+    scores = list(load_sample_scores(path).values())
+    n = len(scores)
+    if n < 2:
+        return PRIOR_VARIANCE
+    p = (sum(s[0] for s in scores) + 1) / (n + 2)
+    # chain 模式的记录没有逐步蕴含率
+    ratios = [s[1] for s in scores if s[1] is not None]
+    mean = sum(ratios) / len(ratios) if ratios else 0.0
+    ratio_var = sum((r - mean) ** 2 for r in ratios) / (len(ratios) - 1) if len(ratios) >= 2 else 0.0
+    return max(p * (1 - p), ratio_var, 1e-4)
+
+
+@dataclass
+class CellState:
+    """规划器掌握的单个实验的状态"""
+    endpoint: str
+    model_name: str
+    cap: int
+    evaluated: int = 0
+    new_samples: int = 0
+    seconds: float = 0.0
+    variance: float = PRIOR_VARIANCE
+    planned: int = None
+    finished: bool = False
+
+    def seconds_per_item(self):
+        """只按本次运行新评估的样本计算，不含续跑前已有的记录"""
+        return self.seconds / self.new_samples if self.new_samples else None
+
+
+class BudgetPlanner:
+    """
+    把墙钟预算分配给矩阵中的各个实验，使每个实验最终的标准误大致相同。每个实验先新跑 warmup 个样本测出吞吐，
+    之后实验 j 分到 n_j = k * variance_j 个样本（下限为已有的样本数，上限为 sample_size），k 为各实验共用、
+    在预算允许范围内取最大的值。成本按 LLM 槽位秒计：实验运行时占用一个槽位，因此同一端点上的实验
+    最多花费 槽位数 × 剩余时间。实验按最多 chunk 个样本分段运行，每段结束后用已观测到的吞吐与方差重新规划。
+    只有调度线程调用规划器，不需要加锁
+    """
+
+    def __init__(self, jobs, budget_seconds, llm_slots, sample_size, warmup=10, chunk=50,
+                 confidence=0.95, resume=False, start=None):
+        self.deadline = (start or time.time()) + budget_seconds
+        self.budget_seconds = budget_seconds
+        self.llm_slots = dict(llm_slots)
+        self.warmup = warmup
+        self.chunk = chunk
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.cells = {job.name: CellState(job.needs.endpoint, job.model_name, sample_size) for job in jobs}
+        self.k = None
+        if resume:
+            # 结果文件中已有的记录计入计划，并用来估计初始方差
+            for job in jobs:
+                path = result_path(job.dataset, job.shot, job.model_name, job.prompt_type)
+                if os.path.exists(path):
+                    cell = self.cells[job.name]
+                    cell.evaluated = len(completed_ids(path))
+                    cell.variance = sample_variance(path)
+                    cell.finished = cell.evaluated >= cell.cap
+
+    def record_segment(self, job, metrics, seconds):
+        """用跑完的一段的指标更新实验状态（sample_size 为结果文件中的全部记录数）"""
+        cell = self.cells[job.name]
+        evaluated = metrics.sample_size or 0
+        if metrics.accuracy is None or evaluated <= cell.evaluated:
+            # 该段失败或数据集已没有剩余样本：实验无法继续增加样本
+            cell.finished = True
+        else:
+            cell.seconds += seconds
+            cell.new_samples += evaluated - cell.evaluated
+            cell.evaluated = evaluated
+            cell.variance = sample_variance(metrics.output_file)
+        self.replan()
+
+    def _rate(self, cell):
+        """观测到的每样本秒数；没有时取同一模型各实验的平均值，再没有时取全部实验的平均值"""
+        rate = cell.seconds_per_item()
+        if rate is not None:
+            return rate
+        for same_model in (True, False):
+            rates = [c.seconds_per_item() for c in self.cells.values()
+                     if c.seconds_per_item() is not None and (not same_model or c.model_name == cell.model_name)]
+            if rates:
+                return sum(rates) / len(rates)
+        return None
+
+    def replan(self, now=None):
+        """按剩余预算重新计算每个实验的计划样本数"""
+        remaining = max(self.deadline - (now or time.time()), 0.0) * BUDGET_SAFETY
+        rates = {name: self._rate(cell) for name, cell in self.cells.items()}
+        if any(rate is None for rate in rates.values()):
+            return
+        if remaining == 0:
+            # 时间已用完：各实验保持现有样本数
+            for cell in self.cells.values():
+                cell.planned = cell.evaluated
+            self.k = 0.0
+            return
+        # 给定 k 时裁剪后的分配，以及它在每个端点上还需要的槽位秒数
+        def allocation(k):
+            return {name: cell.evaluated if cell.finished else
+                    min(max(math.ceil(k * cell.variance), cell.evaluated), cell.cap)
+                    for name, cell in self.cells.items()}
+
+        def fits(k):
+            cost = {}
+            for name, n in allocation(k).items():
+                cell = self.cells[name]
+                cost[cell.endpoint] = cost.get(cell.endpoint, 0.0) + (n - cell.evaluated) * rates[name]
+            return all(seconds <= remaining * self.llm_slots.get(endpoint, 1) for endpoint, seconds in cost.items())
+
+        # 成本随 k 单调增加，二分查找预算内最大的 k
+        low, high = 0.0, max(cell.cap / cell.variance for cell in self.cells.values())
+        if fits(high):
+            low = high
+        else:
+            for _ in range(60):
+                mid = (low + high) / 2
+                low, high = (mid, high) if fits(mid) else (low, mid)
+        self.k = low
+        for name, n in allocation(low).items():
+            self.cells[name].planned = n
+
+    def next_target(self, job):
+        """实验下一段的目标样本数；已达到计划时返回 None"""
+        cell = self.cells[job.name]
+        if cell.finished or time.time() >= self.deadline:
+            return None
+        if cell.new_samples == 0:
+            # 预热：先测出该实验自己的吞吐，再按计划运行
+            return min(cell.evaluated + self.warmup, cell.cap)
+        if cell.planned is None or cell.planned <= cell.evaluated:
+            return None
+        return min(cell.planned, cell.evaluated + self.chunk)
+
+    def has_results(self, job):
+        return self.cells[job.name].evaluated > 0
+
+    def half_width(self, job):
+        """按计划样本数估计的实验指标置信区间半宽"""
+        cell = self.cells[job.name]
+        n = cell.planned or cell.evaluated
+        return self.z * math.sqrt(cell.variance / n) if n else None
+
+    def describe(self, job):
+        cell = self.cells[job.name]
+        planned = "?" if cell.planned is None else str(cell.planned)
+        half_width = self.half_width(job)
+        return f"{cell.evaluated}/{planned}" + (f" ±{half_width*100:.1f}" if half_width is not None else "")
+
+    def summary(self):
+        remaining = max(self.deadline - time.time(), 0.0)
+        plan = "warming up" if self.k is None else f"samples per unit variance: {self.k:.0f}"
+        return f"Budget: {remaining / 3600:.2f} h of {self.budget_seconds / 3600:.2f} h left, {plan}"
+
+    def to_dict(self, job):
+        cell = self.cells[job.name]
+        return {"evaluated": cell.evaluated, "planned": cell.planned, "seconds": cell.seconds,
+                "variance": cell.variance, "half_width": self.half_width(job)}
@@ -0,0 +1,226 @@
+# replay.py
+# 离线重放：读取已保存的结果文件，只重新做推理链抽取与批量 NLI，不调用 LLM。
+# 修改抽取规则、NLI 阈值或假设句模板之后，用它代替 run_experiments 重新打分；
+# 抽取在进程池中提前进行，主进程把一整块记录的 NLI 对合并成一次按长度分桶的前向计算，吞吐只受 NLI 限制。
+import argparse
+import os
+import time
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.cot_extraction.bulk import extract_steps_bulk
+from src.cot_extraction.corpus import infer_prompt_type, iter_result_files
+from src.cot_extraction.extractor import collapse_near_duplicates
+from src.evaluation.coherence import compute_coherence_batch
+from src.evaluation.metrics import ExperimentMetrics, experiment_identity, save_metrics
+from src.evaluation.entailment import (
+    compute_choice_matrix,
+    compute_entailment_ratio_batch,
+    ENTAIL_MODES,
+    HYPOTHESIS_TEMPLATE,
+    ENTAILMENT_THRESHOLD,
+    CONTRADICTION_THRESHOLD,
+)
+from src.utils.nli_client import get_nli_client
+from src.utils.prob_sidecar import ProbabilitySidecar
+from src.utils.result_io import ResultWriter, iter_result_records
+from src.utils.shards import summarize_results, RATIO_KEYS
+
+REPLAY_ROOT = os.path.join("outputs", "replay")
+
+
+def replay_path(path: str, output_root: str = REPLAY_ROOT) -> str:
+    """保留上一级目录名：outputs/zero_shot/x.jsonl -> outputs/replay/zero_shot/x.jsonl"""
+    parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return os.path.join(output_root, parent, os.path.basename(path))
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _choice_texts(record: Dict) -> Tuple[List[str], Optional[int]]:
+    """
+    对比矩阵的选项文本与所选答案下标，与各实验脚本一致：csqa 的 choices 是 标签 -> 文本 的字典，cose 是按 A/B/C… 排列的列表；
+    模型标签无效时回退到标准答案，两者都无效时下标为 None（不计算对比矩阵）
+    """
+    choices = record.get("choices") or []
+    if isinstance(choices, dict):
+        labels, texts = list(choices), list(choices.values())
+    else:
+        labels, texts = [chr(ord('A') + i) for i in range(len(choices))], list(choices)
+    label = record.get("model_answer") if record.get("model_answer") in labels else record.get("answer_label")
+    return texts, labels.index(label) if label in labels else None
+
+
+def replay_file(
+    path: str,
+    output_path: Optional[str] = None,
+    prompt_type: Optional[str] = None,
+    nli_client=None,
+    entail_mode: str = "both",
+    hypothesis_template: str = HYPOTHESIS_TEMPLATE,
+    entail_threshold: float = ENTAILMENT_THRESHOLD,
+    contradiction_threshold: float = CONTRADICTION_THRESHOLD,
+    near_dup_threshold: Optional[float] = None,
+    coherence: bool = False,
+    workers: Optional[int] = None,
+    chunk_size: int = 256,
+    nli_batch_size: int = 32,
+    contrastive: bool = False
+) -> ExperimentMetrics:
+    """
+    对一个结果文件重新抽取步骤并重新计算蕴含（及可选的对比矩阵、连贯性），写入新的结果文件、同名 .metrics.json 和 .probs.npz。
+    原记录中的对比矩阵与 coherence_info 基于旧步骤，未开启 contrastive / coherence 时重放后不再保留。
+    参数：
+        path: 原结果文件
+        output_path: 新结果文件，默认见 replay_path
+        prompt_type: 抽取使用的 prompt 类型，默认由文件名推断
+        chunk_size: 每次合并 NLI 前向计算的记录数
+        其余参数含义同 compute_entailment_ratio_batch 与各实验脚本
+    返回：
+        重放结果的 ExperimentMetrics，replay 字段记录原结果文件与重放配置
+    """
+    start_time = time.time()
+    prompt_type = prompt_type or infer_prompt_type(path)
+    if prompt_type is None:
+        raise ValueError(f"Cannot infer prompt type from file name: {path}")
+    output_path = output_path or replay_path(path)
+    if os.path.abspath(output_path) == os.path.abspath(path):
+        raise ValueError(f"Replay output would overwrite its input: {path}")
+    identity = experiment_identity(path)
+    if identity is None:
+        raise ValueError(f"Cannot tell the experiment of {path}: no .metrics.json and an unknown file name")
+    if nli_client is None:
+        nli_client = get_nli_client()
+
+    pairs = ((record.get("model_reasoning") or "", prompt_type) for record in iter_result_records(path))
+    records = enumerate(zip(iter_result_records(path), extract_steps_bulk(pairs, workers)))
+
+    sidecar = ProbabilitySidecar(output_path)
+    with ResultWriter(output_path) as writer:
+        for chunk in _chunked(records, chunk_size):
+            batch = []
+            for position, (record, steps) in chunk:
+                # 早期的结果文件没有 row_idx，按行号补上
+                record.setdefault("row_idx", position)
+                removed = 0
+                if near_dup_threshold is not None:
+                    steps, removed = collapse_near_duplicates(steps, near_dup_threshold)
+                record["extracted_steps"] = steps
+                record["near_duplicates_removed"] = removed
+                choice_count = len(record.get("choices") or []) if contrastive else 0
+                record["nli_calls_saved"] = removed * ((entail_mode != "chain") + choice_count + (2 if coherence else 0))
+                batch.append(record)
+
+            infos, raw_probs = compute_entailment_ratio_batch(
+                [(r["extracted_steps"], r.get("used_answer_text") or r.get("answer", "")) for r in batch],
+                nli_client,
+                mode=entail_mode,
+                hypothesis_template=hypothesis_template,
+                entail_threshold=entail_threshold,
+                contradiction_threshold=contradiction_threshold,
+                batch_size=nli_batch_size,
+                return_probs=True
+            )
+            coherence_infos = compute_coherence_batch(
+                [(r["extracted_steps"], r["question"]) for r in batch], nli_client, batch_size=nli_batch_size
+            ) if coherence else [None] * len(batch)
+
+            for record, info, probs, coherence_info in zip(batch, infos, raw_probs, coherence_infos):
+                if contrastive:
+                    texts, chosen_index = _choice_texts(record)
+                    if chosen_index is not None:
+                        info["contrastive"] = compute_choice_matrix(
+                            record["extracted_steps"], texts, chosen_index, nli_client,
+                            hypothesis_template=hypothesis_template)
+                record["entailment_info"] = info
+                sidecar.add(record["row_idx"], record.get("model_answer") == record.get("answer_label"), *probs)
+                if coherence_info is None:
+                    record.pop("coherence_info", None)
+                else:
+                    record["coherence_info"] = coherence_info
+                writer.write(record)
+    sidecar.save()
+
+    summary = summarize_results(iter_result_records(output_path))
+    duration = time.time() - start_time
+    # 重放不调用 LLM，没有 token 用量
+    metrics = ExperimentMetrics(
+        **identity,
+        output_file=output_path,
+        duration=duration,
+        evaluated=summary["sample_size"],
+        timings={"total_seconds": duration, "inference_seconds": 0.0,
+                 "seconds_per_sample": duration / summary["sample_size"] if summary["sample_size"] else None},
+        replay={
+            "source": path,
+            "prompt_type": prompt_type,
+            "entail_mode": entail_mode,
+            "hypothesis_template": hypothesis_template,
+            "entail_threshold": entail_threshold,
+            "contradiction_threshold": contradiction_threshold,
+            "near_dup_threshold": near_dup_threshold,
+            "coherence": coherence,
+            "contrastive": contrastive,
+        },
+        **summary,
+    )
+    save_metrics(metrics, output_path)
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-score saved result files (re-extract steps and re-run NLI) without calling the LLM")
+    parser.add_argument("paths", nargs="+", help="Result JSONL files or directories to scan")
+    parser.add_argument("--output_root", default=REPLAY_ROOT, help="Directory for the replayed result files")
+    parser.add_argument("--prompt_type", choices=["simple", "templated", "natural"],
+                        help="Prompt type (default: inferred from each file name)")
+    parser.add_argument("--entail_mode", choices=list(ENTAIL_MODES), default="both")
+    parser.add_argument("--hypothesis_template", default=HYPOTHESIS_TEMPLATE,
+                        help="NLI hypothesis, with {answer} replaced by the answer text")
+    parser.add_argument("--entail_threshold", type=float, default=ENTAILMENT_THRESHOLD,
+                        help="ENTAILMENT probability at or above which a step entails the answer")
+    parser.add_argument("--contradiction_threshold", type=float, default=CONTRADICTION_THRESHOLD,
+                        help="ENTAILMENT probability at or below which a step contradicts the answer")
+    parser.add_argument("--near_dup_threshold", type=float, default=None,
+                        help="Collapse near-duplicate steps at this word-shingle Jaccard similarity before NLI scoring")
+    parser.add_argument("--coherence", action="store_true", help="Also re-score step-to-step and step-to-question coherence")
+    parser.add_argument("--contrastive", action="store_true", help="Also re-score every step against all answer choices")
+    parser.add_argument("--workers", type=int, default=None, help="Extraction worker processes")
+    parser.add_argument("--chunk_size", type=int, default=256, help="Records scored together in one NLI pass")
+    parser.add_argument("--nli_batch_size", type=int, default=32, help="NLI forward batch size")
+    args = parser.parse_args()
+    if "{answer}" not in args.hypothesis_template:
+        parser.error("--hypothesis_template must contain {answer}")
+
+    output_root = os.path.abspath(args.output_root)
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            # 扫描目录时跳过之前的重放结果
+            files.extend(p for p in iter_result_files(path) if not os.path.abspath(p).startswith(output_root + os.sep))
+        else:
+            files.append(path)
+
+    nli_client = get_nli_client()
+    for path in files:
+        if args.prompt_type is None and infer_prompt_type(path) is None:
+            print(f"Skipping {path}: cannot infer prompt type")
+            continue
+        output_path = replay_path(path, args.output_root)
+        metrics = replay_file(path, output_path, args.prompt_type, nli_client, args.entail_mode,
+                              args.hypothesis_template, args.entail_threshold, args.contradiction_threshold,
+                              args.near_dup_threshold, args.coherence, args.workers, args.chunk_size,
+                              args.nli_batch_size, args.contrastive)
+        print(f"{path} -> {output_path}: {metrics.sample_size} records")
+        for key in RATIO_KEYS:
+            value = getattr(metrics, key)
+            if value is not None:
+                print(f"  {key}: {value:.2%}")
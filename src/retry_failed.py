@@ -0,0 +1,149 @@
+# retry_failed.py
+# 重跑死信文件中的样本：按每条死信记录保存的运行参数，以 resume + only_ids 调用对应的评估函数，
+# 只对失败的样本重新调用 LLM，成功的样本追加进原结果文件（指标、sidecar 与 .metrics.json 随之更新），仍然失败的留在死信文件中。
+# --scan_legacy 先把旧版本当作模型输出写入结果文件的失败字符串移到死信文件，再一并重跑。
+import argparse
+import importlib
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+from src import run_experiments, run_experiments_few_shot
+from src.cot_extraction.corpus import iter_result_files
+from src.evaluation.metrics import ExperimentMetrics
+from src.utils.dead_letter import (
+    LEGACY_FAILURE_OUTPUT,
+    dead_letter_path,
+    find_dead_letter_files,
+    is_dead_letter_file,
+    load_dead_letters,
+    quarantine_legacy_failures,
+    result_file_for,
+)
+from src.utils.nli_client import get_nli_client
+from src.utils.result_io import iter_result_records
+from src.utils.result_parquet import parquet_path, parse_result_name
+
+# (dataset, shot) -> (模块, 评估函数)，与两个运行器使用的评估函数一致
+EVALUATORS = {
+    runner.SCRIPT_PROMPT_STORES[script]: evaluator
+    for runner in (run_experiments, run_experiments_few_shot)
+    for script, evaluator in runner.SCRIPT_EVALUATORS.items()
+}
+
+_SHARDED_RE = re.compile(r'\.shard\d+of\d+\.jsonl$')
+
+
+def legacy_config(result_file: str, entail_mode: str = "both", contrastive: bool = False, coherence: bool = False,
+                  near_dup_threshold: Optional[float] = None) -> Optional[Dict]:
+    """
+    旧结果文件没有保存运行参数：数据集、shot、prompt 类型由文件名解析，模型名按 name:tag 还原（mistral_7b -> mistral:7b），
+    sample_size 取文件中最大的 row_idx + 1，其余参数用命令行给出的值。分片文件的行划分依赖原 sample_size，无法还原，返回 None
+    """
+    meta = parse_result_name(result_file)
+    if meta is None or _SHARDED_RE.search(result_file):
+        return None
+    # 早期的结果文件没有 row_idx，按行号计
+    rows = [record.get("row_idx", position) for position, record in enumerate(iter_result_records(result_file))]
+    if not rows:
+        return None
+    name, _, tag = meta["model"].rpartition("_")
+    return {
+        "dataset": meta["dataset"], "shot": meta["shot"], "model_name": f"{name}:{tag}" if name else tag,
+        "prompt_type": meta["prompt_type"], "sample_size": max(rows) + 1, "entail_mode": entail_mode,
+        "contrastive": contrastive, "coherence": coherence, "near_dup_threshold": near_dup_threshold,
+        "shard_index": 0, "shard_count": 1, "shard_policy": "contiguous",
+    }
+
+
+def retry_dead_letters(path: str, nli_client=None) -> List[ExperimentMetrics]:
+    """
+    重跑一个死信文件中的全部样本；不同运行参数（例如不同 sample_size 的运行追加到同一文件）分组各调用一次评估函数。
+    结果文件已有 Parquet 副本时一并重写。返回每组的 ExperimentMetrics
+    """
+    result_file = result_file_for(path)
+    groups: Dict[str, List[str]] = {}
+    for entry_id, entry in load_dead_letters(path).items():
+        groups.setdefault(json.dumps(entry["config"], sort_keys=True), []).append(entry_id)
+
+    results = []
+    for key, ids in groups.items():
+        config = json.loads(key)
+        module_name, function_name = EVALUATORS[(config["dataset"], config["shot"])]
+        evaluate = getattr(importlib.import_module(module_name), function_name)
+        print(f"Retrying {len(ids)} samples of {result_file}")
+        results.append(evaluate(
+            prompt_type=config["prompt_type"], sample_size=config["sample_size"], model_name=config["model_name"],
+            entail_mode=config["entail_mode"], contrastive=config["contrastive"], coherence=config["coherence"],
+            near_dup_threshold=config["near_dup_threshold"], shard_index=config["shard_index"],
+            shard_count=config["shard_count"], shard_policy=config["shard_policy"], resume=True,
+            parquet=os.path.exists(parquet_path(result_file)), only_ids=set(ids), nli_client=nli_client,
+        ))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-run only the samples whose LLM calls failed and merge them back into their result files")
+    parser.add_argument("paths", nargs="*", default=["outputs"],
+                        help="Dead-letter (.failed.jsonl) files, result files or directories to scan")
+    parser.add_argument("--dry_run", action="store_true", help="Only list the failed samples per file")
+    legacy = parser.add_argument_group(
+        "legacy results (older runs wrote the failure message into the result file as the model output)")
+    legacy.add_argument("--scan_legacy", action="store_true",
+                        help="Move such records from the result files into dead-letter files before retrying")
+    legacy.add_argument("--entail_mode", choices=["step", "chain", "both"], default="both",
+                        help="Entailment mode used to re-score legacy records")
+    legacy.add_argument("--contrastive", action="store_true", help="Re-score legacy records with the choice matrix")
+    legacy.add_argument("--coherence", action="store_true", help="Re-score legacy records with coherence")
+    legacy.add_argument("--near_dup_threshold", type=float, default=None,
+                        help="Near-duplicate threshold used to re-score legacy records")
+    args = parser.parse_args()
+
+    result_files, dead_letter_files = [], []
+    for path in args.paths:
+        if os.path.isdir(path):
+            dead_letter_files.extend(find_dead_letter_files(path))
+            result_files.extend(iter_result_files(path))
+        elif is_dead_letter_file(path):
+            dead_letter_files.append(path)
+        else:
+            result_files.append(path)
+            if os.path.exists(dead_letter_path(path)):
+                dead_letter_files.append(dead_letter_path(path))
+
+    if args.scan_legacy:
+        for result_file in result_files:
+            config = legacy_config(result_file, args.entail_mode, args.contrastive, args.coherence,
+                                   args.near_dup_threshold)
+            if config is None:
+                continue
+            if args.dry_run:
+                moved = sum(1 for record in iter_result_records(result_file)
+                            if record.get("model_reasoning") == LEGACY_FAILURE_OUTPUT)
+                if moved:
+                    print(f"{result_file}: {moved} legacy failure records")
+                continue
+            moved = quarantine_legacy_failures(result_file, config)
+            if moved:
+                print(f"Moved {moved} legacy failure records from {result_file} to {dead_letter_path(result_file)}")
+                dead_letter_files.append(dead_letter_path(result_file))
+
+    dead_letter_files = sorted(set(path for path in dead_letter_files if os.path.exists(path)))
+    if not dead_letter_files:
+        raise SystemExit("No failed samples to retry")
+
+    nli_client = None if args.dry_run else get_nli_client()
+    for path in dead_letter_files:
+        entries = load_dead_letters(path)
+        if args.dry_run:
+            stages = {}
+            for entry in entries.values():
+                stages[entry["stage"]] = stages.get(entry["stage"], 0) + 1
+            print(f"{path}: {len(entries)} failed samples ({', '.join(f'{k}: {v}' for k, v in sorted(stages.items()))})")
+            continue
+        for metrics in retry_dead_letters(path, nli_client):
+            accuracy = f"{metrics.accuracy:.2%}" if metrics.accuracy is not None else "N/A"
+            print(f"{metrics.output_file}: {metrics.evaluated} recovered, {metrics.failed} still failing "
+                  f"(accuracy {accuracy} over {metrics.sample_size} samples)")
@@ -1,4 +1,5 @@
 import argparse
+import importlib
 import subprocess
 import concurrent.futures
 import time
@@ -7,58 +8,103 @@ import sys
 import re
 from datetime import datetime
 import ctypes
+from src.evaluation.human_baseline import human_baseline_ratio
+from src.config import LOG_PATH
+from src.evaluation.metrics import ExperimentMetrics, load_metrics, metrics_path
+from src.evaluation.significance import print_prompt_comparisons
+from src.evaluation.sequential import StoppingRule, add_stopping_arguments, stopping_rule_from_args
+from src.utils.prompt_store import ensure_prompt_store
+from src.utils.result_io import result_path
+from src.utils.shards import shard_suffix
 
-def parse_metrics(output_file):
-    """
-    Parse metrics from output file
-    """
-    metrics = {}
-    try:
-        with open(output_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-            # Parse Accuracy
-            acc_match = re.search(r'Accuracy:\s*([\d.]+)%', content)
-            if acc_match:
-                metrics['accuracy'] = float(acc_match.group(1)) / 100
+# Prompt store (dataset, shot) read by each evaluation script
+SCRIPT_PROMPT_STORES = {
+    "main.py": ("csqa", "zero_shot"),
+    "main_cose_entail.py": ("cose", "zero_shot"),
+}
 
-            # Parse Entailment Ratio
-            ratio_match = re.search(r'Average Entailment Ratio:\s*([\d.]+)%', content)
-            if ratio_match:
-                metrics['entailment_ratio'] = float(ratio_match.group(1)) / 100
-    except Exception as e:
-        print(f"Error parsing metrics: {str(e)}")
-        metrics = {'accuracy': None, 'entailment_ratio': None}
-    
-    return metrics
+# Evaluation function behind each script, called directly by the in-process runner
+SCRIPT_EVALUATORS = {
+    "main.py": ("src.main", "evaluate_csqa_entailment"),
+    "main_cose_entail.py": ("src.main_cose_entail", "evaluate_cose_entailment"),
+}
+
+# tqdm progress lines printed by the evaluation scripts, e.g. "Evaluating:  37%|###7      | 38/103 [...]"
+PROGRESS_RE = re.compile(r'Evaluating:.*?\|\s*(\d+)/(\d+)')
+
+def prepare_prompt_stores(experiments):
+    """Compile each prompt store once (or validate its template hash) before launching the scripts"""
+    for script, prompt_type in experiments:
+        dataset, shot = SCRIPT_PROMPT_STORES[script]
+        ensure_prompt_store(dataset, shot, prompt_type)
 
-def run_experiment(script_name, prompt_type, model_name, sample_size):
+def print_experiment_header(script_name, prompt_type, model_name, sample_size, entail_mode,
+                            shard_index, shard_count, shard_policy):
+    print(f"\n{'='*50}")
+    print(f"Starting {script_name} - {prompt_type}")
+    print(f"Model: {model_name}")
+    print(f"Sample size: {sample_size}")
+    print(f"Entailment mode: {entail_mode}")
+    if shard_count > 1:
+        print(f"Shard: {shard_index} of {shard_count} ({shard_policy})")
+    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+def run_experiment(script_name, prompt_type, model_name, sample_size, entail_mode="both", contrastive=False,
+                   coherence=False, near_dup_threshold=None, shard_index=0, shard_count=1,
+                   shard_policy="contiguous", resume=False, parquet=False, stopping=None, progress_callback=None):
     """
-    Run a single experiment script
+    Run a single experiment script in its own python subprocess (isolation mode)
     
     Parameters:
         script_name: script filename
         prompt_type: prompt type ('templated' or 'natural')
         model_name: model to use (e.g., 'mistral:7b', 'falcon3:7b')
         sample_size: number of samples to evaluate
+        entail_mode: entailment mode ('step', 'chain' or 'both')
+        contrastive: whether to also score every step against all choices
+        coherence: whether to also score step-to-step and step-to-question coherence
+        near_dup_threshold: Jaccard threshold for collapsing near-duplicate steps (None disables it)
+        shard_index, shard_count, shard_policy: evaluate only this shard of the first sample_size rows
+        resume: skip samples already in the result file and append to it
+        parquet: also write a zstd-compressed Parquet copy of the result file
+        stopping: StoppingRule for adaptive sampling (random order, early stop); sample_size becomes an upper bound
+        progress_callback: called as progress_callback(done, total) for every progress line of the script
     Returns:
-        metrics: dictionary containing accuracy and entailment ratio
+        metrics: ExperimentMetrics read from the <result>.metrics.json file written by the script
     """
     start_time = time.time()
-    print(f"\n{'='*50}")
-    print(f"Starting {script_name} - {prompt_type}")
-    print(f"Model: {model_name}")
-    print(f"Sample size: {sample_size}")
-    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print_experiment_header(script_name, prompt_type, model_name, sample_size, entail_mode,
+                            shard_index, shard_count, shard_policy)
     
-    # Create temporary output file
-    output_file = f"temp_output_{script_name.replace('.py', '')}_{prompt_type}_{model_name.replace(':', '_')}.txt"
+    dataset, shot = SCRIPT_PROMPT_STORES[script_name]
+    result_file = result_path(dataset, shot, model_name, prompt_type, shard_index, shard_count)
+    # The script's output is streamed to a log file instead of being kept in memory
+    log_file = os.path.join(LOG_PATH, f"{script_name[:-3]}_{prompt_type}_{model_name.replace(':', '_')}"
+                                      f"{shard_suffix(shard_index, shard_count)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    metrics = None
     
     try:
+        # A metrics file left by an earlier run must not be mistaken for the result of this one
+        if os.path.exists(metrics_path(result_file)):
+            os.remove(metrics_path(result_file))
+        os.makedirs(LOG_PATH, exist_ok=True)
+        
         # Set environment variables to pass parameters
         env = os.environ.copy()
         env["PROMPT_TYPE"] = prompt_type
         env["MODEL_NAME"] = model_name
         env["SAMPLE_SIZE"] = str(sample_size)
+        env["ENTAIL_MODE"] = entail_mode
+        env["CONTRASTIVE"] = "1" if contrastive else "0"
+        env["COHERENCE"] = "1" if coherence else "0"
+        env["NEAR_DUP_THRESHOLD"] = "" if near_dup_threshold is None else str(near_dup_threshold)
+        env["SHARD_INDEX"] = str(shard_index)
+        env["SHARD_COUNT"] = str(shard_count)
+        env["SHARD_POLICY"] = shard_policy
+        env["RESUME"] = "1" if resume else "0"
+        env["OUTPUT_PARQUET"] = "1" if parquet else "0"
+        # Always set every STOP_* variable so an inherited rule never leaks into the script
+        env.update((stopping or StoppingRule()).to_env())
         env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         
         # Set PYTHONUNBUFFERED=1 to ensure Python doesn't buffer output
@@ -84,38 +130,35 @@ def run_experiment(script_name, prompt_type, model_name, sample_size):
             creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if os.name == 'nt' else 0
         )
         
-        # Save output for later metric parsing
-        output_lines = []
-        
-        # Read and display output in real-time
-        while True:
-            line = process.stdout.readline()
-            if not line and process.poll() is not None:
-                break
-            if line:
-                # Save output
-                output_lines.append(line)
-                # Display output in real-time
-                print(line, end='', flush=True)
+        # Read and display output in real-time, writing each line to the log as it arrives
+        with open(log_file, 'w', encoding='utf-8', buffering=1) as log:
+            while True:
+                line = process.stdout.readline()
+                if not line and process.poll() is not None:
+                    break
+                if line:
+                    log.write(line)
+                    progress_match = PROGRESS_RE.search(line)
+                    if progress_callback is not None and progress_match:
+                        progress_callback(int(progress_match.group(1)), int(progress_match.group(2)))
+                    # Display output in real-time
+                    print(line, end='', flush=True)
         
         # Wait for process to complete
         process.wait()
         
-        # Save complete output to file
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.writelines(output_lines)
-        
         if process.returncode == 0:
             print(f"\n{script_name} - {prompt_type} executed successfully")
         else:
             print(f"\n{script_name} - {prompt_type} execution failed (return code: {process.returncode})")
+        print(f"Log saved to: {log_file}")
         
-        # Parse metrics
-        metrics = parse_metrics(output_file)
+        metrics = load_metrics(result_file)
+        if metrics is None:
+            print(f"{script_name} - {prompt_type} wrote no metrics file ({metrics_path(result_file)})")
         
     except Exception as e:
         print(f"\nError executing {script_name}: {str(e)}")
-        metrics = {'accuracy': None, 'entailment_ratio': None}
     
     end_time = time.time()
     duration = end_time - start_time
@@ -123,14 +166,58 @@ def run_experiment(script_name, prompt_type, model_name, sample_size):
     print(f"End time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print('='*50)
     
-    # Clean up temporary file
+    if metrics is None:
+        metrics = ExperimentMetrics(dataset=dataset, shot=shot, prompt_type=prompt_type, model_name=model_name,
+                                    sample_size=sample_size, output_file=result_file)
+    # Wall time of the whole subprocess; the script's own timings stay in metrics.timings
+    metrics.duration = duration
+    return metrics
+
+def run_experiment_in_process(script_name, prompt_type, model_name, sample_size, entail_mode="both",
+                              contrastive=False, coherence=False, near_dup_threshold=None, shard_index=0,
+                              shard_count=1, shard_policy="contiguous", resume=False, parquet=False, stopping=None,
+                              nli_client=None, progress_callback=None):
+    """
+    Run a single experiment by calling its evaluation function in this process.
+    The memory-mapped datasets and the NLI model are loaded once and shared by every call.
+    
+    Parameters:
+        same as run_experiment, plus
+        nli_client: shared NLI client (None uses the process-wide singleton)
+        progress_callback: called as progress_callback(done, total) after every evaluated sample
+    Returns:
+        metrics: ExperimentMetrics returned by the evaluation function
+    """
+    start_time = time.time()
+    print_experiment_header(script_name, prompt_type, model_name, sample_size, entail_mode,
+                            shard_index, shard_count, shard_policy)
+    
+    module_name, function_name = SCRIPT_EVALUATORS[script_name]
     try:
-        os.remove(output_file)
-    except:
-        pass
+        evaluate = getattr(importlib.import_module(module_name), function_name)
+        metrics = evaluate(prompt_type=prompt_type, sample_size=sample_size, model_name=model_name,
+                           entail_mode=entail_mode, contrastive=contrastive, coherence=coherence,
+                           near_dup_threshold=near_dup_threshold, shard_index=shard_index,
+                           shard_count=shard_count, shard_policy=shard_policy, resume=resume, parquet=parquet,
+                           stopping=stopping, nli_client=nli_client,
+                           progress_callback=progress_callback)
+        print(f"\n{script_name} - {prompt_type} executed successfully")
+    except Exception as e:
+        print(f"\nError executing {script_name}: {str(e)}")
+        dataset, shot = SCRIPT_PROMPT_STORES[script_name]
+        metrics = ExperimentMetrics(dataset=dataset, shot=shot, prompt_type=prompt_type, model_name=model_name)
     
+    duration = time.time() - start_time
+    print(f"Execution time: {duration:.2f} seconds")
+    print(f"End time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print('='*50)
     return metrics
 
+def load_shared_nli_client():
+    """Load the NLI model once for all in-process experiments (imported lazily so isolation mode never loads torch here)"""
+    from src.utils.nli_client import get_nli_client
+    return get_nli_client()
+
 def print_summary(all_results, model_name, sample_size):
     """
     Print summary of all experiment results
@@ -140,21 +227,33 @@ def print_summary(all_results, model_name, sample_size):
     print(f"Model: {model_name}")
     print(f"Sample size: {sample_size}")
     print("="*80)
-    print(f"{'Dataset':<15} {'Prompt Type':<12} {'Accuracy':<12} {'Entailment Ratio':<15}")
+    print(f"{'Dataset':<15} {'Prompt Type':<12} {'Accuracy':<12} {'Entailment Ratio':<18} {'Coherence':<12}")
     print("-"*80)
     
     for script in ['main.py', 'main_cose_entail.py']:
         dataset = "CommonsenseQA" if script == "main.py" else "CoS-E"
         for prompt_type in ['simple', 'templated', 'natural']:
             metrics = all_results[f"{script}_{prompt_type}"]
-            acc = f"{metrics['accuracy']*100:.2f}%" if metrics['accuracy'] is not None else "N/A"
-            ratio = f"{metrics['entailment_ratio']*100:.2f}%" if metrics['entailment_ratio'] is not None else "N/A"
-            print(f"{dataset:<15} {prompt_type:<12} {acc:<12} {ratio:<15}")
+            acc = f"{metrics.accuracy*100:.2f}%" if metrics.accuracy is not None else "N/A"
+            ratio = f"{metrics.entailment_ratio*100:.2f}%" if metrics.entailment_ratio is not None else "N/A"
+            coherence = f"{metrics.coherence*100:.2f}%" if metrics.coherence is not None else "N/A"
+            print(f"{dataset:<15} {prompt_type:<12} {acc:<12} {ratio:<18} {coherence:<12}")
+    
+    # CoS-E human explanation baseline (built once by `python -m src.evaluation.human_baseline`)
+    human_ratio = human_baseline_ratio("validation")
+    if human_ratio is not None:
+        print("-"*80)
+        print(f"{'CoS-E':<15} {'human':<12} {'-':<12} {human_ratio*100:.2f}%")
     
     print("="*80)
+    
+    # Paired bootstrap between prompt types, aligned by sample id from the result files
+    print_prompt_comparisons(all_results.values())
 
-def run_sequential(model_name, sample_size):
-    """Execute all experiments sequentially"""
+def run_sequential(model_name, sample_size, entail_mode="both", contrastive=False, coherence=False,
+                   near_dup_threshold=None, shard_index=0, shard_count=1, shard_policy="contiguous", resume=False,
+                   parquet=False, stopping=None, isolate=False):
+    """Execute all experiments sequentially (in this process unless isolate=True)"""
     experiments = [
         ("main.py", "simple"),
         ("main.py", "templated"),
@@ -168,10 +267,19 @@ def run_sequential(model_name, sample_size):
     print(f"Model: {model_name}")
     print(f"Sample size: {sample_size}")
     total_start = time.time()
+    prepare_prompt_stores(experiments)
     
     all_results = {}
+    nli_client = None if isolate else load_shared_nli_client()
     for script, prompt_type in experiments:
-        metrics = run_experiment(script, prompt_type, model_name, sample_size)
+        if isolate:
+            metrics = run_experiment(script, prompt_type, model_name, sample_size, entail_mode, contrastive,
+                                     coherence, near_dup_threshold, shard_index, shard_count, shard_policy,
+                                     resume, parquet, stopping)
+        else:
+            metrics = run_experiment_in_process(script, prompt_type, model_name, sample_size, entail_mode,
+                                                contrastive, coherence, near_dup_threshold, shard_index,
+                                                shard_count, shard_policy, resume, parquet, stopping, nli_client)
         all_results[f"{script}_{prompt_type}"] = metrics
     
     total_end = time.time()
@@ -180,8 +288,13 @@ def run_sequential(model_name, sample_size):
     # Print summary results
     print_summary(all_results, model_name, sample_size)
 
-def run_parallel(model_name, sample_size):
-    """Execute all experiments in parallel"""
+def run_parallel(model_name, sample_size, entail_mode="both", contrastive=False, coherence=False,
+                 near_dup_threshold=None, shard_index=0, shard_count=1, shard_policy="contiguous", resume=False,
+                 parquet=False, stopping=None, isolate=False):
+    """
+    Execute all experiments in parallel: threads sharing one NLI model in this process,
+    or one subprocess per experiment when isolate=True
+    """
     experiments = [
         ("main.py", "simple"),
         ("main.py", "templated"),
@@ -195,11 +308,23 @@ def run_parallel(model_name, sample_size):
     print(f"Model: {model_name}")
     print(f"Sample size: {sample_size}")
     total_start = time.time()
+    prepare_prompt_stores(experiments)
     
     all_results = {}
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    if isolate:
+        executor = concurrent.futures.ProcessPoolExecutor()
+        extra_args = ()
+        target = run_experiment
+    else:
+        # LLM calls are I/O bound, so threads overlap them while sharing one copy of the NLI model
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(experiments))
+        extra_args = (load_shared_nli_client(),)
+        target = run_experiment_in_process
+    with executor:
         future_to_exp = {
-            executor.submit(run_experiment, script, prompt_type, model_name, sample_size): (script, prompt_type)
+            executor.submit(target, script, prompt_type, model_name, sample_size, entail_mode,
+                            contrastive, coherence, near_dup_threshold, shard_index, shard_count,
+                            shard_policy, resume, parquet, stopping, *extra_args): (script, prompt_type)
             for script, prompt_type in experiments
         }
         
@@ -210,10 +335,10 @@ def run_parallel(model_name, sample_size):
                 all_results[f"{script}_{prompt_type}"] = metrics
             except Exception as e:
                 print(f"Error generating results for {script} - {prompt_type}: {str(e)}")
-                all_results[f"{script}_{prompt_type}"] = {
-                    'accuracy': None,
-                    'entailment_ratio': None
-                }
+                dataset, shot = SCRIPT_PROMPT_STORES[script]
+                all_results[f"{script}_{prompt_type}"] = ExperimentMetrics(dataset=dataset, shot=shot,
+                                                                           prompt_type=prompt_type,
+                                                                           model_name=model_name)
     
     total_end = time.time()
     print(f"\nAll experiments completed! Total time: {(total_end - total_start):.2f} seconds")
@@ -230,14 +355,24 @@ def get_script_by_dataset(dataset):
     else:
         raise ValueError(f"Unknown dataset: {dataset}")
 
-def run_single_task(dataset, prompt_type, model_name, sample_size):
+def run_single_task(dataset, prompt_type, model_name, sample_size, entail_mode="both", contrastive=False, coherence=False,
+                    near_dup_threshold=None, shard_index=0, shard_count=1, shard_policy="contiguous", resume=False,
+                    parquet=False, stopping=None, isolate=False):
     """Run a single specified task"""
     try:
         script = get_script_by_dataset(dataset)
+        prepare_prompt_stores([(script, prompt_type)])
         print(f"\nStarting single task: {dataset} - {prompt_type}")
         print(f"Model: {model_name}")
         print(f"Sample size: {sample_size}")
-        metrics = run_experiment(script, prompt_type, model_name, sample_size)
+        if isolate:
+            metrics = run_experiment(script, prompt_type, model_name, sample_size, entail_mode, contrastive,
+                                     coherence, near_dup_threshold, shard_index, shard_count, shard_policy,
+                                     resume, parquet, stopping)
+        else:
+            metrics = run_experiment_in_process(script, prompt_type, model_name, sample_size, entail_mode,
+                                                contrastive, coherence, near_dup_threshold, shard_index,
+                                                shard_count, shard_policy, resume, parquet, stopping)
         
         # Print single task result summary
         print("\n" + "="*80)
@@ -247,8 +382,12 @@ def run_single_task(dataset, prompt_type, model_name, sample_size):
         print("="*80)
         print(f"Dataset: {dataset}")
         print(f"Prompt Type: {prompt_type}")
-        print(f"Accuracy: {metrics['accuracy']*100:.2f}%" if metrics['accuracy'] is not None else "Accuracy: N/A")
-        print(f"Entailment Ratio: {metrics['entailment_ratio']*100:.2f}%" if metrics['entailment_ratio'] is not None else "Entailment Ratio: N/A")
+        print(f"Accuracy: {metrics.accuracy*100:.2f}%" if metrics.accuracy is not None else "Accuracy: N/A")
+        print(f"Entailment Ratio: {metrics.entailment_ratio*100:.2f}%" if metrics.entailment_ratio is not None else "Entailment Ratio: N/A")
+        if metrics.coherence is not None:
+            print(f"Coherence: {metrics.coherence*100:.2f}%")
+        if metrics.failed:
+            print(f"Failed samples: {metrics.failed} (not counted; re-run them with python -m src.retry_failed)")
         print("="*80)
         
     except Exception as e:
@@ -284,14 +423,82 @@ if __name__ == "__main__":
         default=103,
         help="Number of samples to evaluate for each dataset"
     )
+    parser.add_argument(
+        "--entail_mode",
+        choices=["step", "chain", "both"],
+        default="both",
+        help="Entailment mode: step(per-step ratio), chain(one NLI call per sample) or both"
+    )
+    parser.add_argument(
+        "--contrastive",
+        action="store_true",
+        help="Also score every step against all answer choices (steps x choices matrix)"
+    )
+    parser.add_argument(
+        "--coherence",
+        action="store_true",
+        help="Also score coherence between consecutive steps and between each step and the question"
+    )
+    parser.add_argument(
+        "--near_dup_threshold",
+        type=float,
+        default=None,
+        help="Collapse near-duplicate steps whose word-shingle Jaccard similarity reaches this threshold before NLI scoring"
+    )
+    parser.add_argument(
+        "--shard_index", "--shard-index",
+        type=int,
+        default=0,
+        help="Index of the shard of the first sample_size rows evaluated by this run (0-based)"
+    )
+    parser.add_argument(
+        "--shard_count", "--shard-count",
+        type=int,
+        default=1,
+        help="Total number of shards; each shard writes its own result file (merge with python -m src.utils.shards)"
+    )
+    parser.add_argument(
+        "--shard_policy", "--shard-policy",
+        choices=["contiguous", "strided"],
+        default="contiguous",
+        help="Shard rows as contiguous ranges or every shard_count-th row"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip samples whose id is already in the result file, append the rest and recompute the metrics from the file"
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also write each result file as zstd-compressed Parquet (read selected columns with src.utils.result_parquet)"
+    )
+    parser.add_argument(
+        "--isolate",
+        action="store_true",
+        help="Run each experiment as a separate python subprocess instead of in this process "
+             "(slower: every subprocess reloads torch, the datasets and the NLI model)"
+    )
+    
+    add_stopping_arguments(parser)
     
     args = parser.parse_args()
+    stopping = stopping_rule_from_args(args)
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard_index must be in [0, --shard_count)")
     
     if args.mode == "single":
         if not args.dataset or not args.prompt_type:
             parser.error("In single mode, both --dataset and --prompt_type parameters must be specified")
-        run_single_task(args.dataset, args.prompt_type, args.model, args.sample_size)
+        run_single_task(args.dataset, args.prompt_type, args.model, args.sample_size,
+                        args.entail_mode, args.contrastive, args.coherence, args.near_dup_threshold,
+                        args.shard_index, args.shard_count, args.shard_policy,
+                        args.resume, args.parquet, stopping, args.isolate)
     elif args.mode == "parallel":
-        run_parallel(args.model, args.sample_size)
+        run_parallel(args.model, args.sample_size, args.entail_mode, args.contrastive, args.coherence,
+                     args.near_dup_threshold, args.shard_index, args.shard_count, args.shard_policy, args.resume,
+                     args.parquet, stopping, args.isolate)
     else:  # sequential
-        run_sequential(args.model, args.sample_size) 
\ No newline at end of file
+        run_sequential(args.model, args.sample_size, args.entail_mode, args.contrastive, args.coherence,
+                       args.near_dup_threshold, args.shard_index, args.shard_count, args.shard_policy, args.resume,
+                       args.parquet, stopping, args.isolate) 
\ No newline at end of file
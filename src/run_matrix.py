@@ -0,0 +1,439 @@
+# run_matrix.py
+# 完整实验矩阵（数据集 × shot × prompt 类型 × 模型）的调度器：每个实验声明所需资源（Ollama 端点的 LLM 槽位、NLI 显存、CPU 核），
+# 资源池放得下时立即开始，同一进程内的实验共享一个 NLI 模型；可选按墙钟预算分段运行（见 planner）与增量重跑（见 pipeline_dag）。
+import argparse
+import concurrent.futures
+import json
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+from src import run_experiments, run_experiments_few_shot
+from src.config import LOG_PATH
+from src.evaluation.metrics import ExperimentMetrics
+from src.evaluation.significance import print_prompt_comparisons
+from src.evaluation.sequential import add_stopping_arguments, stopping_rule_from_args
+from src.inference.infer import ollama_endpoint
+from src.pipeline_dag import ExperimentDag
+from src.planner import BudgetPlanner, parse_duration
+from src.utils.prompt_store import PROMPT_BUILDERS
+from src.utils.result_io import iter_result_records, result_path
+from src.utils.shards import summarize_results
+
+# (dataset, shot) -> (运行器模块, 脚本)，覆盖 run_experiments.py 与 run_experiments_few_shot.py
+MATRIX_RUNNERS = {
+    key: (runner, script)
+    for runner in (run_experiments, run_experiments_few_shot)
+    for script, key in runner.SCRIPT_PROMPT_STORES.items()
+}
+
+# roberta-large-mnli 权重加运行时开销；同一进程内只占一次，--isolate 时每个子进程各占一次
+NLI_MODEL_MEMORY_GB = 1.5
+# 在已加载模型之外，单个实验的 NLI 批次所需的激活内存
+NLI_BATCH_MEMORY_GB = 0.5
+
+
+@dataclass(frozen=True)
+class ResourceNeeds:
+    """实验在整个运行期间占用的资源"""
+    endpoint: str
+    llm_slots: int = 1
+    nli_memory_gb: float = NLI_BATCH_MEMORY_GB
+    cpu_cores: int = 1
+
+
+@dataclass
+class MatrixJob:
+    dataset: str
+    shot: str
+    prompt_type: str
+    model_name: str
+    needs: ResourceNeeds
+    state: str = "pending"
+    done: int = 0
+    total: int = 0
+    started: float = None
+    finished: float = None
+    metrics: ExperimentMetrics = None
+
+    @property
+    def name(self):
+        return f"{self.dataset}/{self.shot}/{self.prompt_type}/{self.model_name}"
+
+    def update_progress(self, done, total):
+        # 由工作线程调用；状态循环只读取这两个属性，普通赋值即可
+        self.done, self.total = done, total
+
+    def seconds_per_item(self):
+        if self.started is None or self.done == 0:
+            return None
+        return ((self.finished or time.time()) - self.started) / self.done
+
+    def eta(self, fallback_rate=None):
+        """剩余秒数：实验有进度后按自身速率估计，否则按同一模型其他实验的速率"""
+        if self.state in ("done", "failed"):
+            return 0.0
+        rate = self.seconds_per_item() or fallback_rate
+        if rate is None or not self.total:
+            return None
+        return rate * (self.total - self.done)
+
+
+class ResourcePool:
+    """
+    并发实验的准入控制：每个 Ollama 端点的 LLM 槽位、NLI 内存与 CPU 核。
+    只有调度线程申请和释放资源，不需要加锁
+    """
+
+    def __init__(self, llm_slots, nli_memory_gb, cpu_cores):
+        self.capacity = {"llm_slots": dict(llm_slots), "nli_memory_gb": nli_memory_gb, "cpu_cores": cpu_cores}
+        self.free_llm_slots = dict(llm_slots)
+        self.free_nli_memory_gb = nli_memory_gb
+        self.free_cpu_cores = cpu_cores
+
+    def fits(self, needs):
+        """资源池空闲时能否容纳该实验"""
+        return (needs.llm_slots <= self.capacity["llm_slots"].get(needs.endpoint, 0)
+                and needs.nli_memory_gb <= self.capacity["nli_memory_gb"]
+                and needs.cpu_cores <= self.capacity["cpu_cores"])
+
+    def try_acquire(self, needs):
+        if (needs.llm_slots > self.free_llm_slots.get(needs.endpoint, 0)
+                or needs.nli_memory_gb > self.free_nli_memory_gb
+                or needs.cpu_cores > self.free_cpu_cores):
+            return False
+        self.free_llm_slots[needs.endpoint] -= needs.llm_slots
+        self.free_nli_memory_gb -= needs.nli_memory_gb
+        self.free_cpu_cores -= needs.cpu_cores
+        return True
+
+    def release(self, needs):
+        self.free_llm_slots[needs.endpoint] += needs.llm_slots
+        self.free_nli_memory_gb += needs.nli_memory_gb
+        self.free_cpu_cores += needs.cpu_cores
+
+    def describe(self):
+        slots = ", ".join(f"{endpoint} {free}/{self.capacity['llm_slots'][endpoint]}"
+                          for endpoint, free in self.free_llm_slots.items())
+        return (f"LLM slots: {slots} | NLI memory: {self.free_nli_memory_gb:.1f}/"
+                f"{self.capacity['nli_memory_gb']:.1f} GB | CPU cores: {self.free_cpu_cores}/{self.capacity['cpu_cores']}")
+
+
+def build_matrix(datasets, shots, prompt_types, models, sample_size, isolate=False, job_cpu_cores=1):
+    """把 数据集 × shot × prompt 类型 × 模型 展开成实验列表，跳过没有对应 prompt 模板的组合"""
+    nli_memory_gb = NLI_MODEL_MEMORY_GB + NLI_BATCH_MEMORY_GB if isolate else NLI_BATCH_MEMORY_GB
+    jobs = []
+    for dataset in datasets:
+        for shot in shots:
+            for prompt_type in prompt_types:
+                if (dataset, shot, prompt_type) not in PROMPT_BUILDERS:
+                    continue
+                for model_name in models:
+                    needs = ResourceNeeds(endpoint=ollama_endpoint(model_name), nli_memory_gb=nli_memory_gb,
+                                          cpu_cores=job_cpu_cores)
+                    jobs.append(MatrixJob(dataset, shot, prompt_type, model_name, needs, total=sample_size))
+    return jobs
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+def model_rates(jobs):
+    """每个模型在已有进度的实验上的平均每样本秒数"""
+    rates = {}
+    for job in jobs:
+        rate = job.seconds_per_item()
+        if rate is not None:
+            rates.setdefault(job.model_name, []).append(rate)
+    return {model: sum(values) / len(values) for model, values in rates.items()}
+
+
+def print_status(jobs, pool, planner=None):
+    rates = model_rates(jobs)
+    print("\n" + "-"*80)
+    print(f"Matrix status at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(pool.describe())
+    if planner is not None:
+        print(planner.summary())
+    # 有预算时 Progress 与 ETA 指当前这一段，Plan 指整个实验
+    plan_header = f" {'Plan (± pts)':<16}" if planner is not None else ""
+    print(f"{'Job':<44} {'State':<9} {'Progress':<12} {'Elapsed':<10} {'ETA':<10}{plan_header}")
+    for job in jobs:
+        elapsed = None if job.started is None else (job.finished or time.time()) - job.started
+        progress = f"{job.done}/{job.total}" if job.total else "-"
+        plan = f" {planner.describe(job):<16}" if planner is not None else ""
+        print(f"{job.name:<44} {job.state:<9} {progress:<12} {format_seconds(elapsed):<10} "
+              f"{format_seconds(job.eta(rates.get(job.model_name))):<10}{plan}")
+    print("-"*80)
+
+
+def metrics_from_file(job):
+    """实验未再运行任何一段就结束时，由其已有的结果文件重新计算指标"""
+    output_file = result_path(job.dataset, job.shot, job.model_name, job.prompt_type)
+    return ExperimentMetrics(dataset=job.dataset, shot=job.shot, prompt_type=job.prompt_type,
+                             model_name=job.model_name, output_file=output_file,
+                             **summarize_results(iter_result_records(output_file)))
+
+
+def refresh_stale_stages(jobs, dag, sample_size):
+    """
+    把每个实验不需要 LLM 的阶段更新到最新（重新抽取步骤、重跑 NLI、重算指标），返回仍需调用 LLM 的实验；
+    其余实验标记为 cached 并载入指标。重算使用本进程的 NLI 单例，之后进程内运行的实验共享它
+    """
+    queued = []
+    for job in jobs:
+        plan = dag.prepare(job.dataset, job.shot, job.prompt_type, job.model_name, sample_size)
+        print(f"  {job.name:<44} {plan.describe()}")
+        if plan.llm is None:
+            job.state, job.metrics = "cached", plan.metrics
+        else:
+            queued.append(job)
+    return queued
+
+
+def run_job(job, sample_size, entail_mode, contrastive, coherence, near_dup_threshold, resume, parquet, stopping,
+            isolate, nli_client):
+    runner, script = MATRIX_RUNNERS[(job.dataset, job.shot)]
+    if isolate:
+        return runner.run_experiment(script, job.prompt_type, job.model_name, sample_size, entail_mode, contrastive,
+                                     coherence, near_dup_threshold, resume=resume,
+                                     parquet=parquet, stopping=stopping, progress_callback=job.update_progress)
+    return runner.run_experiment_in_process(script, job.prompt_type, job.model_name, sample_size, entail_mode,
+                                            contrastive, coherence, near_dup_threshold, resume=resume,
+                                            parquet=parquet, stopping=stopping, nli_client=nli_client, progress_callback=job.update_progress)
+
+
+def run_matrix(jobs, pool, sample_size, entail_mode="both", contrastive=False, coherence=False,
+               near_dup_threshold=None, resume=False, parquet=False, stopping=None, isolate=False,
+               status_interval=60, planner=None):
+    """
+    资源池放得下实验声明的资源时立即运行该实验。等待中的实验按矩阵顺序首次适配准入，
+    等待繁忙端点的实验不会挡住使用其他端点的实验。
+    传入 BudgetPlanner 时每个实验改为分段续跑：每段结束后释放资源、带着规划器给出的下一段样本数回到队尾，
+    直到达到计划或预算用完
+    """
+    for job in jobs:
+        if not pool.fits(job.needs):
+            raise ValueError(f"{job.name} needs {job.needs}, more than the pool provides ({pool.describe()})")
+
+    # 预先编译全部 prompt 存储，避免并发实验同时写同一个文件
+    for job in jobs:
+        runner, script = MATRIX_RUNNERS[(job.dataset, job.shot)]
+        runner.prepare_prompt_stores([(script, job.prompt_type)])
+
+    nli_client = None if isolate else run_experiments.load_shared_nli_client()
+    pending = list(jobs)
+    running = {}
+    segment_started = {}
+    last_status = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs) or 1) as executor:
+        while pending or running:
+            for job in list(pending):
+                target = sample_size if planner is None else planner.next_target(job)
+                if target is None:
+                    # 排队期间已达到计划（或预算用完）
+                    pending.remove(job)
+                    job.finished = time.time()
+                    if job.metrics is None and planner.has_results(job):
+                        job.metrics = metrics_from_file(job)
+                    job.state = "done" if job.metrics is not None else "skipped"
+                    continue
+                if pool.try_acquire(job.needs):
+                    pending.remove(job)
+                    job.state, job.total = "running", target
+                    job.started = job.started or time.time()
+                    # 之后的各段总是追加到前面各段的结果文件
+                    job_resume = resume or (planner is not None and planner.has_results(job))
+                    future = executor.submit(run_job, job, target, entail_mode, contrastive, coherence,
+                                             near_dup_threshold, job_resume, parquet, stopping, isolate, nli_client)
+                    running[future] = job
+                    segment_started[job.name] = time.time()
+
+            finished, _ = concurrent.futures.wait(running, timeout=status_interval,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                pool.release(job.needs)
+                job.finished = time.time()
+                try:
+                    job.metrics = future.result()
+                    job.state = "done" if job.metrics.accuracy is not None else "failed"
+                except Exception as e:
+                    print(f"Error running {job.name}: {str(e)}")
+                    job.metrics = ExperimentMetrics(dataset=job.dataset, shot=job.shot,
+                                                    prompt_type=job.prompt_type, model_name=job.model_name)
+                    job.state = "failed"
+                job.metrics.duration = job.finished - job.started
+                if planner is not None and job.state == "done":
+                    planner.record_segment(job, job.metrics, job.finished - segment_started[job.name])
+                    if planner.next_target(job) is not None:
+                        job.state, job.finished = "pending", None
+                        pending.append(job)
+
+            if finished or time.time() - last_status >= status_interval:
+                print_status(jobs, pool, planner)
+                last_status = time.time()
+    return jobs
+
+
+def print_matrix_summary(jobs):
+    print("\n" + "="*100)
+    print("Experiment Matrix Summary")
+    print("="*100)
+    print(f"{'Dataset':<8} {'Shot':<10} {'Prompt Type':<12} {'Model':<14} {'State':<8} {'Accuracy':<10} "
+          f"{'Entailment Ratio':<18} {'Duration':<10}")
+    print("-"*100)
+    for job in jobs:
+        metrics = job.metrics
+        acc = f"{metrics.accuracy*100:.2f}%" if metrics and metrics.accuracy is not None else "N/A"
+        ratio = f"{metrics.entailment_ratio*100:.2f}%" if metrics and metrics.entailment_ratio is not None else "N/A"
+        duration = format_seconds(metrics.duration if metrics else None)
+        print(f"{job.dataset:<8} {job.shot:<10} {job.prompt_type:<12} {job.model_name:<14} {job.state:<8} "
+              f"{acc:<10} {ratio:<18} {duration:<10}")
+    print("="*100)
+    print_prompt_comparisons(job.metrics for job in jobs if job.metrics)
+
+
+def save_matrix_summary(jobs, log_dir=LOG_PATH, planner=None):
+    os.makedirs(log_dir, exist_ok=True)
+    path = os.path.join(log_dir, f"matrix_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([{"job": job.name, "state": job.state, "needs": job.needs.__dict__,
+                    "metrics": job.metrics.to_dict() if job.metrics else None,
+                    "plan": planner.to_dict(job) if planner is not None and job.name in planner.cells else None} for job in jobs], f, indent=2)
+    return path
+
+
+def parse_key_values(entries, value_type=str):
+    """解析重复给出的 KEY=VALUE 参数；键本身可能含 ':'（模型名）或 '://'（URL）"""
+    parsed = {}
+    for entry in entries:
+        key, sep, value = entry.rpartition("=")
+        if not sep or not key:
+            raise argparse.ArgumentTypeError(f"Expected KEY=VALUE, got {entry}")
+        parsed[key] = value_type(value)
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the dataset x shot x prompt type x model experiment matrix under resource limits")
+    parser.add_argument("--datasets", nargs="+", choices=["csqa", "cose"], default=["csqa", "cose"])
+    parser.add_argument("--shots", nargs="+", choices=["zero_shot", "few_shot"], default=["zero_shot", "few_shot"])
+    parser.add_argument("--prompt_types", nargs="+", choices=["simple", "templated", "natural"],
+                        default=["simple", "templated", "natural"],
+                        help="Prompt types (combinations without a template, e.g. few-shot simple, are skipped)")
+    parser.add_argument("--models", nargs="+", choices=["mistral:7b", "falcon3:7b"], default=["mistral:7b"])
+    parser.add_argument("--sample_size", type=int, default=103,
+                        help="Number of samples to evaluate for each job (the per-job cap with --time_budget)")
+    parser.add_argument("--entail_mode", choices=["step", "chain", "both"], default="both")
+    parser.add_argument("--contrastive", action="store_true", help="Also score every step against all answer choices")
+    parser.add_argument("--coherence", action="store_true", help="Also score step-to-step and step-to-question coherence")
+    parser.add_argument("--near_dup_threshold", type=float, default=None,
+                        help="Collapse near-duplicate steps at this word-shingle Jaccard similarity before NLI scoring")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip samples already in each job's result file (re-running the matrix after a crash)")
+    parser.add_argument("--parquet", action="store_true",
+                        help="Also write each job's result file as zstd-compressed Parquet")
+    parser.add_argument("--endpoint", action="append", default=[], metavar="MODEL=URL",
+                        help="Ollama endpoint serving MODEL (repeatable; default: config.MODEL_PATH)")
+    parser.add_argument("--llm_slots", type=int, default=1,
+                        help="Concurrent generations allowed per endpoint (match OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--endpoint_slots", action="append", default=[], metavar="URL=N",
+                        help="Override --llm_slots for one endpoint (repeatable)")
+    parser.add_argument("--nli_memory_gb", type=float, default=4.0,
+                        help="Memory available to the NLI model and its batches (GPU memory when running on CUDA)")
+    parser.add_argument("--cpu_cores", type=int, default=os.cpu_count() or 1, help="CPU cores available to jobs")
+    parser.add_argument("--job_cpu_cores", type=int, default=1, help="CPU cores declared by each job")
+    parser.add_argument("--isolate", action="store_true",
+                        help="Run each job as a python subprocess; each then declares a full NLI model of memory")
+    parser.add_argument("--status_interval", type=float, default=60, help="Seconds between status tables")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only print the jobs and their resource needs (and, with --incremental, their stale stages)")
+    incremental = parser.add_argument_group("incremental runs")
+    incremental.add_argument("--incremental", action="store_true",
+                             help="Recompute only the stages whose inputs changed since each job's last run: "
+                                  "re-score steps and NLI offline when the LLM outputs are still valid, "
+                                  "regenerate (or restore from outputs/dag_cache) otherwise, and resume every queued job")
+    incremental.add_argument("--adopt_untracked", action="store_true",
+                             help="Treat result files from before --incremental as matching the current inputs "
+                                  "instead of regenerating them")
+    budget = parser.add_argument_group("wall-clock budget")
+    budget.add_argument("--time_budget", default=None,
+                        help="Finish the matrix within this time (e.g. 4h, 90m, 1h30m) by allotting samples per job "
+                             "for comparable precision, re-planned from the observed throughput")
+    budget.add_argument("--warmup_samples", type=int, default=10,
+                        help="Samples each job runs to measure its throughput before the plan applies")
+    budget.add_argument("--plan_chunk", type=int, default=50,
+                        help="Samples per segment between two re-plans")
+    add_stopping_arguments(parser)
+    args = parser.parse_args()
+    stopping = stopping_rule_from_args(args)
+    try:
+        time_budget = parse_duration(args.time_budget) if args.time_budget else None
+    except ValueError as e:
+        parser.error(str(e))
+    if time_budget is not None and stopping is not None:
+        # 自适应采样会打乱前 sample_size 行，逐段增长的样本集合不再互相包含
+        parser.error("--time_budget cannot be combined with the adaptive sampling flags")
+
+    try:
+        endpoints = parse_key_values(args.endpoint)
+        endpoint_slots = parse_key_values(args.endpoint_slots, int)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if endpoints:
+        # 子进程会继承该环境变量，本进程中的 run_inference 也读取它
+        os.environ["OLLAMA_HOSTS"] = ",".join(f"{model}={url}" for model, url in endpoints.items())
+
+    jobs = build_matrix(args.datasets, args.shots, args.prompt_types, args.models, args.sample_size,
+                        args.isolate, args.job_cpu_cores)
+    llm_slots = {job.needs.endpoint: args.llm_slots for job in jobs}
+    llm_slots.update({url.rstrip("/"): slots for url, slots in endpoint_slots.items()})
+    # 进程内运行的实验共享一个 NLI 模型，整个运行期间保持加载
+    nli_memory_gb = args.nli_memory_gb if args.isolate else args.nli_memory_gb - NLI_MODEL_MEMORY_GB
+    if nli_memory_gb < 0:
+        parser.error(f"--nli_memory_gb must be at least {NLI_MODEL_MEMORY_GB} to hold the NLI model")
+    pool = ResourcePool(llm_slots, nli_memory_gb, args.cpu_cores)
+
+    print(f"Experiment matrix: {len(jobs)} jobs")
+    print(pool.describe())
+    for job in jobs:
+        print(f"  {job.name:<44} {job.needs}")
+    dag = None
+    if args.incremental:
+        dag = ExperimentDag(args.entail_mode, args.contrastive, args.coherence, args.near_dup_threshold,
+                            adopt_untracked=args.adopt_untracked)
+    if args.dry_run:
+        if dag is not None:
+            print("Stale stages:")
+            for job in jobs:
+                plan = dag.plan(job.dataset, job.shot, job.prompt_type, job.model_name, args.sample_size)
+                print(f"  {job.name:<44} {plan.describe()}")
+        raise SystemExit(0)
+
+    total_start = time.time()
+    queued = jobs
+    if dag is not None:
+        print("Refreshing stale stages:")
+        queued = refresh_stale_stages(jobs, dag, args.sample_size)
+        print(f"{len(queued)} of {len(jobs)} jobs need LLM calls")
+    # 增量运行追加到输入未变的产物（失效的产物已经打包进缓存）
+    resume = args.resume or dag is not None
+    planner = None
+    if time_budget is not None:
+        planner = BudgetPlanner(queued, time_budget, llm_slots, args.sample_size, args.warmup_samples,
+                                args.plan_chunk, resume=resume, start=total_start)
+        print(planner.summary())
+    run_matrix(queued, pool, args.sample_size, args.entail_mode, args.contrastive, args.coherence,
+               args.near_dup_threshold, resume, args.parquet, stopping, args.isolate,
+               args.status_interval, planner)
+    print(f"\nAll jobs completed! Total time: {(time.time() - total_start):.2f} seconds")
+    print_matrix_summary(jobs)
+    print(f"Summary saved to {save_matrix_summary(jobs, planner=planner)}")
@@ -0,0 +1,166 @@
+# dead_letter.py
+# 死信文件：LLM 调用重试后仍失败的样本不写入结果文件、不参与指标，而是连同错误信息和运行配置写入 <结果>.failed.jsonl；
+# 之后的续跑或 `python -m src.retry_failed` 只重跑这些样本并合并回结果文件，成功的样本从死信文件中移除。
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+from src.utils.prob_sidecar import ProbabilitySidecar, journal_path, sidecar_path
+from src.utils.result_io import completed_ids, iter_result_records
+
+DEAD_LETTER_SUFFIX = ".failed.jsonl"
+
+# 旧版本 run_inference 在重试失败时返回的字符串，会被当作模型输出写入结果文件
+LEGACY_FAILURE_OUTPUT = "[Ollama API调用失败]"
+
+
+def dead_letter_path(result_file: str) -> str:
+    base = result_file[:-len(".jsonl")] if result_file.endswith(".jsonl") else result_file
+    return base + DEAD_LETTER_SUFFIX
+
+
+def is_dead_letter_file(path: str) -> bool:
+    return path.endswith(DEAD_LETTER_SUFFIX)
+
+
+def load_dead_letters(path: str) -> Dict[str, Dict]:
+    """读取死信文件，返回 样本 id -> 最近一次失败的记录"""
+    entries = {}
+    for entry in iter_result_records(path):
+        entries[entry["id"]] = entry
+    return entries
+
+
+def _rewrite(path: str, entries: List[Dict]):
+    if not entries:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def merge_dead_letters(result_files: List[str], merged_result_file: str) -> int:
+    """
+    把各分片结果文件的死信合并成 merged_result_file 的死信文件，按 row_idx 排序；
+    运行参数改成不分片，retry_failed 重跑时写入合并后的结果文件。返回合并的条数
+    """
+    entries = {}
+    for result_file in result_files:
+        path = dead_letter_path(result_file)
+        if os.path.exists(path):
+            entries.update(load_dead_letters(path))
+    for entry in entries.values():
+        entry["config"] = dict(entry["config"], shard_index=0, shard_count=1, shard_policy="contiguous")
+    _rewrite(dead_letter_path(merged_result_file), sorted(entries.values(), key=lambda entry: entry["row_idx"]))
+    return len(entries)
+
+
+def prune_dead_letters(result_file: str) -> int:
+    """去掉已经出现在结果文件中的样本，同一样本只保留最近一次失败；没有剩余时删除死信文件。返回剩余条数"""
+    path = dead_letter_path(result_file)
+    if not os.path.exists(path):
+        return 0
+    done = completed_ids(result_file)
+    remaining = [entry for entry_id, entry in load_dead_letters(path).items() if entry_id not in done]
+    _rewrite(path, remaining)
+    return len(remaining)
+
+
+class DeadLetterWriter:
+    """
+    评估过程中逐条追加失败的样本；config 为重跑所需的运行参数（sample_size、entail_mode 等），随每条记录保存。
+    不续跑时清空旧的死信文件，与结果文件保持一致
+    """
+
+    def __init__(self, result_file: str, config: Dict, append: bool = False):
+        self.result_file = result_file
+        self.path = dead_letter_path(result_file)
+        self.config = config
+        if not append and os.path.exists(self.path):
+            os.remove(self.path)
+        self._file = None
+
+    def add(self, item, stage: str, error: Exception):
+        """记录一个样本在 stage（'reasoning' 或 'answer'）阶段的失败"""
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        entry = {
+            "id": item.get("id", ""),
+            "row_idx": item["row_idx"],
+            "stage": stage,
+            "error": getattr(error, "error", str(error)),
+            "error_type": getattr(error, "error_type", type(error).__name__),
+            "attempts": getattr(error, "attempts", None),
+            "url": getattr(error, "url", None),
+            "failed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "config": self.config,
+        }
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        print(f"LLM call failed for sample {entry['id']} ({stage}), moved to {self.path}: {entry['error']}")
+
+    def close(self) -> int:
+        """关闭文件并整理死信文件，返回仍然失败的样本数"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return prune_dead_letters(self.result_file)
+
+
+def quarantine_legacy_failures(result_file: str, config: Dict) -> int:
+    """
+    把旧版本写入结果文件的失败记录（model_reasoning 为 LEGACY_FAILURE_OUTPUT）移出结果文件、写入死信文件，返回移出的条数。
+    只能识别推理阶段的失败：答案阶段的失败字符串已经被抽取成选项标签，无法与正常输出区分
+    """
+    kept, failed = [], []
+    for position, record in enumerate(iter_result_records(result_file)):
+        # 早期的结果文件没有 row_idx，按行号补上（与 replay 一致），保留的记录也一并写回
+        record.setdefault("row_idx", position)
+        (failed if record.get("model_reasoning") == LEGACY_FAILURE_OUTPUT else kept).append(record)
+    if not failed:
+        return 0
+    # 概率 sidecar 中对应的记录一并去掉，重跑成功后重新写入
+    if os.path.exists(sidecar_path(result_file)) or os.path.exists(journal_path(result_file)):
+        sidecar = ProbabilitySidecar(result_file, resume=True)
+        for record in failed:
+            sidecar.discard(record["row_idx"])
+        sidecar.save()
+    path = dead_letter_path(result_file)
+    entries = load_dead_letters(path) if os.path.exists(path) else {}
+    for record in failed:
+        entries[record["id"]] = {
+            "id": record["id"],
+            "row_idx": record["row_idx"],
+            "stage": "reasoning",
+            "error": LEGACY_FAILURE_OUTPUT,
+            "error_type": "LegacyFailureOutput",
+            "attempts": None,
+            "url": None,
+            "failed_at": None,
+            "config": config,
+        }
+    _rewrite(path, list(entries.values()))
+    tmp_path = f"{result_file}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in kept:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, result_file)
+    return len(failed)
+
+
+def find_dead_letter_files(root: str = "outputs") -> Iterator[str]:
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        paths.extend(os.path.join(dirpath, name) for name in filenames if is_dead_letter_file(name))
+    yield from sorted(paths)
+
+
+def result_file_for(dead_letter_file: str) -> Optional[str]:
+    if not is_dead_letter_file(dead_letter_file):
+        return None
+    return dead_letter_file[:-len(DEAD_LETTER_SUFFIX)] + ".jsonl"
@@ -8,10 +8,14 @@ from transformers import AutoModelForSequenceClassification, AutoTokenizer
 from typing import List, Union, Dict, Optional
 import time
 
+from src.config import NLI_MODEL_NAME
+
 class NLIClient:
     def __init__(self,
-                 model_name: str = "roberta-large-mnli",
-                 device: str = "cuda" if torch.cuda.is_available() else "cpu"):
+                 model_name: str = NLI_MODEL_NAME,
+                 device: str = "cuda" if torch.cuda.is_available() else "cpu",
+                 max_length: int = 512,
+                 cache_size: int = 50000):
         self.device = device
         # 初始化分词器与模型
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
@@ -19,18 +23,102 @@ class NLIClient:
         self.model.eval()
         # 标签映射：0→ENTAILMENT, 1→NEUTRAL, 2→CONTRADICTION
         self.id2label = {0: "ENTAILMENT", 1: "NEUTRAL", 2: "CONTRADICTION"}
+        # 文本 → token id 缓存：同一样本的所有步骤共用同一个假设句，只需编码一次
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self._token_cache: Dict[str, List[int]] = {}
+        self._num_special = self.tokenizer.num_special_tokens_to_add(pair=True)
+        self._use_token_type_ids = "token_type_ids" in self.tokenizer.model_input_names
+
+    def _encode_text(self, text: str) -> List[int]:
+        """对单段文本编码（不含特殊符号），结果按文本缓存"""
+        ids = self._token_cache.get(text)
+        if ids is None:
+            if len(self._token_cache) >= self.cache_size:
+                self._token_cache.clear()
+            ids = self.tokenizer.encode(text, add_special_tokens=False)
+            self._token_cache[text] = ids
+        return ids
+
+    def _truncate_pair(self, premise_ids: List[int], hypothesis_ids: List[int]):
+        """按 longest_first 策略截断，与 tokenizer(truncation=True) 的行为一致"""
+        budget = self.max_length - self._num_special
+        overflow = len(premise_ids) + len(hypothesis_ids) - budget
+        if overflow <= 0:
+            return premise_ids, hypothesis_ids
+        p_len, h_len = len(premise_ids), len(hypothesis_ids)
+        for _ in range(overflow):
+            if p_len > h_len:
+                p_len -= 1
+            else:
+                h_len -= 1
+        return premise_ids[:p_len], hypothesis_ids[:h_len]
+
+    def _prepare_pairs(self,
+                       premises: List[str],
+                       hypotheses: List[str]) -> Dict[str, torch.Tensor]:
+        """
+        利用缓存的 token id 直接拼接成对输入，并写入预先分配好的填充张量，
+        避免对每个 premise-hypothesis 对重复调用 tokenizer。
+        """
+        rows = []
+        for premise, hypothesis in zip(premises, hypotheses):
+            p_ids, h_ids = self._truncate_pair(self._encode_text(premise),
+                                               self._encode_text(hypothesis))
+            row = self.tokenizer.build_inputs_with_special_tokens(p_ids, h_ids)
+            if self._use_token_type_ids:
+                types = self.tokenizer.create_token_type_ids_from_sequences(p_ids, h_ids)
+            else:
+                types = None
+            rows.append((row, types))
+
+        max_len = max(len(row) for row, _ in rows)
+        input_ids = torch.full((len(rows), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), max_len), dtype=torch.long)
+        token_type_ids = torch.zeros((len(rows), max_len), dtype=torch.long) if self._use_token_type_ids else None
+        for i, (row, types) in enumerate(rows):
+            input_ids[i, :len(row)] = torch.tensor(row, dtype=torch.long)
+            attention_mask[i, :len(row)] = 1
+            if token_type_ids is not None:
+                token_type_ids[i, :len(types)] = torch.tensor(types, dtype=torch.long)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if token_type_ids is not None:
+            inputs["token_type_ids"] = token_type_ids
+        return {k: v.to(self.device) for k, v in inputs.items()}
+
+    def window_premises(self,
+                        segments: List[str],
+                        hypothesis: str,
+                        prefix: str = "",
+                        joiner: str = " ") -> List[str]:
+        """
+        将多个片段按顺序拼接成若干前提窗口（每个窗口以 prefix 开头），
+        使每个窗口与假设句拼接后不超过 max_length。
+        单个片段本身超长时单独成窗，由 _truncate_pair 负责截断。
+        """
+        budget = (self.max_length - self._num_special
+                  - len(self._encode_text(hypothesis)) - len(self._encode_text(prefix)))
+        joiner_len = len(self._encode_text(joiner)) if joiner.strip() else 0
+        windows: List[str] = []
+        current: List[str] = []
+        current_len = 0
+        for seg in segments:
+            seg_len = len(self._encode_text(seg))
+            extra = seg_len + (joiner_len if current else 0)
+            if current and current_len + extra > budget:
+                windows.append(prefix + joiner.join(current))
+                current, current_len = [], 0
+                extra = seg_len
+            current.append(seg)
+            current_len += extra
+        if current:
+            windows.append(prefix + joiner.join(current))
+        return windows
 
     def _prepare_input(self, premise: str, hypothesis: str) -> Dict[str, torch.Tensor]:
         """准备单条输入的张量，供单条预测和entailment_score使用"""
-        inputs = self.tokenizer(
-            premise,
-            hypothesis,
-            truncation=True,
-            max_length=512,
-            padding=True,
-            return_tensors="pt"
-        )
-        return {k: v.to(self.device) for k, v in inputs.items()}
+        return self._prepare_pairs([premise], [hypothesis])
 
     def predict_batch(self,
                       premises: List[str],
@@ -42,16 +130,8 @@ class NLIClient:
             batch_premises = premises[i:i + batch_size]
             batch_hypotheses = hypotheses[i:i + batch_size]
             try:
-                # 使用 tokenizer 批量编码
-                inputs = self.tokenizer(
-                    batch_premises,
-                    batch_hypotheses,
-                    truncation=True,
-                    max_length=512,
-                    padding=True,
-                    return_tensors="pt"
-                )
-                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                # 使用缓存的 token id 批量拼接
+                inputs = self._prepare_pairs(batch_premises, batch_hypotheses)
 
                 with torch.no_grad():
                     outputs = self.model(**inputs)
@@ -94,6 +174,38 @@ class NLIClient:
             # 返回 ENTAILMENT 类别的概率
             return probs[0, 0].item()
 
+    def predict_proba(self,
+                      premises: List[str],
+                      hypotheses: List[str],
+                      batch_size: int = 32,
+                      bucket_by_length: bool = False) -> List[List[float]]:
+        """
+        批量获取多个输入对的三分类概率 [ENTAILMENT, NEUTRAL, CONTRADICTION]。
+        bucket_by_length=True 时先按 token 长度排序再分批，减少填充，结果仍按输入顺序返回。
+        """
+        order = list(range(len(premises)))
+        if bucket_by_length:
+            order.sort(key=lambda i: len(self._encode_text(premises[i])) + len(self._encode_text(hypotheses[i])))
+        probs: List[List[float]] = [None] * len(premises)
+        for i in range(0, len(order), batch_size):
+            idx = order[i:i + batch_size]
+            inputs = self._prepare_pairs([premises[j] for j in idx], [hypotheses[j] for j in idx])
+            with torch.no_grad():
+                outputs = self.model(**inputs)
+                batch_probs = torch.softmax(outputs.logits, dim=-1).tolist()
+            for j, p in zip(idx, batch_probs):
+                probs[j] = p
+        return probs
+
+    def entailment_scores(self,
+                          premises: List[str],
+                          hypotheses: List[str],
+                          batch_size: int = 32,
+                          bucket_by_length: bool = False) -> List[float]:
+        """批量获取多个输入对的 ENTAILMENT 概率分数"""
+        probs = self.predict_proba(premises, hypotheses, batch_size, bucket_by_length)
+        return [p[0] for p in probs]
+
 # 全局单例
 _nli_client = None
 
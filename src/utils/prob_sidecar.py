@@ -0,0 +1,181 @@
+# prob_sidecar.py
+# 每个结果文件旁的原始 NLI 概率 sidecar（<结果>.probs.npz）：保存每个步骤的 [ENTAILMENT, NEUTRAL, CONTRADICTION]
+# 三分类概率（float16，按记录用 CSR 偏移拼接）和链级概率，调整软阈值时无需重新跑 NLI（见 src.evaluation.threshold_sweep）。
+# 评估过程中每条概率只追加到 <结果>.probs.journal（每行一条 JSON，与结果文件一样定期 fsync），不在内存中累积；
+# 结束时由日志重建 .npz 并删除日志。崩溃后续跑时从 .npz 与日志恢复，结果文件中已有的记录不会丢失概率。
+import json
+import os
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+N_CLASSES = 3
+
+
+def sidecar_path(result_path: str) -> str:
+    base = result_path[:-len(".jsonl")] if result_path.endswith(".jsonl") else result_path
+    return base + ".probs.npz"
+
+
+def journal_path(result_path: str) -> str:
+    base = result_path[:-len(".jsonl")] if result_path.endswith(".jsonl") else result_path
+    return base + ".probs.journal"
+
+
+def _result_rows(result_path: str) -> Set[int]:
+    # 延迟导入，result_io 与本模块互不依赖
+    from src.utils.result_io import iter_result_records
+    if not os.path.exists(result_path):
+        return set()
+    return {record["row_idx"] for record in iter_result_records(result_path) if "row_idx" in record}
+
+
+def load_sidecar(path: str) -> Dict[str, np.ndarray]:
+    """
+    读取 sidecar，返回：
+        row_idx: (n,) int32
+        correct: (n,) bool，模型答案是否正确
+        step_offsets: (n + 1,) int64，第 i 条记录的步骤概率为 step_probs[step_offsets[i]:step_offsets[i + 1]]
+        step_probs: (总步骤数, 3) float16
+        chain_probs: (n, 3) float16，得分最高的链级窗口的概率；未做链级评估时为 NaN
+    """
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def _load_records(path: str) -> Dict[int, tuple]:
+    """读取 sidecar，返回 row_idx -> (correct, step_probs, chain_probs)"""
+    data = load_sidecar(path)
+    offsets = data["step_offsets"]
+    return {row: (bool(data["correct"][i]), data["step_probs"][offsets[i]:offsets[i + 1]], data["chain_probs"][i])
+            for i, row in enumerate(data["row_idx"].tolist())}
+
+
+def _iter_journal(path: str):
+    """逐条读取日志，返回 (row_idx, correct, step_probs, chain_probs)；跳过中断时写了一半的最后一行"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield (entry["row_idx"], entry["correct"],
+                   np.asarray(entry["step_probs"], dtype=np.float16).reshape(-1, N_CLASSES),
+                   np.asarray(entry["chain_probs"], dtype=np.float16))
+
+
+def _write_records(path: str, records: Dict[int, tuple]) -> str:
+    """按 row_idx 排序写入 sidecar"""
+    rows = sorted(records)
+    step_counts = [len(records[row][1]) for row in rows]
+    arrays = {
+        "row_idx": np.asarray(rows, dtype=np.int32),
+        "correct": np.asarray([records[row][0] for row in rows], dtype=bool),
+        "step_offsets": np.concatenate([[0], np.cumsum(step_counts, dtype=np.int64)]).astype(np.int64),
+        "step_probs": (np.concatenate([records[row][1] for row in rows])
+                       if rows else np.zeros((0, N_CLASSES), dtype=np.float16)),
+        "chain_probs": (np.stack([records[row][2] for row in rows])
+                        if rows else np.zeros((0, N_CLASSES), dtype=np.float16)),
+    }
+    # 先写临时文件再替换；传入文件对象，避免 numpy 自动追加 .npz 后缀
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+
+def merge_sidecars(result_paths: List[str], merged_result_path: str) -> Optional[str]:
+    """把各分片结果文件的 sidecar 按 row_idx 合并成 merged_result_path 的 sidecar；没有任何 sidecar 时返回 None"""
+    paths = [sidecar_path(path) for path in result_paths if os.path.exists(sidecar_path(path))]
+    if not paths:
+        return None
+    records = {}
+    for path in paths:
+        records.update(_load_records(path))
+    return _write_records(sidecar_path(merged_result_path), records)
+
+
+class ProbabilitySidecar:
+    """
+    评估过程中逐条把概率追加到日志，内存中不保留已评估的记录；save() 由已有的 .npz（续跑时）与日志重建 .npz。
+    续跑时先把已有的 sidecar 与上次中断留下的日志合并写回，只保留结果文件中存在的记录，
+    结果文件中有而概率缺失的记录给出警告（threshold_sweep 会跳过它们）
+    """
+
+    def __init__(self, result_path: str, resume: bool = False, fsync_every: int = 16):
+        self.result_path = result_path
+        self.path = sidecar_path(result_path)
+        self.journal_path = journal_path(result_path)
+        self.fsync_every = fsync_every
+        # 续跑时 save() 在已有的 .npz 上合并日志；否则覆盖
+        self._keep_existing = resume
+        # discard() 标记的记录，save() 时去掉
+        self._discarded: Set[int] = set()
+        self._journal = None
+        self._journaled = 0
+        if resume:
+            self._recover()
+        elif os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def _recover(self):
+        if not os.path.exists(self.path) and not os.path.exists(self.journal_path):
+            return
+        records = self._consolidated()
+        rows = _result_rows(self.result_path)
+        # 日志中已打分、但还没写入结果文件的记录（例如等待连贯性批次时中断）会被重新评估
+        for row in set(records) - rows:
+            del records[row]
+        missing = len(rows - set(records))
+        if missing:
+            print(f"Warning: {missing} records in {self.result_path} have no probabilities in {self.path}; "
+                  f"threshold_sweep will skip them")
+        # 合并后的状态写回 .npz，之后的日志只记录本次新增的概率
+        _write_records(self.path, records)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def _consolidated(self) -> Dict[int, tuple]:
+        """已有的 .npz（续跑时）加上日志中的记录，同一行以日志中最后一次为准"""
+        records = _load_records(self.path) if self._keep_existing and os.path.exists(self.path) else {}
+        for row, correct, step_probs, chain_probs in _iter_journal(self.journal_path):
+            records[row] = (bool(correct), step_probs, chain_probs)
+        for row in self._discarded:
+            records.pop(row, None)
+        return records
+
+    def add(self, row_idx: int, correct: bool, step_probs, chain_probs=None):
+        step_probs = np.asarray(step_probs, dtype=np.float32).reshape(-1, N_CLASSES)
+        chain_probs = (np.full(N_CLASSES, np.nan, dtype=np.float32) if chain_probs is None
+                       else np.asarray(chain_probs, dtype=np.float32))
+        self._discarded.discard(row_idx)
+        # 先于结果记录写入日志：结果文件中出现的记录在日志中一定有概率
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal.write(json.dumps({"row_idx": int(row_idx), "correct": bool(correct),
+                                        "step_probs": step_probs.tolist(),
+                                        "chain_probs": chain_probs.tolist()}) + "\n")
+        self._journal.flush()
+        self._journaled += 1
+        if self._journaled % self.fsync_every == 0:
+            os.fsync(self._journal.fileno())
+
+    def discard(self, row_idx: int):
+        """去掉一条记录的概率（该样本被移出结果文件时调用），save() 时生效"""
+        self._discarded.add(row_idx)
+
+    def save(self) -> str:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        _write_records(self.path, self._consolidated())
+        # 日志中的概率都已合并进 .npz
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        # 此后 .npz 即为全部状态
+        self._keep_existing = True
+        self._discarded.clear()
+        return self.path
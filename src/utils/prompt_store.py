@@ -0,0 +1,206 @@
+# prompt_store.py
+# 预编译的 prompt 仓库：按 (数据集, few/zero-shot, prompt 类型) 把整个数据划分、各阶段的 prompt 一次性渲染进 Parquet 文件，
+# 同时记录每条 prompt 的哈希与 token 数；文件元数据保存模板模块源码的哈希，模板改动后自动重新编译。
+import argparse
+import hashlib
+import importlib
+import inspect
+import os
+import re
+from typing import Callable, Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.datasets.loader import iter_split_batches, CSQA_COLUMNS, COSE_COLUMNS
+
+PROMPT_STORE_ROOT = os.path.join("outputs", "prompt_store")
+STAGES = ("reasoning", "answer")
+SHOTS = ("zero_shot", "few_shot")
+
+# 数据集简称 -> (data/ 下的目录名, 需要的列)
+DATASETS = {
+    "csqa": ("commonsenseqa", CSQA_COLUMNS),
+    "cose": ("cose", COSE_COLUMNS),
+}
+
+# (数据集, shot, prompt 类型) -> (模板模块, 构建函数)，与各 main 脚本原先的选择逻辑一致
+PROMPT_BUILDERS = {
+    ("csqa", "zero_shot", "simple"): ("prompts.templates.templated.simple", "build_prompt_csqa"),
+    ("csqa", "zero_shot", "templated"): ("prompts.templates.templated.templated1", "build_prompt_csqa"),
+    ("csqa", "zero_shot", "natural"): ("prompts.templates.naturalistic.natural1", "build_prompt_csqa"),
+    ("cose", "zero_shot", "simple"): ("prompts.templates.templated.simple", "build_prompt"),
+    ("cose", "zero_shot", "templated"): ("prompts.templates.templated.templated1", "build_prompt"),
+    ("cose", "zero_shot", "natural"): ("prompts.templates.naturalistic.natural1", "build_prompt"),
+    ("csqa", "few_shot", "templated"): ("prompts.templates.templated.templated_few_shot", "build_fewshot_prompt_csqa"),
+    ("csqa", "few_shot", "natural"): ("prompts.templates.naturalistic.natural_few_shot", "build_fewshot_prompt_csqa"),
+    ("cose", "few_shot", "templated"): ("prompts.templates.templated.templated_few_shot", "build_fewshot_prompt_coes"),
+    ("cose", "few_shot", "natural"): ("prompts.templates.naturalistic.natural_few_shot", "build_fewshot_prompt_cose"),
+}
+
+# Ollama 模型的分词器不在本地，默认用 "词 + 标点各计一个" 近似 token 数
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """近似 token 数"""
+    return len(_TOKEN_RE.findall(text))
+
+
+def prompt_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _resolve_builder(dataset: str, shot: str, prompt_type: str):
+    key = (dataset, shot, prompt_type)
+    if key not in PROMPT_BUILDERS:
+        raise ValueError(f"No prompt template registered for dataset={dataset}, shot={shot}, prompt_type={prompt_type}")
+    module_name, function_name = PROMPT_BUILDERS[key]
+    module = importlib.import_module(module_name)
+    return module, getattr(module, function_name)
+
+
+def template_hash(dataset: str, shot: str, prompt_type: str) -> str:
+    """模板模块完整源码 + 构建函数名的哈希；模块内任何改动（包括 few-shot 示例）都会使仓库失效"""
+    module, builder = _resolve_builder(dataset, shot, prompt_type)
+    source = inspect.getsource(module) + "\n" + builder.__name__
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def store_path(dataset: str, shot: str, prompt_type: str, split: str = "validation",
+               root: str = PROMPT_STORE_ROOT) -> str:
+    return os.path.join(root, f"{dataset}_{split}_{shot}_{prompt_type}.parquet")
+
+
+def compile_prompt_store(
+    dataset: str,
+    shot: str,
+    prompt_type: str,
+    split: str = "validation",
+    root: str = PROMPT_STORE_ROOT,
+    token_counter: Callable[[str], int] = count_tokens
+) -> str:
+    """
+    渲染整个数据划分在各阶段的 prompt 并写入 Parquet 文件。
+    参数：
+        dataset: 'csqa' 或 'cose'
+        shot: 'zero_shot' 或 'few_shot'
+        prompt_type: 'simple'、'templated' 或 'natural'
+        split: 数据划分
+        root: 仓库目录
+        token_counter: token 计数函数，可传入真实分词器的 lambda
+    返回：
+        写出的文件路径
+    """
+    _, builder = _resolve_builder(dataset, shot, prompt_type)
+    data_name, columns = DATASETS[dataset]
+
+    rows: Dict[str, list] = {"row_idx": [], "id": [], "stage": [], "prompt": [], "prompt_hash": [], "n_tokens": []}
+    for batch in iter_split_batches(data_name, split, columns):
+        for item in batch:
+            for stage in STAGES:
+                prompt = builder(item, stage=stage)
+                rows["row_idx"].append(item["row_idx"])
+                rows["id"].append(item["id"])
+                rows["stage"].append(stage)
+                rows["prompt"].append(prompt)
+                rows["prompt_hash"].append(prompt_hash(prompt))
+                rows["n_tokens"].append(token_counter(prompt))
+
+    module_name, function_name = PROMPT_BUILDERS[(dataset, shot, prompt_type)]
+    table = pa.table({
+        "row_idx": pa.array(rows["row_idx"], pa.int32()),
+        "id": pa.array(rows["id"], pa.string()),
+        "stage": pa.array(rows["stage"], pa.string()).dictionary_encode(),
+        "prompt": pa.array(rows["prompt"], pa.string()),
+        "prompt_hash": pa.array(rows["prompt_hash"], pa.string()),
+        "n_tokens": pa.array(rows["n_tokens"], pa.int32()),
+    })
+    table = table.replace_schema_metadata({
+        "template_hash": template_hash(dataset, shot, prompt_type),
+        "template_module": module_name,
+        "template_function": function_name,
+        "dataset": dataset,
+        "split": split,
+    })
+
+    path = store_path(dataset, shot, prompt_type, split, root)
+    os.makedirs(root, exist_ok=True)
+    # 先写临时文件再替换，避免并行实验读到写了一半的文件
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+    return path
+
+
+def ensure_prompt_store(dataset: str, shot: str, prompt_type: str, split: str = "validation",
+                        root: str = PROMPT_STORE_ROOT, rebuild: bool = False) -> str:
+    """仓库文件不存在或模板哈希不一致时重新编译，返回文件路径"""
+    path = store_path(dataset, shot, prompt_type, split, root)
+    if not rebuild and os.path.exists(path):
+        metadata = pq.read_schema(path).metadata or {}
+        if metadata.get(b"template_hash", b"").decode() == template_hash(dataset, shot, prompt_type):
+            return path
+    return compile_prompt_store(dataset, shot, prompt_type, split, root)
+
+
+class PromptStore:
+    """按 (行号, 阶段) 查询预编译 prompt"""
+
+    def __init__(self, table: pa.Table):
+        metadata = table.schema.metadata or {}
+        self.template_hash = metadata.get(b"template_hash", b"").decode()
+        self._prompts: Dict[str, Dict[int, str]] = {stage: {} for stage in STAGES}
+        self._n_tokens: Dict[str, Dict[int, int]] = {stage: {} for stage in STAGES}
+        for row_idx, stage, prompt, n_tokens in zip(
+            table.column("row_idx").to_pylist(),
+            table.column("stage").to_pylist(),
+            table.column("prompt").to_pylist(),
+            table.column("n_tokens").to_pylist(),
+        ):
+            self._prompts[stage][row_idx] = prompt
+            self._n_tokens[stage][row_idx] = n_tokens
+
+    def prompt(self, row_idx: int, stage: str) -> str:
+        return self._prompts[stage][row_idx]
+
+    def n_tokens(self, row_idx: int, stage: str) -> int:
+        return self._n_tokens[stage][row_idx]
+
+    def __len__(self):
+        return len(self._prompts[STAGES[0]])
+
+
+def load_prompt_store(dataset: str, shot: str, prompt_type: str, split: str = "validation",
+                      root: str = PROMPT_STORE_ROOT, limit: Optional[int] = None) -> PromptStore:
+    """
+    读取（必要时先编译）prompt 仓库。
+    参数：
+        limit: 只载入前 limit 行的 prompt，None 表示全部
+    """
+    path = ensure_prompt_store(dataset, shot, prompt_type, split, root)
+    columns: List[str] = ["row_idx", "stage", "prompt", "n_tokens"]
+    filters = [("row_idx", "<", limit)] if limit is not None else None
+    return PromptStore(pq.read_table(path, columns=columns, filters=filters))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile prompt stores for every dataset x shot x prompt type")
+    parser.add_argument("--dataset", nargs="+", choices=list(DATASETS), default=list(DATASETS))
+    parser.add_argument("--shot", nargs="+", choices=SHOTS, default=list(SHOTS))
+    parser.add_argument("--prompt_type", nargs="+", choices=["simple", "templated", "natural"],
+                        default=["simple", "templated", "natural"])
+    parser.add_argument("--split", default="validation", help="Dataset split to render")
+    parser.add_argument("--root", default=PROMPT_STORE_ROOT, help="Prompt store directory")
+    parser.add_argument("--rebuild", action="store_true", help="Recompile even if the template hash matches")
+    args = parser.parse_args()
+
+    for dataset in args.dataset:
+        for shot in args.shot:
+            for prompt_type in args.prompt_type:
+                if (dataset, shot, prompt_type) not in PROMPT_BUILDERS:
+                    continue
+                path = ensure_prompt_store(dataset, shot, prompt_type, args.split, args.root, args.rebuild)
+                n_tokens = pq.read_table(path, columns=["n_tokens"]).column("n_tokens")
+                print(f"{path}: {len(n_tokens)} prompts, {pc.sum(n_tokens).as_py()} tokens")
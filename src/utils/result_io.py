@@ -0,0 +1,100 @@
+# result_io.py
+# 结果文件的命名与逐条写入：每评估完一个样本就追加一行 JSON，定期 fsync，崩溃时最多丢失尚未落盘的几条；
+# --resume 时跳过文件中已有的样本 id，最终的汇总指标从文件流式重新计算，内存占用与样本数无关。
+import json
+import os
+from typing import Dict, Iterable, Iterator, Set
+
+from src.utils.shards import shard_suffix
+
+OUTPUT_ROOT = "outputs"
+
+
+def result_path(dataset: str, shot: str, model_name: str, prompt_type: str,
+                shard_index: int = 0, shard_count: int = 1, root: str = OUTPUT_ROOT) -> str:
+    """
+    各实验脚本的结果文件路径，例如 outputs/few_shot/csqa_entail_results_mistral_7b_few-shot_natural.jsonl
+    """
+    model_name_cleaned = model_name.replace(':', '_')
+    shot_tag = "few-shot_" if shot == "few_shot" else ""
+    return os.path.join(root, shot, f"{dataset}_entail_results_{model_name_cleaned}_{shot_tag}{prompt_type}"
+                                    f"{shard_suffix(shard_index, shard_count)}.jsonl")
+
+
+def repair_partial_tail(path: str) -> int:
+    """
+    截掉崩溃时写了一半的最后一行，返回截掉的字节数
+    """
+    if not os.path.exists(path):
+        return 0
+    good_end = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                if line.strip():
+                    json.loads(line)
+            except ValueError:
+                break
+            good_end += len(line)
+        size = f.seek(0, os.SEEK_END)
+    if size > good_end:
+        with open(path, 'r+b') as f:
+            f.truncate(good_end)
+    return size - good_end
+
+
+def iter_result_records(path: str) -> Iterator[Dict]:
+    """逐行读取结果文件，不把整个文件载入内存"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def completed_ids(path: str) -> Set[str]:
+    """
+    续跑前调用：修复不完整的末行，返回已写入的样本 id 集合
+    """
+    if not os.path.exists(path):
+        return set()
+    repair_partial_tail(path)
+    return {record["id"] for record in iter_result_records(path)}
+
+
+class ResultWriter:
+    """
+    逐条追加结果记录：每条写入后 flush 到操作系统，每 fsync_every 条 fsync 一次落盘
+    """
+
+    def __init__(self, path: str, append: bool = False, fsync_every: int = 16):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.fsync_every = fsync_every
+        self.written = 0
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, record: Dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.written += 1
+        if self.written % self.fsync_every == 0:
+            os.fsync(self._file.fileno())
+
+    def write_all(self, records: Iterable[Dict]):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,239 @@
+# result_parquet.py
+# 结果文件的列式版本：把 JSONL 结果流式转换成 zstd 压缩的 Parquet（与 JSONL 同名，后缀 .parquet），
+# 步骤、逐步分数与连贯性分数存为嵌套 list 列，数据集 / shot / 模型 / prompt 类型等重复取值的列用字典编码；
+# 读取时只加载需要的列（Parquet 按列存储，其余列不会被解压）。JSONL 仍是续跑与汇总的依据，Parquet 用于存档和分析。
+import argparse
+import os
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.evaluation.entailment import decode_float16_matrix
+from src.utils.result_io import iter_result_records
+from src.cot_extraction.corpus import iter_result_files
+
+# csqa_entail_results_mistral_7b_few-shot_natural.shard0of4.jsonl -> csqa / few_shot / mistral_7b / natural
+_RESULT_NAME_RE = re.compile(
+    r'^(?P<dataset>[a-z]+)_entail_results_(?P<model>.+?)_(?P<few_shot>few-shot_)?'
+    r'(?P<prompt_type>simple|templated|natural)(?:\.shard\d+of\d+)?\.(?:jsonl|parquet)$'
+)
+
+_LABEL = pa.dictionary(pa.int8(), pa.string())
+
+RESULT_SCHEMA = pa.schema([
+    ("dataset", _LABEL),
+    ("shot", _LABEL),
+    ("model", _LABEL),
+    ("prompt_type", _LABEL),
+    ("row_idx", pa.int32()),
+    ("id", pa.string()),
+    ("question", pa.string()),
+    ("choice_labels", pa.list_(pa.string())),
+    ("choice_texts", pa.list_(pa.string())),
+    ("answer_label", pa.string()),
+    ("answer", pa.string()),
+    ("model_reasoning", pa.string()),
+    ("model_answer", pa.string()),
+    ("used_answer_text", pa.string()),
+    ("correct", pa.bool_()),
+    ("extracted_steps", pa.list_(pa.string())),
+    ("near_duplicates_removed", pa.int32()),
+    ("nli_calls_saved", pa.int32()),
+    # entailment_info 展开；step_details 只保留分数与标签，步骤文本与 extracted_steps 相同
+    ("entail_mode", _LABEL),
+    ("hypothesis", pa.string()),
+    ("entailment_ratio", pa.float32()),
+    ("valid_steps", pa.int32()),
+    ("entail_steps", pa.int32()),
+    ("step_scores", pa.list_(pa.float32())),
+    ("step_labels", pa.list_(_LABEL)),
+    ("chain_score", pa.float32()),
+    ("chain_label", _LABEL),
+    ("chain_ratio", pa.float32()),
+    ("chain_windows", pa.int32()),
+    # 对比式评估（未开启时为 null）；choice_matrix 为 (步骤 × 选项) 的嵌套列表
+    ("choice_matrix", pa.list_(pa.list_(pa.float32()))),
+    ("chosen_index", pa.int8()),
+    ("contrastive_ratio", pa.float32()),
+    ("mean_margin", pa.float32()),
+    ("chain_agrees", pa.bool_()),
+    # 连贯性（未开启时为 null）
+    ("coherence", pa.float32()),
+    ("question_consistency", pa.float32()),
+    ("consecutive_entail", pa.list_(pa.float32())),
+    ("consecutive_contradiction", pa.list_(pa.float32())),
+    ("question_contradiction", pa.list_(pa.float32())),
+])
+
+
+def parse_result_name(path: str) -> Optional[Dict[str, str]]:
+    """从结果文件名（.jsonl 或 .parquet）解析 dataset / shot / model / prompt_type，模型名为文件名中的形式（':' 已替换为 '_'）"""
+    match = _RESULT_NAME_RE.match(os.path.basename(path))
+    if match is None:
+        return None
+    return {
+        "dataset": match.group("dataset"),
+        "shot": "few_shot" if match.group("few_shot") else "zero_shot",
+        "model": match.group("model"),
+        "prompt_type": match.group("prompt_type"),
+    }
+
+
+def parquet_path(result_path: str) -> str:
+    base = result_path[:-len(".jsonl")] if result_path.endswith(".jsonl") else result_path
+    return base + ".parquet"
+
+
+def _record_row(record: Dict, meta: Dict[str, str]) -> Dict:
+    """把一条 JSONL 记录展开成 RESULT_SCHEMA 的一行；早期文件缺少的字段记为 null"""
+    choices = record.get("choices")
+    if isinstance(choices, dict):
+        choice_labels, choice_texts = list(choices.keys()), list(choices.values())
+    elif isinstance(choices, list):
+        # CoS-E 的选项是列表，标签按 A/B/C... 顺序
+        choice_labels, choice_texts = [chr(ord('A') + i) for i in range(len(choices))], choices
+    else:
+        choice_labels = choice_texts = None
+
+    info = record.get("entailment_info") or {}
+    details = info.get("step_details") or []
+    contrastive = info.get("contrastive") or {}
+    coherence_info = record.get("coherence_info") or {}
+    matrix = contrastive.get("choice_matrix")
+
+    return {
+        **meta,
+        "row_idx": record.get("row_idx"),
+        "id": record.get("id"),
+        "question": record.get("question"),
+        "choice_labels": choice_labels,
+        "choice_texts": choice_texts,
+        "answer_label": record.get("answer_label"),
+        "answer": record.get("answer"),
+        "model_reasoning": record.get("model_reasoning"),
+        "model_answer": record.get("model_answer"),
+        "used_answer_text": record.get("used_answer_text"),
+        "correct": record.get("model_answer") == record.get("answer_label"),
+        "extracted_steps": record.get("extracted_steps"),
+        "near_duplicates_removed": record.get("near_duplicates_removed"),
+        "nli_calls_saved": record.get("nli_calls_saved"),
+        "entail_mode": info.get("mode"),
+        "hypothesis": info.get("hypothesis"),
+        "entailment_ratio": info.get("ratio"),
+        "valid_steps": info.get("valid_steps"),
+        "entail_steps": info.get("entail_steps"),
+        "step_scores": [d["score"] for d in details],
+        "step_labels": [d["label"] for d in details],
+        "chain_score": info.get("chain_score"),
+        "chain_label": info.get("chain_label"),
+        "chain_ratio": info.get("chain_ratio"),
+        "chain_windows": info.get("chain_windows"),
+        "choice_matrix": decode_float16_matrix(matrix).astype("float32").tolist() if matrix else None,
+        "chosen_index": contrastive.get("chosen_index"),
+        "contrastive_ratio": contrastive.get("contrastive_ratio"),
+        "mean_margin": contrastive.get("mean_margin"),
+        "chain_agrees": contrastive.get("chain_agrees"),
+        "coherence": coherence_info.get("coherence"),
+        "question_consistency": coherence_info.get("question_consistency"),
+        "consecutive_entail": coherence_info.get("consecutive_entail"),
+        "consecutive_contradiction": coherence_info.get("consecutive_contradiction"),
+        "question_contradiction": coherence_info.get("question_contradiction"),
+    }
+
+
+def write_results_parquet(
+    path: str,
+    output_path: Optional[str] = None,
+    meta: Optional[Dict[str, str]] = None,
+    row_group_size: int = 1024
+) -> str:
+    """
+    把一个 JSONL 结果文件流式转换为 Parquet，每 row_group_size 条记录写一个 row group，内存占用与文件大小无关。
+    参数：
+        path: JSONL 结果文件
+        output_path: 默认与 JSONL 同名，后缀 .parquet
+        meta: dataset / shot / model / prompt_type，默认由文件名解析
+    返回：
+        Parquet 文件路径
+    """
+    meta = meta or parse_result_name(path)
+    if meta is None:
+        raise ValueError(f"Cannot infer dataset/shot/model/prompt type from file name: {path}")
+    output_path = output_path or parquet_path(path)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    # 先写临时文件再替换，避免分析脚本读到写了一半的文件
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with pq.ParquetWriter(tmp_path, RESULT_SCHEMA, compression="zstd") as writer:
+        rows = []
+        for record in iter_result_records(path):
+            rows.append(_record_row(record, meta))
+            if len(rows) == row_group_size:
+                writer.write_table(pa.Table.from_pylist(rows, schema=RESULT_SCHEMA))
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=RESULT_SCHEMA))
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def find_result_parquets(paths: Union[str, Sequence[str]]) -> List[str]:
+    """展开目录，只保留文件名符合结果命名规则的 Parquet 文件（跳过 prompt 仓库、基线等其他 Parquet）"""
+    files = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, name) for name in filenames
+                             if name.endswith(".parquet") and parse_result_name(name) is not None)
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def read_results(
+    paths: Union[str, Sequence[str]],
+    columns: Optional[List[str]] = None,
+    filter: Optional[ds.Expression] = None
+) -> pa.Table:
+    """
+    读取一个或多个 Parquet 结果文件（或目录），只加载 columns 中的列；filter 为 pyarrow.dataset 表达式，
+    例如 ds.field("model") == "mistral_7b"，按 row group 统计信息跳过不需要的数据
+    """
+    dataset = ds.dataset(find_result_parquets(paths), format="parquet", schema=RESULT_SCHEMA)
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def iter_result_batches(
+    paths: Union[str, Sequence[str]],
+    columns: Optional[List[str]] = None,
+    batch_size: int = 1024
+) -> Iterator[pa.RecordBatch]:
+    """按批次流式读取指定列，适合不想把整列载入内存的扫描"""
+    dataset = ds.dataset(find_result_parquets(paths), format="parquet", schema=RESULT_SCHEMA)
+    yield from dataset.to_batches(columns=columns, batch_size=batch_size)
+
+
+def _iter_jsonl(paths: Iterable[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_result_files(path)
+        else:
+            yield path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert JSONL result files to zstd-compressed Parquet")
+    parser.add_argument("paths", nargs="*", default=["outputs"], help="Result JSONL files or directories to scan")
+    parser.add_argument("--row_group_size", type=int, default=1024, help="Records per Parquet row group")
+    args = parser.parse_args()
+
+    for path in _iter_jsonl(args.paths):
+        if not path.endswith(".jsonl") or parse_result_name(path) is None:
+            print(f"Skipping {path}: not a result file name")
+            continue
+        output_path = write_results_parquet(path, row_group_size=args.row_group_size)
+        print(f"{path} ({os.path.getsize(path) / 1e6:.1f} MB) -> {output_path} "
+              f"({os.path.getsize(output_path) / 1e6:.1f} MB)")
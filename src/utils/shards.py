@@ -0,0 +1,176 @@
+# shards.py
+# 分片结果文件的命名与合并：各节点用 --shard-index/--shard-count 独立跑同一个实验，
+# 每个分片写入带 ".shard{i}of{n}" 后缀的结果文件，merge 按 row_idx 还原成一个有序结果文件并重新计算汇总指标，
+# 各分片的概率 sidecar 与死信文件一并合并。
+import argparse
+import glob
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Optional
+
+from src.evaluation.metrics import ExperimentMetrics, load_metrics, save_metrics
+from src.utils.prob_sidecar import merge_sidecars
+
+_SHARD_SUFFIX_RE = re.compile(r'\.shard(\d+)of(\d+)\.jsonl$')
+
+
+def shard_suffix(shard_index: int = 0, shard_count: int = 1) -> str:
+    """分片文件名后缀；不分片时为空，保持原有文件名不变"""
+    return "" if shard_count == 1 else f".shard{shard_index}of{shard_count}"
+
+
+def find_shard_files(merged_path: str) -> List[str]:
+    """返回合并目标文件对应的全部分片文件，按分片号排序；缺少分片时报错"""
+    base = merged_path[:-len(".jsonl")] if merged_path.endswith(".jsonl") else merged_path
+    shard_files = {}
+    shard_counts = set()
+    for path in glob.glob(glob.escape(base) + ".shard*of*.jsonl"):
+        match = _SHARD_SUFFIX_RE.search(path)
+        if match:
+            shard_files[int(match.group(1))] = path
+            shard_counts.add(int(match.group(2)))
+    if not shard_files:
+        raise FileNotFoundError(f"No shard files found for {merged_path}")
+    if len(shard_counts) != 1:
+        raise ValueError(f"Shard files for {merged_path} disagree on the shard count: {sorted(shard_counts)}")
+    shard_count = shard_counts.pop()
+    missing = sorted(set(range(shard_count)) - set(shard_files))
+    if missing:
+        raise FileNotFoundError(f"Missing shards {missing} of {shard_count} for {merged_path}")
+    return [shard_files[i] for i in range(shard_count)]
+
+
+# 百分比形式的汇总指标；其余为计数
+RATIO_KEYS = ("accuracy", "entailment_ratio", "chain_entailment", "contrastive_ratio", "coherence",
+              "question_consistency")
+
+
+def summarize_results(records: Iterable[Dict]) -> Dict[str, Optional[float]]:
+    """由结果记录重新计算各实验脚本打印的汇总指标；只遍历一次，可直接传入逐行读取文件的生成器"""
+    sums = {key: 0.0 for key in RATIO_KEYS}
+    counts = {key: 0 for key in RATIO_KEYS}
+    sample_size = near_dup_removed = nli_calls_saved = 0
+
+    def add(key, value):
+        if value is not None:
+            sums[key] += value
+            counts[key] += 1
+
+    for r in records:
+        sample_size += 1
+        info = r.get("entailment_info", {})
+        coherence_info = r.get("coherence_info", {})
+        add("accuracy", float(r.get("model_answer") == r.get("answer_label")))
+        add("entailment_ratio", info.get("ratio"))
+        add("chain_entailment", info.get("chain_ratio"))
+        add("contrastive_ratio", info.get("contrastive", {}).get("contrastive_ratio"))
+        add("coherence", coherence_info.get("coherence"))
+        add("question_consistency", coherence_info.get("question_consistency"))
+        near_dup_removed += r.get("near_duplicates_removed", 0)
+        nli_calls_saved += r.get("nli_calls_saved", 0)
+
+    summary = {"sample_size": sample_size}
+    summary.update({key: sums[key] / counts[key] if counts[key] else None for key in RATIO_KEYS})
+    summary["near_duplicates_removed"] = near_dup_removed
+    summary["nli_calls_saved"] = nli_calls_saved
+    return summary
+
+
+def _sum_dicts(dicts: List[Optional[Dict]]) -> Optional[Dict]:
+    """逐键求和（token 用量、耗时）；任一分片缺少时为 None"""
+    if not dicts or any(d is None for d in dicts):
+        return None
+    return {key: sum(d[key] for d in dicts if d.get(key) is not None) for key in dicts[0]}
+
+
+def _merged_metrics(merged_path: str, shard_files: List[str], summary: Dict) -> ExperimentMetrics:
+    """
+    由各分片的 .metrics.json 组合出合并后的 ExperimentMetrics：汇总指标按合并后的记录重新计算，
+    evaluated、failed、token 用量与耗时为各分片之和，duration 取最慢的分片（分片在不同节点上并行运行）。
+    早于 .metrics.json 的分片没有这些信息，实验标识由文件名解析
+    """
+    shard_metrics = [load_metrics(path) for path in shard_files]
+    known = [m for m in shard_metrics if m is not None]
+    if known:
+        first = known[0]
+        identity = {"dataset": first.dataset, "shot": first.shot, "prompt_type": first.prompt_type,
+                    "model_name": first.model_name}
+    else:
+        # 延迟导入：result_parquet 依赖 pyarrow
+        from src.utils.result_parquet import parse_result_name
+        meta = parse_result_name(merged_path)
+        if meta is None:
+            raise ValueError(f"Cannot tell the experiment of {merged_path}: no shard metrics and an unknown file name")
+        name, _, tag = meta["model"].rpartition("_")
+        identity = {"dataset": meta["dataset"], "shot": meta["shot"], "prompt_type": meta["prompt_type"],
+                    "model_name": f"{name}:{tag}" if name else tag}
+    complete = len(known) == len(shard_metrics)
+    evaluated = sum(m.evaluated for m in known)
+    timings = _sum_dicts([m.timings if m is not None else None for m in shard_metrics])
+    if timings is not None:
+        timings["seconds_per_sample"] = timings["total_seconds"] / evaluated if evaluated else None
+    return ExperimentMetrics(
+        **identity,
+        output_file=merged_path,
+        duration=max((m.duration for m in known if m.duration is not None), default=None) if complete else None,
+        evaluated=evaluated,
+        failed=sum(m.failed for m in known),
+        timings=timings,
+        token_usage=_sum_dicts([m.token_usage if m is not None else None for m in shard_metrics]),
+        **summary,
+    )
+
+
+def merge_shards(merged_path: str, remove_shards: bool = False) -> ExperimentMetrics:
+    """
+    合并分片结果文件：按 row_idx 排序写入 merged_path，并把汇总指标写入同名的 .metrics.json；
+    各分片的概率 sidecar 与死信文件同样按 row_idx 合并。
+    返回：
+        合并后的 ExperimentMetrics
+    """
+    shard_files = find_shard_files(merged_path)
+    records = []
+    for path in shard_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r["row_idx"])
+    row_ids = [r["row_idx"] for r in records]
+    if len(set(row_ids)) != len(row_ids):
+        raise ValueError(f"Shards of {merged_path} overlap: duplicate row_idx values")
+
+    with open(merged_path, 'w', encoding='utf-8') as f:
+        for r in records:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    # 延迟导入：dead_letter 经 result_io 依赖本模块
+    from src.utils.dead_letter import merge_dead_letters
+    merge_sidecars(shard_files, merged_path)
+    merge_dead_letters(shard_files, merged_path)
+    metrics = _merged_metrics(merged_path, shard_files, summarize_results(records))
+    save_metrics(metrics, merged_path)
+
+    if remove_shards:
+        for path in shard_files:
+            base = path[:-len(".jsonl")]
+            for suffix in (".jsonl", ".probs.npz", ".metrics.json", ".failed.jsonl"):
+                if os.path.exists(base + suffix):
+                    os.remove(base + suffix)
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge sharded result files into one ordered result file")
+    parser.add_argument("paths", nargs="+",
+                        help="Merged result paths, e.g. outputs/zero_shot/csqa_entail_results_mistral_7b_templated.jsonl")
+    parser.add_argument("--remove_shards", action="store_true", help="Delete the shard files after merging")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        metrics = merge_shards(path, args.remove_shards)
+        print(f"Merged {metrics.sample_size} records into {path}")
+        for key in RATIO_KEYS:
+            value = getattr(metrics, key)
+            if value is not None:
+                print(f"  {key}: {value:.2%}")
+        if metrics.failed:
+            print(f"  failed: {metrics.failed} (see {path[:-len('.jsonl')]}.failed.jsonl)")